@@ -17,10 +17,13 @@ from qgis.core import (QgsField, QgsFeature, QgsFeatureSink, QgsFeatureRequest,
                         
 from qgis.utils import iface
 
-from datetime import datetime
+from date_parsing import datetime_parser
 
 import os
 
+# output features are written to the sink in batches of this size
+SINK_BATCH_SIZE = 10000
+
                        
 class AddDateField(QgsProcessingAlgorithm):
     INPUT = 'INPUT'
@@ -91,7 +94,11 @@ class AddDateField(QgsProcessingAlgorithm):
         (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
                                                output_flds, source.wkbType(), source.sourceCrs())
         
-        all_feats = []
+        date_idx = source.fields().lookupField(date_string_field)
+        # Format is compiled once; date only strings repeat, so their parsed values are cached
+        parse_date = datetime_parser(datetime_format, cache_size=4096)
+        
+        feats = []
         
         src_feat_count = source.featureCount()
         for i, ft in enumerate(source.getFeatures()):
@@ -101,14 +108,18 @@ class AddDateField(QgsProcessingAlgorithm):
             feedback.setProgress(round(pcnt, 1))
             feat = QgsFeature(output_flds)
             feat.setGeometry(ft.geometry())
-            atts = [att for att in ft.attributes()]
-            dt = datetime.strptime(ft[date_string_field], datetime_format)
+            atts = ft.attributes()
+            dt = parse_date(atts[date_idx])
             qdtd = QDate(dt.date())
             atts.insert(new_fld_idx, qdtd)
             feat.setAttributes(atts)
-            all_feats.append(feat)
+            feats.append(feat)
+            # Stream features to the sink so memory use doesn't grow with the input
+            if len(feats) >= SINK_BATCH_SIZE:
+                sink.addFeatures(feats, QgsFeatureSink.FastInsert)
+                feats = []
         
-        sink.addFeatures(all_feats)
+        sink.addFeatures(feats, QgsFeatureSink.FastInsert)
         
         return {self.OUTPUT: dest_id}
                 
@@ -17,9 +17,13 @@ from qgis.core import (QgsField, QgsFeature, QgsFeatureSink, QgsFeatureRequest,
                         
 from qgis.utils import iface
 
+from date_parsing import datetime_parser
 from datetime import datetime
 
 import os
+
+# output features are written to the sink in batches of this size
+SINK_BATCH_SIZE = 10000
 
                        
 class AddDateTimeField(QgsProcessingAlgorithm):
@@ -112,7 +116,13 @@ class AddDateTimeField(QgsProcessingAlgorithm):
         (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
                                                output_flds, source.wkbType(), source.sourceCrs())
         
-        all_feats = []
+        date_idx = source.fields().lookupField(date_string_field)
+        time_idx = source.fields().lookupField(time_string_field)
+        # Formats are compiled once; separate date strings repeat, so their parsed values are cached
+        parse_date = datetime_parser(date_format, cache_size=0 if date_idx == time_idx else 4096)
+        parse_time = datetime_parser(time_format)
+        
+        feats = []
         
         src_feat_count = source.featureCount()
         for i, ft in enumerate(source.getFeatures()):
@@ -122,25 +132,29 @@ class AddDateTimeField(QgsProcessingAlgorithm):
             feedback.setProgress(round(pcnt, 1))
             feat = QgsFeature(output_flds)
             feat.setGeometry(ft.geometry())
-            atts = [att for att in ft.attributes()]
+            atts = ft.attributes()
             #Parse DateTime###########################################
-            if date_string_field == time_string_field:
+            if date_idx == time_idx:
                 # Date and Time are both in a single field e.g. '2023-05-10 05:57:34Z'
                 # So we can parse a datetime object from either input
-                dt = datetime.strptime(ft[date_string_field], date_format)
-            elif date_string_field != time_string_field:
+                dt = parse_date(atts[date_idx])
+            else:
                 # Date and time info is in separate fields
                 # So we need to parse separately then combine
-                dd = datetime.strptime(ft[date_string_field], date_format)
-                tt = datetime.strptime(ft[time_string_field], time_format)
+                dd = parse_date(atts[date_idx])
+                tt = parse_time(atts[time_idx])
                 dt = datetime.combine(dd.date(), tt.time())
             qdtd = QDateTime(dt)
             #########################################################
             atts.insert(new_fld_idx, qdtd)
             feat.setAttributes(atts)
-            all_feats.append(feat)
+            feats.append(feat)
+            # Stream features to the sink so memory use doesn't grow with the input
+            if len(feats) >= SINK_BATCH_SIZE:
+                sink.addFeatures(feats, QgsFeatureSink.FastInsert)
+                feats = []
         
-        sink.addFeatures(all_feats)
+        sink.addFeatures(feats, QgsFeatureSink.FastInsert)
         
         return {self.OUTPUT: dest_id}
 
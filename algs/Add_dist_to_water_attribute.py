@@ -7,14 +7,17 @@ from qgis.core import (QgsField, QgsFeature, QgsFeatureSink, QgsFeatureRequest,
                         QgsProcessingParameterFeatureSource,
                         QgsProcessingParameterString, QgsWkbTypes,
                         QgsProcessingParameterField, QgsFields,
-                        QgsProcessingParameterFeatureSink, QgsGeometry,
-                        QgsProcessingParameterCrs, QgsCoordinateTransform,
-                        QgsSpatialIndex)
-                        
-import processing
-
+                        QgsProcessingParameterFeatureSink,
+                        QgsProcessingParameterCrs,
+                        QgsProcessingException)
+from transforms import transform_coords
+from nearest_water import NearestWaterIndex
+                        
 import os
 
+# source points are read, queried and written to the sink in batches of this size
+BATCH_SIZE = 10000
+
                        
 class AddDistanceToWaterAttribute(QgsProcessingAlgorithm):
     INPUT = 'INPUT'
@@ -144,61 +147,25 @@ class AddDistanceToWaterAttribute(QgsProcessingAlgorithm):
             wpt_vlayer = wpt_lyr.materialize(QgsFeatureRequest().setDestinationCrs(dest_crs, context.transformContext()))
         else:
             wpt_vlayer = wpt_lyr.materialize(QgsFeatureRequest())
-                        
-        fix_geom_params = {'INPUT': wpt_vlayer,
-                            'METHOD':1,
-                            'OUTPUT':'TEMPORARY_OUTPUT'}
-        wpt_vlayer_fixed_id = processing.run("native:fixgeometries",
-                                            fix_geom_params,
-                                            is_child_algorithm=True,
-                                            feedback=feedback,
-                                            context=context)['OUTPUT']
-        wpt_vlayer_fixed = context.getMapLayer(wpt_vlayer_fixed_id)
-        wpt_sp_idx = QgsSpatialIndex(wpt_vlayer_fixed)
         
-        output_feats = []
+        # Waterpoint coordinates, names & types are loaded once into a nearest neighbour index
+        wpt_index = NearestWaterIndex(wpt_vlayer, wpt_name_fld, wpt_type_fld)
+        if not len(wpt_index):
+            raise QgsProcessingException('Waterpoint layer contains no waterpoints')
+        
         feature_count = source.featureCount()
+        batch = []
         for i, ft in enumerate(source.getFeatures()):
-#            if i == 10:
-#                break
             if feedback.isCanceled():
                 break
-            pcnt = ((i+1)/feature_count)*100
-            feedback.setProgress(round(pcnt, 1))
-            if src_crs != dest_crs:
-                geom = self.transformed_geom(ft.geometry(), src_crs, dest_crs, context.project())
-            else:
-                geom = ft.geometry()
-            try:
-                pnt = geom.asMultiPoint()[0]
-            except TypeError:
-                pnt = geom.asPoint()
-            nwp_id = wpt_sp_idx.nearestNeighbor(pnt)[0]
-            nwp_ft = wpt_vlayer.getFeature(nwp_id)
-            atts = [ft[fld_name] for fld_name in source_fields]
-#            feedback.pushInfo(repr([fld.name() for fld in sink_fields]))
-#            feedback.pushInfo(repr(atts))
-            dist_to_nearest_water = geom.distance(nwp_ft.geometry())# meters
-            atts.append(round(dist_to_nearest_water, 3))
-            dist_to_nearest_water_km = dist_to_nearest_water/1000
-            atts.append(round(dist_to_nearest_water_km, 5))
-            if wpt_type_fld is not None:
-                #feedback.pushInfo(repr(nwp_ft))
-                try:
-                    nearest_wp_type = nwp_ft[wpt_type_fld]
-                except KeyError:
-                    nearest_wp_type = 'Not Found'
-                atts.append(str(nearest_wp_type))
-            try:
-                nearest_wp_name = nwp_ft[wpt_name_fld]
-            except KeyError:
-                nearest_wp_name = 'Not Found'
-            atts.append(str(nearest_wp_name))
-            feat = QgsFeature(sink_fields)
-            feat.setGeometry(ft.geometry())
-            feat.setAttributes(atts)
-            output_feats.append(feat)
-        sink.addFeatures(output_feats, QgsFeatureSink.FastInsert)
+            batch.append(ft)
+            if len(batch) == BATCH_SIZE:
+                self.write_batch(batch, source_fields, sink, sink_fields, wpt_index, wpt_type_fld, src_crs, dest_crs, context)
+                batch = []
+                pcnt = ((i+1)/feature_count)*100
+                feedback.setProgress(round(pcnt, 1))
+        if batch and not feedback.isCanceled():
+            self.write_batch(batch, source_fields, sink, sink_fields, wpt_index, wpt_type_fld, src_crs, dest_crs, context)
         
         if context.willLoadLayerOnCompletion(dest_id):
             details = context.layerToLoadOnCompletionDetails(dest_id)
@@ -211,10 +178,25 @@ class AddDistanceToWaterAttribute(QgsProcessingAlgorithm):
         return results
         
 
-    def transformed_geom(self, geom, src_crs, tgt_crs, project):
-        g = QgsGeometry.fromWkt(geom.asWkt())
-        xform = QgsCoordinateTransform(src_crs, tgt_crs, project)
-        g.transform(xform)
-        return g
+    def write_batch(self, feats, source_fields, sink, sink_fields, wpt_index, wpt_type_fld, src_crs, dest_crs, context):
+        '''Find the nearest water to a batch of gps points in one query and
+        write them to the sink with the distance to water attributes'''
+        # 0th vertex is the point for both Point and MultiPoint geoms
+        points = [ft.geometry().vertexAt(0) for ft in feats]
+        x, y = transform_coords([pt.x() for pt in points], [pt.y() for pt in points], src_crs, dest_crs, context.transformContext())
+        distances, wp_names, wp_types = wpt_index.nearest(x, y)# meters
+        output_feats = []
+        for ft, dist_to_nearest_water, nearest_wp_name, nearest_wp_type in zip(feats, distances.tolist(), wp_names, wp_types):
+            atts = [ft[fld_name] for fld_name in source_fields]
+            atts.append(round(dist_to_nearest_water, 3))
+            dist_to_nearest_water_km = dist_to_nearest_water/1000
+            atts.append(round(dist_to_nearest_water_km, 5))
+            if wpt_type_fld is not None:
+                atts.append(nearest_wp_type)
+            atts.append(nearest_wp_name)
+            feat = QgsFeature(sink_fields)
+            feat.setGeometry(ft.geometry())
+            feat.setAttributes(atts)
+            output_feats.append(feat)
+        sink.addFeatures(output_feats, QgsFeatureSink.FastInsert)
         
-        
\ No newline at end of file
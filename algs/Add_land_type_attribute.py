@@ -7,18 +7,27 @@ from qgis.core import (QgsField, QgsFeature, QgsFeatureSink, QgsFeatureRequest,
                         QgsProcessingParameterFeatureSource,
                         QgsProcessingParameterString, QgsWkbTypes,
                         QgsProcessingParameterField, QgsFields,
-                        QgsProcessingParameterFeatureSink, QgsGeometry,
-                        QgsProcessingParameterCrs, QgsCoordinateTransform,
-                        QgsSpatialIndex)
-
+                        QgsProcessingParameterFeatureSink,
+                        QgsProcessingParameterCrs,
+                        QgsProcessingParameterEnum,
+                        QgsProcessingParameterNumber,
+                        QgsProcessingParameterDefinition)
+from transforms import coordinate_transform, transform_coords
+from polygon_lookup import PolygonLookup
+
 import os
 
+# source points are read, looked up and written to the sink in batches of this size
+BATCH_SIZE = 10000
+
                        
 class AddLandTypeAttribute(QgsProcessingAlgorithm):
     INPUT = 'INPUT'
     SOURCE_FIELDS = 'SOURCE_FIELDS'
     LAND_TYPES = 'LAND_TYPES'
     LAND_TYPE_FIELD = 'LAND_TYPE_FIELD'
+    LOOKUP_METHOD = 'LOOKUP_METHOD'
+    GRID_CELL_SIZE = 'GRID_CELL_SIZE'
     OUTPUT = 'OUTPUT'
  
     def __init__(self):
@@ -38,7 +47,10 @@ class AddLandTypeAttribute(QgsProcessingAlgorithm):
  
     def shortHelpString(self):
         return "Add an attribute containing the land type in which the point\
-        is located for each point in a gps collar layer"
+        is located for each point in a gps collar layer. For very large point\
+        layers the land types can be looked up from a grid (advanced parameters),\
+        which is faster but only exact to the grid cell size at land type boundaries\
+        (land type layers in a projected CRS only)."
         
     def icon(self):
         return QIcon(os.path.join(os.path.dirname(__file__), "../icons/collar_icon.png"))
@@ -48,6 +60,14 @@ class AddLandTypeAttribute(QgsProcessingAlgorithm):
          
     def createInstance(self):
         return type(self)()
+        
+    def checkParameterValues(self, parameters, context):
+        lt_lyr = self.parameterAsSource(parameters, self.LAND_TYPES, context)
+        use_grid = self.parameterAsEnum(parameters, self.LOOKUP_METHOD, context) == 1
+        if use_grid and lt_lyr is not None and lt_lyr.sourceCrs().isGeographic():
+            # the grid cell size is in land type layer units, which would be degrees
+            return False, 'Grid lookup method needs a land type layer in a projected CRS'
+        return super().checkParameterValues(parameters, context)
    
     def initAlgorithm(self, config=None):
         self.addParameter(QgsProcessingParameterFeatureSource(
@@ -72,8 +92,23 @@ class AddLandTypeAttribute(QgsProcessingAlgorithm):
             'Field containing land type',
             parentLayerParameterName=self.LAND_TYPES,
             type=QgsProcessingParameterField.String))
+            
+        self.addParameter(QgsProcessingParameterEnum(
+            self.LOOKUP_METHOD,
+            'Land type lookup method',
+            ['Exact (point in polygon)', 'Grid (fast, approximate at land type boundaries)'],
+            defaultValue=0))
+        self.parameterDefinition(self.LOOKUP_METHOD).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
+            
+        self.addParameter(QgsProcessingParameterNumber(
+            self.GRID_CELL_SIZE,
+            'Grid cell size (land type layer units)',
+            QgsProcessingParameterNumber.Double,
+            defaultValue=25,
+            minValue=0.000001))
+        self.parameterDefinition(self.GRID_CELL_SIZE).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
         
-        self.addParameter(QgsProcessingParameterFeatureSink(
+        self.addParameter(QgsProcessingParameterFeatureSink(
             self.OUTPUT,
             "Points with land type attibute added",
             QgsProcessing.TypeVectorPoint))
@@ -93,6 +128,10 @@ class AddLandTypeAttribute(QgsProcessingAlgorithm):
         
         lt_crs = lt_lyr.sourceCrs()
         
+        use_grid = self.parameterAsEnum(parameters, self.LOOKUP_METHOD, context) == 1
+        
+        grid_cell_size = self.parameterAsDouble(parameters, self.GRID_CELL_SIZE, context)
+        
         output_fields = ([QgsField('Dist to nearest water m', len=8, prec=3),
                         QgsField('Dist to nearest water km', len=8, prec=5),
                         QgsField('Water Type', QVariant.String),
@@ -109,42 +148,27 @@ class AddLandTypeAttribute(QgsProcessingAlgorithm):
         (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
                                                sink_fields, source.wkbType(), source.sourceCrs())
         #############################################################
-        lt_sp_idx = QgsSpatialIndex(lt_lyr)
-        all_land_types = {ft.id(): ft for ft in lt_lyr.getFeatures()}
-        geom_engines = {}
-        for ft in lt_lyr.getFeatures():
-            geom_engine = QgsGeometry.createGeometryEngine(ft.geometry().constGet())
-            geom_engine.prepareGeometry()
-            geom_engines[ft.id()] = geom_engine
+        # Only land types which intersect the gps points are used
+        gps_extent = source.sourceExtent()
+        if src_crs != lt_crs:
+            gps_extent = coordinate_transform(src_crs, lt_crs, context.transformContext()).transformBoundingBox(gps_extent)
+        land_types = PolygonLookup(lt_lyr, lt_fld, gps_extent)
+        if use_grid:
+            land_types = land_types.grid(gps_extent, grid_cell_size)
         #############################################################
-        output_feats = []
         feature_count = source.featureCount()
+        batch = []
         for i, ft in enumerate(source.getFeatures()):
             if feedback.isCanceled():
                 break
-            pcnt = ((i+1)/feature_count)*100
-            feedback.setProgress(round(pcnt, 1))
-            if src_crs != lt_crs:
-                geom = self.transformed_geom(ft.geometry(), src_crs, lt_crs, context.project())
-            else:
-                geom = ft.geometry()
-            #pnt = geom.asMultiPoint()[0]
-            candidate_lt_ids = lt_sp_idx.intersects(geom.boundingBox())
-            #feedback.pushInfo(repr(candidate_lt_ids))
-            land_type = 'NULL'
-            if candidate_lt_ids:
-                for id in candidate_lt_ids:
-                    candidate_ft = all_land_types[id]
-                    ge = geom_engines[id]
-                    if ge.contains(geom.constGet()):
-                        land_type = candidate_ft[lt_fld]
-            atts = [ft[fld_name] for fld_name in source_fields]
-            atts.append(land_type)
-            feat = QgsFeature(sink_fields)
-            feat.setGeometry(ft.geometry())
-            feat.setAttributes(atts)
-            output_feats.append(feat)
-        sink.addFeatures(output_feats, QgsFeatureSink.FastInsert)
+            batch.append(ft)
+            if len(batch) == BATCH_SIZE:
+                self.write_batch(batch, source_fields, sink, sink_fields, land_types, src_crs, lt_crs, context)
+                batch = []
+                pcnt = ((i+1)/feature_count)*100
+                feedback.setProgress(round(pcnt, 1))
+        if batch and not feedback.isCanceled():
+            self.write_batch(batch, source_fields, sink, sink_fields, land_types, src_crs, lt_crs, context)
         
         if context.willLoadLayerOnCompletion(dest_id):
             details = context.layerToLoadOnCompletionDetails(dest_id)
@@ -157,8 +181,18 @@ class AddLandTypeAttribute(QgsProcessingAlgorithm):
         return results
         
 
-    def transformed_geom(self, geom, src_crs, tgt_crs, project):
-        g = QgsGeometry.fromWkt(geom.asWkt())
-        xform = QgsCoordinateTransform(src_crs, tgt_crs, project)
-        g.transform(xform)
-        return g
\ No newline at end of file
+    def write_batch(self, feats, source_fields, sink, sink_fields, land_types, src_crs, lt_crs, context):
+        '''Look up the land type of a batch of gps points and write them to
+        the sink with the land type attribute'''
+        # 0th vertex is the point for both Point and MultiPoint geoms
+        points = [ft.geometry().vertexAt(0) for ft in feats]
+        x, y = transform_coords([pt.x() for pt in points], [pt.y() for pt in points], src_crs, lt_crs, context.transformContext())
+        output_feats = []
+        for ft, land_type in zip(feats, land_types.lookup(x, y)):
+            atts = [ft[fld_name] for fld_name in source_fields]
+            atts.append('NULL' if land_type is None else land_type)
+            feat = QgsFeature(sink_fields)
+            feat.setGeometry(ft.geometry())
+            feat.setAttributes(atts)
+            output_feats.append(feat)
+        sink.addFeatures(output_feats, QgsFeatureSink.FastInsert)
@@ -6,10 +6,14 @@ from qgis.core import (NULL, QgsField, QgsFields, QgsFeature, QgsFeatureSink,
                         QgsProcessingParameterField,
                         QgsProcessingParameterFileDestination,
                         QgsProcessingParameterFeatureSink,
+                        QgsProcessingParameterBoolean,
+                        QgsProcessingParameterDefinition,
                         QgsGeometry, QgsSpatialIndex,
-                        QgsCoordinateTransform, QgsWkbTypes,
+                        QgsWkbTypes,
                         QgsProcessingMultiStepFeedback,
                         QgsVectorLayer)
+from transforms import transformed_geom
+from watered_area_cache import WateredAreaCache
                         
 import processing
 
@@ -24,6 +28,7 @@ class CarryingCapacitySummary(QgsProcessingAlgorithm):
     WATERPOINTS = 'WATERPOINTS'
     WA_3KM_LYR = 'WA_3KM_LYR'
     WA_5KM_LYR = 'WA_5KM_LYR'
+    PARALLEL = 'PARALLEL'
     OUTPUT = 'OUTPUT'
     XL_SUMMARY = 'XL_SUMMARY'
  
@@ -99,6 +104,9 @@ class CarryingCapacitySummary(QgsProcessingAlgorithm):
             self.WA_5KM_LYR,
             "5km watered areas",
             [QgsProcessing.TypeVectorPolygon], optional=True))
+            
+        self.addParameter(QgsProcessingParameterBoolean(self.PARALLEL, 'Buffer paddock waterpoints in parallel processes (uses all CPU cores)', defaultValue=False))
+        self.parameterDefinition(self.PARALLEL).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
                         
         self.addParameter(QgsProcessingParameterFeatureSink(
             self.OUTPUT,
@@ -136,6 +144,8 @@ class CarryingCapacitySummary(QgsProcessingAlgorithm):
         
         wa_3km_lyr = self.parameterAsSource(parameters, self.WA_3KM_LYR, context)
         wa_5km_lyr = self.parameterAsSource(parameters, self.WA_5KM_LYR, context)
+        
+        workers = 0 if self.parameterAsBool(parameters, self.PARALLEL, context) else 1
 
         dest_spreadsheet = parameters[self.XL_SUMMARY]
         
@@ -206,6 +216,21 @@ class CarryingCapacitySummary(QgsProcessingAlgorithm):
         
         feedback.setCurrentStep(step)
         step+=1
+        
+        if not (wa_3km_lyr and wa_5km_lyr):
+            # 3 & 5km watered areas of every paddock are calculated up front,
+            # one paddock at a time or in parallel processes
+            pdk_ids = []
+            wa_items = []
+            for pdk in pdk_lyr.getFeatures():
+                pdk_geom = pdk.geometry().makeValid()
+                pdk_wpts = [ft.geometry() for ft in wpt_lyr.getFeatures() if ft.geometry().intersects(pdk_geom)]
+                pdk_ids.append(pdk.id())
+                wa_items += [(pdk_geom, pdk_wpts, 3000), (pdk_geom, pdk_wpts, 5000)]
+            # watered areas of paddocks (and waterpoints) which have not changed since the last run come from the cache
+            with WateredAreaCache(pdk_lyr.sourceCrs(), feedback=feedback) as wa_cache:
+                watered_areas = wa_cache.watered_areas(wa_items, workers, feedback)
+            pdk_watered_areas = {pdk_id: watered_areas[2*i:2*i+2] for i, pdk_id in enumerate(pdk_ids)}
 
         for pdk in pdk_lyr.getFeatures():
             if feedback.isCanceled():
@@ -227,16 +252,10 @@ class CarryingCapacitySummary(QgsProcessingAlgorithm):
                 pdk_5km_wa = self.transformed_geom(pdk_5km_wa_orig, wa_5km_crs, pdk_lyr.sourceCrs(), context.project()).intersection(pdk_geom)
             else:
                 feedback.pushInfo('Using Buffered Waterpoints')
-                pdk_wpts = [ft for ft in wpt_lyr.getFeatures() if ft.geometry().intersects(pdk_geom)]
                 # We need to construct the watered areas by buffering the waterpoints which are within the current paddock
-                buffers_3km = [ft.geometry().buffer(3000, 25) for ft in pdk_wpts]
-                dissolved_3km_buffers = QgsGeometry.unaryUnion(buffers_3km)
-                pdk_3km_wa = dissolved_3km_buffers.intersection(pdk_geom)
+                pdk_3km_wa, pdk_5km_wa = pdk_watered_areas[pdk.id()]
                 ###########################################################CONVERT GEOMETRY COLLECTION*********************
                 pdk_3km_wa.convertGeometryCollectionToSubclass(QgsWkbTypes.PolygonGeometry)
-                buffers_5km = [ft.geometry().buffer(5000, 25) for ft in pdk_wpts]
-                dissolved_5km_buffers = QgsGeometry.unaryUnion(buffers_5km)
-                pdk_5km_wa = dissolved_5km_buffers.intersection(pdk_geom)
                 ###########################################################CONVERT GEOMETRY COLLECTION*********************
                 pdk_5km_wa.convertGeometryCollectionToSubclass(QgsWkbTypes.PolygonGeometry)
             
@@ -338,11 +357,7 @@ class CarryingCapacitySummary(QgsProcessingAlgorithm):
         return results
     
     def transformed_geom(self, geom, src_crs, dest_crs, project):
-        # Copy geometry
-        g = QgsGeometry().fromWkt(geom.asWkt())
-        xform = QgsCoordinateTransform(src_crs, dest_crs, project)
-        g.transform(xform)
-        return g
+        return transformed_geom(geom, src_crs, dest_crs, project)
         
     def align_input_layers_crs(self, paddock_layer, land_type_layer, waterpoint_layer, transform_context):
         if not waterpoint_layer:
@@ -7,11 +7,14 @@ from qgis.core import (QgsProcessing,
                         QgsProcessingParameterField,
                         QgsProcessingParameterRasterLayer,
                         QgsProcessingParameterMultipleLayers,
+                        QgsProcessingParameterEnum,
                         QgsProcessingParameterFolderDestination,
-                        QgsProcessingFeatureSourceDefinition,
-                        QgsFeatureRequest)
+                        QgsProcessingParameterDefinition)
                         
-import processing
+from zonal_stats import zone_windows, clip_to_zone
+from zone_cache import cached_district_zone_grid
+from virtual_rasters import clip_by_geometries
+from osgeo import gdal
 
 import os
 
@@ -32,6 +35,10 @@ class ClipRastersByPastoralDistrict(QgsProcessingAlgorithm):
     GROWTH_PROBABILITY_OUPUT = 'GROWTH_PROBABILITY_OUPUT'
     PERCENTILE_GROWTH_OUPUT = 'PERCENTILE_GROWTH_OUPUT'
     TSDM_OUPUT = 'TSDM_OUPUT' # Directory
+    # output format
+    OUTPUT_FORMAT = 'OUTPUT_FORMAT'
+    
+    output_formats = ['Raster files (.img)', 'Virtual rasters (.vrt) with district cutlines']
 
     def initAlgorithm(self, config=None):
         # Alg inputs
@@ -48,144 +55,83 @@ class ClipRastersByPastoralDistrict(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterFolderDestination(self.GROWTH_PROBABILITY_OUPUT, 'Output growth probability'))
         self.addParameter(QgsProcessingParameterFolderDestination(self.PERCENTILE_GROWTH_OUPUT, 'Output growth percent'))
         self.addParameter(QgsProcessingParameterFolderDestination(self.TSDM_OUPUT, 'Output TSDM'))
+        self.addParameter(QgsProcessingParameterEnum(self.OUTPUT_FORMAT, 'Output format', self.output_formats, defaultValue=0))
+        self.parameterDefinition(self.OUTPUT_FORMAT).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
 
     def processAlgorithm(self, parameters, context, model_feedback):
         # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
         # overall progress through the model
         mask_vector = self.parameterAsVectorLayer(parameters, self.DISTRICTS, context)
         name_field = self.parameterAsFields(parameters, self.NAME_FIELD, context)[0]
+        growth_prob_layer = self.parameterAsRasterLayer(parameters, self.GROWTH_PROBABILITY_INPUT, context)
         pcnt_growth_layers = self.parameterAsLayerList(parameters, self.PERCENTILE_GROWTH_INPUTS, context)
+        tsdm_layer = self.parameterAsRasterLayer(parameters, self.TSDM_INPUT, context)
+        tsdm_pcnt_layer = self.parameterAsRasterLayer(parameters, self.TSDM_PCNT_INPUT, context)
         
         growth_prob_folder = parameters[self.GROWTH_PROBABILITY_OUPUT]
         pcnt_growth_folder = parameters[self.PERCENTILE_GROWTH_OUPUT]
         tsdm_folder = parameters[self.TSDM_OUPUT]
+        write_vrts = self.parameterAsEnum(parameters, self.OUTPUT_FORMAT, context) == 1
+        
+        # List of (output key prefix, input raster path, output folder, output file name template)
+        # Clip Growth Probability map, Percentile Growth maps and TSDM rasters by district
+        clip_jobs = [('growth_prob', growth_prob_layer.source(), growth_prob_folder, '{district}_GROWTHPROB.img')]
+        for raster_lyr in pcnt_growth_layers:
+            month_part = raster_lyr.source().split('.')[1]
+            clip_jobs.append((f'growth_pcnt_{month_part}', raster_lyr.source(), pcnt_growth_folder, '{district}-'+f'{month_part}.img'))
+        clip_jobs.append(('tsdm', tsdm_layer.source(), tsdm_folder, '{district}_TSDM.img'))
+        clip_jobs.append(('tsdm_pcnt', tsdm_pcnt_layer.source(), tsdm_folder, '{district}_TSDMPCNT.img'))
         
-        raster_count = len(pcnt_growth_layers) + 3
-        district_count = mask_vector.featureCount()
-        steps = district_count*raster_count
+        steps = len(clip_jobs)
         
         feedback = QgsProcessingMultiStepFeedback(steps, model_feedback)
         
         step = 1
         
         results = {}
-        outputs = {}
         
-        for feat in mask_vector.getFeatures():
-            # Clip AussieGRASS rasters by districts
-            mask_vector.selectByIds([feat.id()])
-            district_name = feat[name_field].title()# Format upper case to title case e.g. "BARKLY" -> "Barkly"
-            
-            # Clip Growth Probability map by districts
-            growth_prob_out_path = os.path.join(growth_prob_folder, f'{district_name}_GROWTHPROB.img')
-            growth_prob_params = {
-                    'INPUT': parameters[self.GROWTH_PROBABILITY_INPUT],
-                    'MASK':QgsProcessingFeatureSourceDefinition(mask_vector.source(), selectedFeaturesOnly=True, featureLimit=-1, geometryCheck=QgsFeatureRequest.GeometryAbortOnInvalid),
-                    'SOURCE_CRS':None,
-                    'TARGET_CRS':None,
-                    'NODATA':-999,
-                    'ALPHA_BAND':False,
-                    'CROP_TO_CUTLINE':True,
-                    'KEEP_RESOLUTION':False,
-                    'SET_RESOLUTION':False,
-                    'X_RESOLUTION':None,
-                    'Y_RESOLUTION':None,
-                    'MULTITHREADING':False,
-                    'OPTIONS':'',
-                    'DATA_TYPE':5,
-                    'EXTRA':'',
-                    'OUTPUT':growth_prob_out_path
-                    }
-            feedback.setCurrentStep(step)
-            step+=1
-            outputs[f'growth_prob_{district_name}'] = processing.run("gdal:cliprasterbymasklayer", growth_prob_params, context=context, feedback=feedback, is_child_algorithm=True)
-            results[f'growth_prob_{district_name}'] = outputs[f'growth_prob_{district_name}']['OUTPUT']
-################################################################################
-            # Clip Percentile Growth maps by district
-            for raster_lyr in pcnt_growth_layers:
-                month_part = raster_lyr.source().split('.')[1]
-                pcnt_growth_out_path = os.path.join(pcnt_growth_folder, f'{district_name}-{month_part}.img')
-                # PARAMS HERE FOR CLIPPING EACH MONTH OF PCNT GROWTH
-                pcnt_growth_params = {
-                    'INPUT': raster_lyr,
-                    'MASK':QgsProcessingFeatureSourceDefinition(mask_vector.source(), selectedFeaturesOnly=True, featureLimit=-1, geometryCheck=QgsFeatureRequest.GeometryAbortOnInvalid),
-                    'SOURCE_CRS':None,
-                    'TARGET_CRS':None,
-                    'NODATA':-999,
-                    'ALPHA_BAND':False,
-                    'CROP_TO_CUTLINE':True,
-                    'KEEP_RESOLUTION':False,
-                    'SET_RESOLUTION':False,
-                    'X_RESOLUTION':None,
-                    'Y_RESOLUTION':None,
-                    'MULTITHREADING':False,
-                    'OPTIONS':'',
-                    'DATA_TYPE':5,
-                    'EXTRA':'',
-                    'OUTPUT':pcnt_growth_out_path
-                }
+        if write_vrts:
+            # VRTs reference the input rasters and carry the district outline as a
+            # cutline, so no pixels are copied; the inputs must be kept alongside them
+            district_geometries = {}
+            for f in mask_vector.getFeatures():
+                district_geometries.setdefault(f[name_field], []).append(f.geometry().asWkb())
+            crs_wkt = mask_vector.crs().toWkt()
+            for key_prefix, raster_path, output_folder, file_template in clip_jobs:
                 feedback.setCurrentStep(step)
                 step+=1
-                outputs[f'growth_pcnt_{district_name}'] = processing.run("gdal:cliprasterbymasklayer", pcnt_growth_params, context=context, feedback=feedback, is_child_algorithm=True)
-                results[f'growth_pcnt_{district_name}'] = outputs[f'growth_pcnt_{district_name}']['OUTPUT']
-            
-################################################################################
-            # Clip TSDM rasters by District
-            # First tsdm.int...
-            tsdm_out_path = os.path.join(tsdm_folder, f'{district_name}_TSDM.img')
-            tsdm_params = {
-                    'INPUT': parameters[self.TSDM_INPUT],
-                    'MASK':QgsProcessingFeatureSourceDefinition(mask_vector.source(), selectedFeaturesOnly=True, featureLimit=-1, geometryCheck=QgsFeatureRequest.GeometryAbortOnInvalid),
-                    'SOURCE_CRS':None,
-                    'TARGET_CRS':None,
-                    'NODATA':-999,
-                    'ALPHA_BAND':False,
-                    'CROP_TO_CUTLINE':True,
-                    'KEEP_RESOLUTION':False,
-                    'SET_RESOLUTION':False,
-                    'X_RESOLUTION':None,
-                    'Y_RESOLUTION':None,
-                    'MULTITHREADING':False,
-                    'OPTIONS':'',
-                    'DATA_TYPE':5,
-                    'EXTRA':'',
-                    'OUTPUT':tsdm_out_path
-                    }
-                    
-            feedback.setCurrentStep(step)
-            step+=1
-            outputs[f'tsdm_{district_name}'] = processing.run("gdal:cliprasterbymasklayer", tsdm_params, context=context, feedback=feedback, is_child_algorithm=True)
-            results[f'tsdm_{district_name}'] = outputs[f'tsdm_{district_name}']['OUTPUT']
-            
-            # Now tsdm.pcnt...
-            tsdm_pcnt_out_path = os.path.join(tsdm_folder, f'{district_name}_TSDMPCNT.img')
-
-            tsdm_pcnt_params = {
-                    'INPUT': parameters[self.TSDM_PCNT_INPUT],
-                    'MASK':QgsProcessingFeatureSourceDefinition(mask_vector.source(), selectedFeaturesOnly=True, featureLimit=-1, geometryCheck=QgsFeatureRequest.GeometryAbortOnInvalid),
-                    'SOURCE_CRS':None,
-                    'TARGET_CRS':None,
-                    'NODATA':-999,
-                    'ALPHA_BAND':False,
-                    'CROP_TO_CUTLINE':True,
-                    'KEEP_RESOLUTION':False,
-                    'SET_RESOLUTION':False,
-                    'X_RESOLUTION':None,
-                    'Y_RESOLUTION':None,
-                    'MULTITHREADING':False,
-                    'OPTIONS':'',
-                    'DATA_TYPE':5,
-                    'EXTRA':'',
-                    'OUTPUT':tsdm_pcnt_out_path
-                    }
-            
+                for i, (name, wkb_geometries) in enumerate(district_geometries.items()):
+                    if feedback.isCanceled():
+                        break
+                    district_name = name.title()
+                    out_path = os.path.join(output_folder, os.path.splitext(file_template.format(district=district_name))[0]+'.vrt')
+                    clipped = clip_by_geometries(raster_path, wkb_geometries, crs_wkt, out_path, 'VRT', nodata=-999, data_type=gdal.GDT_Int32)
+                    if clipped is None:
+                        feedback.pushWarning(f'Could not clip {raster_path} to {district_name}')
+                        continue
+                    results[f'{key_prefix}_{district_name}'] = clipped
+                    feedback.setProgress((i+1)/len(district_geometries)*100)
+            return results
+        
+        for key_prefix, raster_path, output_folder, file_template in clip_jobs:
             feedback.setCurrentStep(step)
             step+=1
-            outputs[f'tsdm_pcnt_{district_name}'] = processing.run("gdal:cliprasterbymasklayer", tsdm_pcnt_params, context=context, feedback=feedback, is_child_algorithm=True)
-            results[f'tsdm_pcnt_{district_name}'] = outputs[f'tsdm_pcnt_{district_name}']['OUTPUT']
+            # Input rasters usually share one grid, so the (cached) zone grid is reused
+            zone_ds, district_names = cached_district_zone_grid(mask_vector, name_field, raster_path, context.transformContext(), feedback)
+            windows = zone_windows(zone_ds, len(district_names))
+            for i, name in enumerate(district_names):
+                if feedback.isCanceled():
+                    break
+                district_name = name.title()# Format upper case to title case e.g. "BARKLY" -> "Barkly"
+                if i+1 not in windows:
+                    feedback.pushWarning(f'{district_name} does not overlap {raster_path}')
+                    continue
+                out_path = os.path.join(output_folder, file_template.format(district=district_name))
+                results[f'{key_prefix}_{district_name}'] = clip_to_zone(raster_path, zone_ds, i+1, windows[i+1], out_path, 'HFA', nodata=-999, data_type=gdal.GDT_Int32)
+                feedback.setProgress((i+1)/len(district_names)*100)
+            zone_ds = None
             
         return results
-#        return results
 
     def name(self):
         return 'Clip_rasters_by_pastoral_district'
@@ -195,7 +141,10 @@ class ClipRastersByPastoralDistrict(QgsProcessingAlgorithm):
         
     def shortHelpString(self):
         return "Clips Growth Probability, Growth Percentile, TSDM & TSDM Percentile\
-        rasters from AussieGRASS to pastoral districts for report maps."
+        rasters from AussieGRASS to pastoral districts for report maps.\
+        Under advanced parameters the outputs can be written as lightweight\
+        virtual rasters (.vrt) which reference the input rasters and clip them\
+        with a district cutline, instead of copying pixels to .img files."
         
     def icon(self):
         return QIcon(os.path.join(os.path.dirname(__file__), "../icons/clip_rasters_icon.PNG"))
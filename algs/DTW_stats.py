@@ -14,14 +14,16 @@ from qgis.core import (QgsField, QgsFeature, QgsFeatureRequest,
                         QgsFields,
                         QgsProcessingParameterFileDestination,
                         QgsVectorLayer, QgsMapLayerProxyModel,
-                        QgsFieldProxyModel)
+                        QgsFieldProxyModel, NULL)
                         
 from qgis.gui import (QgsMapLayerComboBox, QgsFieldComboBox)
 
+from collar_tracks import day_groups, fix_times
+from time_index import TimeIndex
 import processing
 
-import statistics
-
+import numpy as np
+
 import os
                        
 class DistanceToWaterStats(QgsProcessingAlgorithm):
@@ -130,54 +132,33 @@ class DistanceToWaterStats(QgsProcessingAlgorithm):
         
         feedback.pushInfo(f'Total GPS features: {total_ft_count}')
         
-        start_date_string = start_datetime.toString('yyyy-MM-ddThh:mm:ss')
-        end_date_string = end_datetime.toString('yyyy-MM-ddThh:mm:ss')
-        
-        exp = f""""{datetime_fld}" >= '{start_date_string}' and "{datetime_fld}" <= '{end_date_string}'"""
-        
-        #feedback.pushInfo(exp)
-        
-        it = gps_collar_lyr.getFeatures(exp)
-        
-        gps_collar_feats = [gps_ft for gps_ft in it]
+        # Features in the datetime range are found in the time index and read once,
+        # in chronological order, one date at a time
+        time_index = TimeIndex.for_layer(gps_collar_lyr, datetime_fld, feedback)
+        request = QgsFeatureRequest().setFilterFids(time_index.range_fids(start_datetime, end_datetime))
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([datetime_fld, dist_to_water_fld], gps_collar_lyr.fields())
         
-        feedback.pushInfo(f'Total GPS features filtered by date: {len(gps_collar_feats)}')
-        
-        all_dates = list(set(ft[datetime_fld].date() for ft in gps_collar_feats))
-        total = len(all_dates)
-        feedback.pushInfo(f'Total dates: {total}')
-        for i, unique_date in enumerate(sorted(all_dates)):
+        filtered_count = 0
+        date_count = 0
+        for unique_date, date_feats_chronological in day_groups(gps_collar_lyr, datetime_fld, feedback, request):
             if feedback.isCanceled():
                 break
-            pcnt = ((i+1)/total)*100
-            feedback.setProgress(round(pcnt, 1))
-            date_feats = [ft for ft in gps_collar_feats if ft[datetime_fld].date() == unique_date]
-            if len(date_feats)<2:
+            filtered_count += len(date_feats_chronological)
+            date_count += 1
+            if len(date_feats_chronological)<2:
                 # There is only one feature for this date (calculating time gaps etc won't work)
                 continue
-            # Sort the features for each day period by time to ensure consecutive feature pairs are constructed in the correct order
-            # Otherwise time delta gaps will not be correct. This should be a redundant safeguard since fid order should also match
-            # chronological order.
-            date_feats_chronological = sorted(date_feats, key=lambda ft: ft[datetime_fld])
             ########################################################################
-            day_time_gaps = []
-            day_distances_to_water = []
-            ids = [f.id() for f in date_feats_chronological]
-            last_id = ids[-1]
-            for j, feat in enumerate(date_feats_chronological):
-                if feat.id() == last_id:
-                    break
-                gap, dtw  = self.gap_and_dtw(feat,
-                                        date_feats_chronological[j+1],
-                                        datetime_fld,
-                                        dist_to_water_fld)
-                day_time_gaps.append(gap)
-                day_distances_to_water.append(dtw)
+            # Time gap between each pair of consecutive features and the
+            # distance to water of the first feature of each pair
+            day_time_gaps = np.diff(fix_times(date_feats_chronological, datetime_fld))
+            day_distances_to_water = np.array([np.nan if ft[dist_to_water_fld] == NULL else ft[dist_to_water_fld] for ft in date_feats_chronological[:-1]], dtype=np.float64)
 
-            max_time_gap = round(max(day_time_gaps)/60, 1)# Divide by 60 to convert from seconds to minutes
-            min_dtw = round(min(day_distances_to_water), 2)
-            max_dtw = round(max(day_distances_to_water), 2)
-            mean_dtw = round(statistics.mean(day_distances_to_water), 2)
+            max_time_gap = round(float(day_time_gaps.max())/60, 1)# Divide by 60 to convert from seconds to minutes
+            min_dtw = round(float(np.nanmin(day_distances_to_water)), 2)
+            max_dtw = round(float(np.nanmax(day_distances_to_water)), 2)
+            mean_dtw = round(float(np.nanmean(day_distances_to_water)), 2)
 
             ########################################################################
             y = unique_date.year()
@@ -193,6 +174,8 @@ class DistanceToWaterStats(QgsProcessingAlgorithm):
                                     max_dtw,
                                     mean_dtw])
             temp_feats.append(day_feat)
+        feedback.pushInfo(f'Total GPS features filtered by date: {filtered_count}')
+        feedback.pushInfo(f'Total dates: {date_count}')
         #############################################################
         temp_lyr.dataProvider().addFeatures(temp_feats)
         ##############################################################
@@ -215,17 +198,6 @@ class DistanceToWaterStats(QgsProcessingAlgorithm):
                 'Overwrite Output Spreadsheet': overwrite_xlsx}
         '''
         
-    def gap_and_dtw(self, ft1, ft2, dt_fld, dtw_fld):
-        '''
-        Returns the distance to water for each feature
-        and the time gap between each pair of consecutive features
-        '''
-        ft1_dt = ft1[dt_fld]
-        ft2_dt = ft2[dt_fld]
-        delta_secs = ft1_dt.secsTo(ft2_dt)# Use method from QDateTime class
-        dtw = ft1[dtw_fld]
-        return delta_secs, dtw
-        
 #####################CUSTOM WIDGET WRAPPER####################
 class CustomInputParameterWidgetWrapper(WidgetWrapper):
     def createWidget(self):
@@ -307,11 +279,12 @@ class CustomInputWidget(QWidget):
         self.set_widget_date_ranges()
         
     def set_widget_date_ranges(self):
-        gps_fts = [ft for ft in self.gps_lyr.getFeatures()]
         dt_fld = self.dt_fld_cb.currentField()
         dt_fld_idx = self.gps_lyr.fields().lookupField(dt_fld)
-        dt_fld_obj = self.gps_lyr.fields()[dt_fld_idx]
-        if not dt_fld or not gps_fts:
+        # Earliest & latest datetimes come from the provider (no need to read every feature)
+        first_dt = self.gps_lyr.minimumValue(dt_fld_idx) if dt_fld_idx != -1 else None
+        last_dt = self.gps_lyr.maximumValue(dt_fld_idx) if dt_fld_idx != -1 else None
+        if not dt_fld or not isinstance(first_dt, QDateTime) or not isinstance(last_dt, QDateTime):
             self.start_dt_edit.setMinimumDateTime(QDateTime.currentDateTime())
             self.start_dt_edit.setMaximumDateTime(QDateTime.currentDateTime())
             self.start_dt_edit.setStyleSheet('color: red')
@@ -321,10 +294,6 @@ class CustomInputWidget(QWidget):
             return
         self.start_dt_edit.setStyleSheet('color: black')
         self.end_dt_edit.setStyleSheet('color: black')
-        first_feat = gps_fts[0]
-        last_feat = gps_fts[-1]
-        first_dt = first_feat[dt_fld]
-        last_dt = last_feat[dt_fld]
 
         start_y = first_dt.date().year()
         start_m = first_dt.date().month()
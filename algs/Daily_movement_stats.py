@@ -1,4 +1,4 @@
-from qgis.PyQt.QtCore import QCoreApplication, QVariant
+from qgis.PyQt.QtCore import QCoreApplication, QVariant, QDate
 
 from qgis.PyQt.QtGui import QIcon
 
@@ -8,14 +8,18 @@ from qgis.core import (QgsField, QgsFeature, QgsFeatureSink, QgsFeatureRequest,
                         QgsProcessingParameterString, QgsWkbTypes,
                         QgsProcessingParameterField, QgsFields,
                         QgsProcessingParameterFeatureSink, QgsGeometry,
-                        QgsProcessingParameterCrs, QgsCoordinateTransform,
+                        QgsProcessingParameterCrs,
                         QgsProcessingParameterFileDestination,
-                        QgsVectorLayer)
+                        QgsProcessingParameterBoolean,
+                        QgsProcessingParameterDefinition,
+                        QgsProcessingMultiStepFeedback,
+                        QgsVectorLayer, QgsLineString, NULL)
                         
+from collar_tracks import collar_fixes, daily_stats, sheet_name
+from transforms import transform_coords
+from parallel import ordered_results
 import processing
 
-import statistics
-
 import os
 
                        
@@ -23,10 +27,13 @@ class DailyMovementStats(QgsProcessingAlgorithm):
     INPUT = 'INPUT'
     PADDOCK_NAME = 'PADDOCK_NAME'
     COLLAR_ID = 'COLLAR_ID'
+    COLLAR_ID_FIELD = 'COLLAR_ID_FIELD'
+    PADDOCK_FIELD = 'PADDOCK_FIELD'
     DATETIME_FIELD = 'DATETIME_FIELD'
     OUTPUT = 'OUTPUT'
     OUTPUT_CRS = 'OUTPUT_CRS'
     OUTPUT_XL = 'OUTPUT_XL'
+    PARALLEL = 'PARALLEL'
  
     def __init__(self):
         super().__init__()
@@ -48,7 +55,9 @@ class DailyMovementStats(QgsProcessingAlgorithm):
  
     def shortHelpString(self):
         return "Calculate daily distance walked statistics and write results to\
-        a line layer and excel spreadsheet"
+        a line layer and excel spreadsheet. To process many collars in one run,\
+        select the field containing the collar ID (and optionally the paddock name)\
+        instead of typing them in. Each collar is written to its own sheet."
  
     def helpUrl(self):
         return "https://qgis.org"
@@ -60,6 +69,11 @@ class DailyMovementStats(QgsProcessingAlgorithm):
         crs = self.parameterAsCrs(parameters, self.OUTPUT_CRS, context)
         if crs.isGeographic():
             return False, 'Please select a projected CRS'
+        if not self.parameterAsFields(parameters, self.COLLAR_ID_FIELD, context):
+            if not self.parameterAsString(parameters, self.COLLAR_ID, context):
+                return False, 'Please enter a collar ID or select a collar ID field'
+            if not self.parameterAsString(parameters, self.PADDOCK_NAME, context) and not self.parameterAsFields(parameters, self.PADDOCK_FIELD, context):
+                return False, 'Please enter a paddock name or select a paddock name field'
         return super().checkParameterValues(parameters, context)
    
     def initAlgorithm(self, config=None):
@@ -70,11 +84,25 @@ class DailyMovementStats(QgsProcessingAlgorithm):
         
         self.addParameter(QgsProcessingParameterString(
             self.PADDOCK_NAME,
-            'Paddock name'))
+            'Paddock name',
+            optional=True))
 
         self.addParameter(QgsProcessingParameterString(
             self.COLLAR_ID,
-            'Collar ID'))
+            'Collar ID',
+            optional=True))
+            
+        self.addParameter(QgsProcessingParameterField(
+            self.COLLAR_ID_FIELD,
+            'Field containing collar ID (batch mode; used instead of Collar ID)',
+            parentLayerParameterName=self.INPUT,
+            optional=True))
+            
+        self.addParameter(QgsProcessingParameterField(
+            self.PADDOCK_FIELD,
+            'Field containing paddock name (batch mode; used instead of Paddock name)',
+            parentLayerParameterName=self.INPUT,
+            optional=True))
     
         self.addParameter(QgsProcessingParameterField(
             self.DATETIME_FIELD,
@@ -96,20 +124,36 @@ class DailyMovementStats(QgsProcessingAlgorithm):
             self.OUTPUT_XL,
             'Output Collar Spreadsheet',
             'Microsoft Excel (*.xlsx);;Open Document Spreadsheet (*.ods)'))
+            
+        self.addParameter(QgsProcessingParameterBoolean(self.PARALLEL, 'Process collars in parallel processes (uses all CPU cores)', defaultValue=False))
+        self.parameterDefinition(self.PARALLEL).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
  
-    def processAlgorithm(self, parameters, context, feedback):
-        results = {}
-        
+    def processAlgorithm(self, parameters, context, model_feedback):
+        results = {}
+        
         source = self.parameterAsSource(parameters, self.INPUT, context)
         
         paddock_name = self.parameterAsString(parameters, self.PADDOCK_NAME, context)
         
-        collar_id = self.parameterAsString(parameters, self.COLLAR_ID, context)
-        
-        datetime_fields = self.parameterAsFields(parameters, self.DATETIME_FIELD, context)
-        if not datetime_fields:
-            return {}
-        datetime_field = datetime_fields[0]
+        collar_id = self.parameterAsString(parameters, self.COLLAR_ID, context)
+        
+        datetime_fields = self.parameterAsFields(parameters, self.DATETIME_FIELD, context)
+        if not datetime_fields:
+            return {}
+        datetime_field = datetime_fields[0]
+        
+        # In batch mode collars (and optionally paddocks) come from fields of the input layer
+        collar_id_fields = self.parameterAsFields(parameters, self.COLLAR_ID_FIELD, context)
+        collar_id_field = collar_id_fields[0] if collar_id_fields else None
+        
+        paddock_fields = self.parameterAsFields(parameters, self.PADDOCK_FIELD, context)
+        paddock_field = paddock_fields[0] if paddock_fields else None
+        
+        workers = 0 if self.parameterAsBool(parameters, self.PARALLEL, context) else 1
+        
+        steps = 2 if workers == 1 else 3
+        feedback = QgsProcessingMultiStepFeedback(steps, model_feedback)
+        step = 1
         
         output_fields = [QgsField('Paddock', QVariant.String),# Paddock
                         QgsField('Collar_No', QVariant.String),# Collar
@@ -131,151 +175,96 @@ class DailyMovementStats(QgsProcessingAlgorithm):
         src_crs = source.sourceCrs()
         
         dest_crs = self.parameterAsCrs(parameters, self.OUTPUT_CRS, context)
-        
-        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
+        
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
                                                sink_fields, QgsWkbTypes.LineString, dest_crs)
         
-        #Create a memory layer simply to use as input layer for exporttospreadsheet alg! WHY???????!!!
-        #Even though dest_id is either an id string or a source string it doesn't work (invalid input value)!!!
-        temp_lyr = QgsVectorLayer(f'LineString?crs={dest_crs.authid()}', f'Daily_Tracks_{paddock_name}_{collar_id}', 'memory')
-        temp_lyr.dataProvider().addAttributes(sink_fields)
-        temp_lyr.updateFields()
-        ###############################################
-                                               
-        all_track_features = []
+        # Fixes are read once, ordered by collar and then datetime, so that tracklines
+        # are constructed in the correct order (otherwise distance will not be correct).
+        # Coordinates of each collar are transformed to the output crs in one batch.
+        feedback.setCurrentStep(step)
+        step+=1
+        projected_collars = ((collar, paddock, *transform_coords(x, y, src_crs, dest_crs, context.transformContext()), t, days)
+                            for collar, paddock, x, y, t, days in collar_fixes(source, datetime_field, collar_id_field, paddock_field, feedback))
+        if workers == 1:
+            collar_stats = ((collar, paddock, x, y, daily_stats(x, y, t, days)) for collar, paddock, x, y, t, days in projected_collars)
+        else:
+            projected_collars = list(projected_collars)
+            feedback.setCurrentStep(step)
+            step+=1
+            collar_stats = ((collar, paddock, x, y, day_stats) for (collar, paddock, x, y, t, days), day_stats in
+                            zip(projected_collars, ordered_results(daily_stats, [(x, y, t, days) for collar, paddock, x, y, t, days in projected_collars], workers, feedback)))
         
-        all_dates = list(set(ft[datetime_field].date() for ft in source.getFeatures()))
-        total = len(all_dates)
-        for i, unique_date in enumerate(sorted(all_dates)):
+        # One memory layer per collar, each of which is written to its own sheet of the spreadsheet
+        track_layers = []
+        # (lower case) sheet names already used by a collar
+        sheet_names = set()
+        
+        for collar, paddock, x_coords, y_coords, day_stats in collar_stats:
             if feedback.isCanceled():
                 break
-            pcnt = ((i+1)/total)*100
-            feedback.setProgress(round(pcnt, 1))
-            date_feats = [ft for ft in source.getFeatures() if ft[datetime_field].date() == unique_date]
-            if len(date_feats)<2:
-                # There is only one feature for this date (calculating time gaps etc won't work)
-                continue
-            # Sort the features for each day period by time to ensure tracklines are constructed in the correct order
-            # Otherwise distance will not be correct. This should be a redundant safeguard since fid order should also match
-            # chronological order.
-            date_feats_chronological = sorted(date_feats, key=lambda ft: ft[datetime_field])
-            
-            try:
-                date_points = [ft.geometry().asMultiPoint()[0] for ft in date_feats_chronological]# Geom is MultiPointXY; PointXY is 0th element
-            except TypeError:
-                date_points = [ft.geometry().asPoint() for ft in date_feats_chronological]
-            
-            line_geom = QgsGeometry.fromPolylineXY(date_points)
-            transformed_line_geom = self.transformed_geom(line_geom, src_crs, dest_crs, context.project())
-            total_distance = round(transformed_line_geom.length()/1000, 3)
-            ########################################################################
-            # Calculate distance and speed between gps pings for each day
-            day_time_gaps = []
-            day_distances = []
-            day_speeds = []
-            ids = [f.id() for f in date_feats_chronological]
-            last_id = ids[-1]
-            for i, feat in enumerate(date_feats_chronological):
-                if feat.id() == last_id:
-                    break
-                gap, dist, speed = self.calculate_distance_and_speed(feat,
-                                                                    date_feats_chronological[i+1],
-                                                                    datetime_field,
-                                                                    src_crs,
-                                                                    dest_crs,
-                                                                    context.project())
-                # Ignore/skip time gaps less than 5 mins.
-                # Sometimes there are time gaps of zero or only a few seconds, with distances of a few km
-                # leading to outlandish max & average daily speeds (in the thousands of km/h)
-                if gap < 300:
-                    continue
-                day_time_gaps.append(gap)
-                day_distances.append(dist)
-                day_speeds.append(speed)
-            if not day_time_gaps:
-                max_time_gap = 0
+            collar_no = collar_id if collar_id_field is None else str(collar)
+            collar_paddock = paddock_name if paddock is None or paddock == NULL else str(paddock)
+            if collar_id_field is None:
+                track_lyr_name = f'Daily_Tracks_{collar_paddock}_{collar_no}'
             else:
-                max_time_gap = round(max(day_time_gaps)/60, 1)# Divide by 60 to convert from seconds to minutes
-            if not day_distances:
-                min_dist = 0
-                max_dist = 0
-                mean_dist = 0
-            else:
-                min_dist = round(min(day_distances), 2)
-                max_dist = round(max(day_distances), 2)
-                mean_dist = round(statistics.mean(day_distances), 2)
-            if not day_speeds:
-                min_speed = 0
-                max_speed = 0
-                mean_speed = 0
-            else:
-                min_speed = round(min(day_speeds), 2)
-                max_speed = round(max(day_speeds), 2)
-                mean_speed = round(statistics.mean(day_speeds), 2)
-            ########################################################################
-            y = unique_date.year()
-            m = unique_date.month()
-            d = unique_date.day()
-            date_att = f'{y}-{m}-{d}'
-            line_feat = QgsFeature(sink_fields)
-            line_feat.setGeometry(transformed_line_geom)
-            line_feat.setAttributes([paddock_name,
-                                    collar_id,
-                                    date_att,
-                                    str(total_distance),
-                                    max_time_gap,
-                                    min_dist,
-                                    max_dist,
-                                    mean_dist,
-                                    min_speed,
-                                    max_speed,
-                                    mean_speed])
-            all_track_features.append(line_feat)
-        #############################################################
-        sink.addFeatures(all_track_features, QgsFeatureSink.FastInsert)
-        #Add the features to the temp layer
-        temp_lyr.dataProvider().addFeatures(all_track_features)
+                # layer names become sheet names, which must be unique and short enough for Excel
+                track_lyr_name = sheet_name(collar_no, collar_paddock, sheet_names)
+            track_lyr = self.track_layer(track_lyr_name, dest_crs, sink_fields)
+            track_features = []
+            for julian_day, start, end, total_distance, max_time_gap, min_dist, max_dist, mean_dist, min_speed, max_speed, mean_speed in day_stats:
+                unique_date = QDate.fromJulianDay(julian_day)
+                y = unique_date.year()
+                m = unique_date.month()
+                d = unique_date.day()
+                date_att = f'{y}-{m}-{d}'
+                line_feat = QgsFeature(sink_fields)
+                line_feat.setGeometry(QgsGeometry(QgsLineString(x_coords[start:end].tolist(), y_coords[start:end].tolist())))
+                line_feat.setAttributes([collar_paddock,
+                                        collar_no,
+                                        date_att,
+                                        str(round(total_distance/1000, 3)),
+                                        round(max_time_gap/60, 1),# Divide by 60 to convert from seconds to minutes
+                                        round(min_dist, 2),
+                                        round(max_dist, 2),
+                                        round(mean_dist, 2),
+                                        round(min_speed, 2),
+                                        round(max_speed, 2),
+                                        round(mean_speed, 2)])
+                track_features.append(line_feat)
+            sink.addFeatures(track_features, QgsFeatureSink.FastInsert)
+            #Add the features to the collar layer
+            track_lyr.dataProvider().addFeatures(track_features)
+            track_layers.append(track_lyr)
+        
+        if not track_layers:
+            track_layers.append(self.track_layer(f'Daily_Tracks_{paddock_name}_{collar_id}', dest_crs, sink_fields))
         ##############################################################
         if context.willLoadLayerOnCompletion(dest_id):
             details = context.layerToLoadOnCompletionDetails(dest_id)
-            # If memory layer output with generic name, we will rename it
+            # If memory layer output with generic name (and a single collar), we will rename it
             #feedback.pushInfo(details.name)
-            if details.name == 'Daily Tracks':
-                details.name = f'Daily_Tracks_{paddock_name}_{collar_id}'
+            if details.name == 'Daily Tracks' and collar_id_field is None:
+                details.name = f'Daily_Tracks_{paddock_name}_{collar_id}'
         results[self.OUTPUT] = dest_id
         #feedback.pushInfo(str(dest_id))
-        save_to_xl_params = {'LAYERS':[temp_lyr],
+        feedback.setCurrentStep(step)
+        step+=1
+        save_to_xl_params = {'LAYERS':track_layers,
                             'USE_ALIAS':False,
                             'FORMATTED_VALUES':False,
                             'OUTPUT':parameters[self.OUTPUT_XL],
                             'OVERWRITE':False}
         
-        result = processing.run("native:exporttospreadsheet", save_to_xl_params, context=context, feedback=feedback, is_child_algorithm=True)        
-        results[self.OUTPUT_XL] = result['OUTPUT']# Path to output spreadsheet
+        result = processing.run("native:exporttospreadsheet", save_to_xl_params, context=context, feedback=feedback, is_child_algorithm=True)        
+        results[self.OUTPUT_XL] = result['OUTPUT']# Path to output spreadsheet
         
-        return results
+        return results
     
-    def transformed_geom(self, g, in_crs, out_crs, project):
-        geom = QgsGeometry.fromWkt(g.asWkt())
-        xform = QgsCoordinateTransform(in_crs, out_crs, project)
-        geom.transform(xform)
-        return geom
-        
-    def calculate_distance_and_speed(self, ft1, ft2, dt_fld, in_crs, out_crs, project):
-        '''
-        Returns the distance and (approx) speed between 2 consecutive features
-        '''
-        geom1 = QgsGeometry.fromWkt(ft1.geometry().asWkt())
-        geom2 = QgsGeometry.fromWkt(ft2.geometry().asWkt())
-        geom1_utm = self.transformed_geom(geom1, in_crs, out_crs, project)
-        geom2_utm = self.transformed_geom(geom2, in_crs, out_crs, project)
-        dist = geom1_utm.distance(geom2_utm)# Meters
-        ft1_dt = ft1[dt_fld]
-        ft2_dt = ft2[dt_fld]
-        delta_secs = ft1_dt.secsTo(ft2_dt)# Use method from QDateTime class
-        # Avoid division by zero error
-        if delta_secs <= 0:
-            return 0, -1, -1
-        speed_meters_per_second = dist/delta_secs
-        speed_kmh = speed_meters_per_second*3.6
-        return delta_secs, dist, speed_kmh
\ No newline at end of file
+    def track_layer(self, name, crs, fields):
+        #Create a memory layer simply to use as input layer for exporttospreadsheet alg! WHY???????!!!
+        #Even though dest_id is either an id string or a source string it doesn't work (invalid input value)!!!
+        lyr = QgsVectorLayer(f'LineString?crs={crs.authid()}', name, 'memory')
+        lyr.dataProvider().addAttributes(fields)
+        lyr.updateFields()
+        return lyr
@@ -6,12 +6,14 @@ from qgis.core import (NULL,
                         QgsFeature,
                         QgsFeatureSink,
                         QgsFeatureRequest,
-                        QgsGeometry,
                         QgsProcessing,
                         QgsProcessingAlgorithm,
                         QgsProcessingParameterFeatureSource,
                         QgsProcessingParameterField,
                         QgsProcessingParameterNumber,
+                        QgsProcessingParameterEnum,
+                        QgsProcessingParameterBoolean,
+                        QgsProcessingParameterDefinition,
                         QgsProcessingParameterFeatureSink,
                         QgsCoordinateReferenceSystem,
                         QgsStyle,
@@ -22,6 +24,9 @@ from qgis.core import (NULL,
                         QgsRendererCategory,
                         QgsCategorizedSymbolRenderer)
                         
+from band_rings import paddock_bands, paddock_bands_job, geometry_from_wkb
+from parallel import ordered_results
+from waterpoint_index import WaterpointIndex
 import os
                        
 class DistanceToWaterBands(QgsProcessingAlgorithm):
@@ -29,6 +34,10 @@ class DistanceToWaterBands(QgsProcessingAlgorithm):
     PDK_NAME_FLD = 'PDK_NAME_FLD'
     WATERPOINTS = 'WATERPOINTS'
     BAND_WIDTH = 'BAND_WIDTH'
+    METHOD = 'METHOD'
+    CELL_SIZE = 'CELL_SIZE'
+    POLYGONIZE = 'POLYGONIZE'
+    PARALLEL = 'PARALLEL'
     OUTPUT = 'OUTPUT'
  
     def __init__(self):
@@ -52,7 +61,11 @@ class DistanceToWaterBands(QgsProcessingAlgorithm):
     def shortHelpString(self):
         return "Create dissolved buffer rings of a specified width\
                 around all points in an input waterpoint layer\
-                within each paddock polygon of an input paddock layer."
+                within each paddock polygon of an input paddock layer.\
+                The raster band method (advanced) classifies a distance\
+                transform of a grid over each paddock instead, which is much\
+                faster for many waterpoints or narrow bands; band areas and\
+                percentages are then calculated from grid cell counts."
  
     def helpUrl(self):
         return "https://qgis.org"
@@ -82,6 +95,30 @@ class DistanceToWaterBands(QgsProcessingAlgorithm):
             "Band width (meters)",
             defaultValue=500))
             
+        self.addParameter(QgsProcessingParameterEnum(
+            self.METHOD,
+            'Band method',
+            ['Vector (buffer rings)', 'Raster (distance transform, fast, approximate to the cell size)'],
+            defaultValue=0))
+        self.parameterDefinition(self.METHOD).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
+            
+        self.addParameter(QgsProcessingParameterNumber(
+            self.CELL_SIZE,
+            'Raster cell size (meters)',
+            QgsProcessingParameterNumber.Double,
+            defaultValue=25,
+            minValue=0.000001))
+        self.parameterDefinition(self.CELL_SIZE).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
+            
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.POLYGONIZE,
+            'Polygonize raster bands (otherwise bands have no geometry)',
+            defaultValue=True))
+        self.parameterDefinition(self.POLYGONIZE).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
+            
+        self.addParameter(QgsProcessingParameterBoolean(self.PARALLEL, 'Process paddocks in parallel processes (uses all CPU cores)', defaultValue=False))
+        self.parameterDefinition(self.PARALLEL).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
+            
         self.addParameter(QgsProcessingParameterFeatureSink(
             self.OUTPUT,
             "Watered_bands",
@@ -98,6 +135,14 @@ class DistanceToWaterBands(QgsProcessingAlgorithm):
         
         band_width = self.parameterAsInt(parameters, self.BAND_WIDTH, context)
         
+        use_raster = self.parameterAsEnum(parameters, self.METHOD, context) == 1
+        
+        cell_size = self.parameterAsDouble(parameters, self.CELL_SIZE, context)
+        
+        polygonize = self.parameterAsBool(parameters, self.POLYGONIZE, context)
+        
+        workers = 0 if self.parameterAsBool(parameters, self.PARALLEL, context) else 1
+        
         if (not pdk_lyr.sourceCrs().isGeographic()) and (wpt_lyr.sourceCrs() != pdk_lyr.sourceCrs()):
             wpt_lyr = wpt_lyr.materialize(QgsFeatureRequest().setDestinationCrs(pdk_lyr.sourceCrs(), context.transformContext()))
         if (not wpt_lyr.sourceCrs().isGeographic()) and (wpt_lyr.sourceCrs() != pdk_lyr.sourceCrs()):
@@ -128,6 +173,12 @@ class DistanceToWaterBands(QgsProcessingAlgorithm):
         unnamed_pdk_count = 0
         
         feats = []
+        
+        # spatial index so that each paddock only tests nearby waterpoints
+        waterpoint_index = WaterpointIndex(wp.geometry() for wp in wpt_lyr.getFeatures())
+
+        # paddocks with waterpoints: (name, area, waterpoint geometries, paddock geometry)
+        paddocks = []
 
         for pdk in pdk_lyr.getFeatures():
             pdk_name = pdk[name_fld]
@@ -136,51 +187,41 @@ class DistanceToWaterBands(QgsProcessingAlgorithm):
                 unnamed_pdk_count+=1
             pdk_area = round(pdk.geometry().area()/10000, 2)# Hectares
             # get all waterpoints which fall inside the current paddock
-            waterpoint_geoms = [wp.geometry() for wp in wpt_lyr.getFeatures() if wp.geometry().within(pdk.geometry())]
+            waterpoint_geoms = waterpoint_index.paddock_waterpoints(pdk.geometry(), within=True)
             if waterpoint_geoms:
-                buffer_distance = band_width
-                band_count = 0
-                band_intersects = True
-                # dissolved buffer of all paddock waterpoints
-                # this will be the first 'band' (just a buffer around waterpoint)
-                first_buffer = QgsGeometry.unaryUnion([geom.buffer(buffer_distance, 25) for geom in waterpoint_geoms])
-                # print(f'Band count: {band_count}')
-                if band_count == 0:
-                    clipped_to_pdk = first_buffer.intersection(pdk.geometry())
-                    area_ha = round(clipped_to_pdk.area()/10000, 2)
-                    pcnt = round((clipped_to_pdk.area()/pdk.geometry().area())*100, 7)
-                    feat = QgsFeature(flds)
-                    feat.setGeometry(clipped_to_pdk)
-                    feat.setAttributes([pdk_name, pdk_area, f'0-{buffer_distance}m', buffer_distance, area_ha, pcnt])
-                    feats.append(feat)
-                    buffer_distance+=band_width
-                    band_count+=1
-                # these will be 'band buffers' composed of difference between current & previous buffer
-                # break the loop if the last buffer does not intersect the paddock
-                while band_intersects and band_count < 500:
-                    # print(f'Band count: {band_count}')
-                    outer_ring = QgsGeometry.unaryUnion([geom.buffer(buffer_distance, 25) for geom in waterpoint_geoms])
-                    inner_ring = QgsGeometry.unaryUnion([geom.buffer(buffer_distance-band_width, 25) for geom in waterpoint_geoms])
-                    dtw_band = outer_ring.difference(inner_ring)
-                    if dtw_band.intersects(pdk.geometry()):
-                        clipped_to_pdk = dtw_band.intersection(pdk.geometry())
-                        area_ha = round(clipped_to_pdk.area()/10000, 2)
-                        pcnt = round((clipped_to_pdk.area()/pdk.geometry().area())*100, 7)
-                        feat = QgsFeature(flds)
-                        feat.setGeometry(clipped_to_pdk)
-                        feat.setAttributes([pdk_name,
-                                            pdk_area,
-                                            f'{buffer_distance-band_width}-{buffer_distance}m',
-                                            buffer_distance,
-                                            area_ha,
-                                            pcnt])
-                        feats.append(feat)
-                        buffer_distance+=band_width
-                        band_count+=1
-                    else:
-                        band_intersects = False
-                pdk_max_dist_to_water = band_count*band_width
-                pdk_max_dtws[pdk_name] = pdk_max_dist_to_water
+                paddocks.append((pdk_name, pdk_area, waterpoint_geoms, pdk.geometry()))
+        
+        # raster bands are classified from a distance transform of each paddock grid,
+        # vector bands are dissolved buffer rings around all paddock waterpoints, clipped to the paddock
+        # (the first 'band' is just a buffer around the waterpoints)
+        band_args = (band_width, cell_size, pdk_lyr.sourceCrs().toWkt(), polygonize) if use_raster else (band_width,)
+        if workers == 1:
+            paddock_results = (paddock_bands(waterpoint_geoms, pdk_geom, *band_args) for pdk_name, pdk_area, waterpoint_geoms, pdk_geom in paddocks)
+        else:
+            # paddocks are processed in parallel processes, with geometries passed as WKB
+            jobs = [([bytes(geom.asWkb()) for geom in waterpoint_geoms], bytes(pdk_geom.asWkb()), *band_args)
+                    for pdk_name, pdk_area, waterpoint_geoms, pdk_geom in paddocks]
+            paddock_results = ordered_results(paddock_bands_job, jobs, workers, feedback)
+        
+        for (pdk_name, pdk_area, waterpoint_geoms, pdk_geom), bands in zip(paddocks, paddock_results):
+            for inner_distance, outer_distance, band_geom, band_area, band_pcnt in bands:
+                area_ha = round(band_area/10000, 2)
+                pcnt = round(band_pcnt, 7)
+                feat = QgsFeature(flds)
+                if band_geom is not None:
+                    feat.setGeometry(band_geom if workers == 1 else geometry_from_wkb(band_geom))
+                feat.setAttributes([pdk_name,
+                                    pdk_area,
+                                    f'{inner_distance}-{outer_distance}m',
+                                    outer_distance,
+                                    area_ha,
+                                    pcnt])
+                feats.append(feat)
+            pdk_max_dist_to_water = bands[-1][1] if bands else band_width
+            pdk_max_dtws[pdk_name] = pdk_max_dist_to_water
+        
+        if feedback.isCanceled():
+            return {}
         
         for ft in feats:
             max_dtw = pdk_max_dtws[ft['Pdk Name']]
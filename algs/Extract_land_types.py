@@ -31,7 +31,6 @@ from qgis.core import (NULL,
                         QgsSpatialIndex,
                         QgsGeometry,
                         QgsProcessingException,
-                        QgsCoordinateTransform,
                         QgsCoordinateReferenceSystem,
                         QgsDistanceArea,
                         QgsUnitTypes,
@@ -39,6 +38,9 @@ from qgis.core import (NULL,
 
 from pathlib import Path
 
+from transforms import transformed_geom
+from watered_area_cache import WateredAreaCache
+
 import processing
 
 import os
@@ -53,6 +55,7 @@ class ExtractLandTypes(QgsProcessingAlgorithm):
     DISSOLVE_PADDOCKS = 'DISSOLVE_PADDOCKS'# Boolean
     WATERED_AREAS = 'WATERED_AREAS'# Enum
     AREA_METHOD = 'AREA_METHOD'# Enum
+    PARALLEL = 'PARALLEL'# Boolean
     OUTPUT_FOLDER = 'OUTPUT_FOLDER'# destination folder
     LOAD_OUTPUTS = 'LOAD_OUTPUTS'# Boolean
     OUTPUT_LAYERS = 'OUTPUT_LAYERS'
@@ -170,6 +173,9 @@ class ExtractLandTypes(QgsProcessingAlgorithm):
             'widget_wrapper': {
                 'useCheckBoxes': True,
                 'columns': 2}})
+            
+        self.addParameter(QgsProcessingParameterBoolean(self.PARALLEL, 'Buffer paddock waterpoints in parallel processes (uses all CPU cores)', defaultValue=False))
+        self.parameterDefinition(self.PARALLEL).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
         
         self.addParameter(QgsProcessingParameterFolderDestination(
             self.OUTPUT_FOLDER,
@@ -216,6 +222,7 @@ class ExtractLandTypes(QgsProcessingAlgorithm):
         dissolve_paddocks = self.parameterAsBool(parameters, self.DISSOLVE_PADDOCKS, context)
         watered_areas = self.parameterAsEnums(parameters, self.WATERED_AREAS, context)
         area_method = self.parameterAsEnum(parameters, self.AREA_METHOD, context)
+        workers = 0 if self.parameterAsBool(parameters, self.PARALLEL, context) else 1
         output_folder = self.parameterAsString(parameters, self.OUTPUT_FOLDER, context)
         load_outputs = self.parameterAsBool(parameters, self.LOAD_OUTPUTS, context)
         output_format = self.parameterAsEnum(parameters, self.OUTPUT_FORMAT, context)
@@ -445,12 +452,8 @@ class ExtractLandTypes(QgsProcessingAlgorithm):
                 
                 all_3km_wa_geoms = []
                 
-                for pdk_ft in source_paddocks.getFeatures():
-                    pdk_geom = self.transformedGeom(pdk_ft.geometry(), src_crs, dest_crs, context.transformContext())
-                    pdk_wpts = [ft for ft in waterpoints_projected.getFeatures() if ft.geometry().intersects(pdk_geom)]
-                    pdk_wpts_buffered = [ft.geometry().buffer(3000, 25) for ft in pdk_wpts]
-                    buffered_wpts_dissolved = QgsGeometry.unaryUnion(pdk_wpts_buffered)
-                    pdk_3km_wa_geom = buffered_wpts_dissolved.intersection(pdk_geom)
+                for pdk_ft, pdk_geom, pdk_3km_wa_geom in self.paddockWateredAreas(source_paddocks, waterpoints_projected, 3000,
+                                                                                    workers, src_crs, dest_crs, context, feedback):
                     # Add watered area geometry to list (these will be dissolved & intersected with land types)
                     all_3km_wa_geoms.append(pdk_3km_wa_geom)
                     for lt_ft in lltpd_temp_result.getFeatures():
@@ -566,12 +569,8 @@ class ExtractLandTypes(QgsProcessingAlgorithm):
                 
                 all_5km_wa_geoms = []
                 
-                for pdk_ft in source_paddocks.getFeatures():
-                    pdk_geom = self.transformedGeom(pdk_ft.geometry(), src_crs, dest_crs, context.transformContext())
-                    pdk_wpts = [ft for ft in waterpoints_projected.getFeatures() if ft.geometry().intersects(pdk_geom)]
-                    pdk_wpts_buffered = [ft.geometry().buffer(5000, 25) for ft in pdk_wpts]
-                    buffered_wpts_dissolved = QgsGeometry.unaryUnion(pdk_wpts_buffered)
-                    pdk_5km_wa_geom = buffered_wpts_dissolved.intersection(pdk_geom)
+                for pdk_ft, pdk_geom, pdk_5km_wa_geom in self.paddockWateredAreas(source_paddocks, waterpoints_projected, 5000,
+                                                                                    workers, src_crs, dest_crs, context, feedback):
                     # Add watered area geometry to list (these will be dissolved & intersected with land types)
                     all_5km_wa_geoms.append(pdk_5km_wa_geom)
                     for lt_ft in lltpd_temp_result.getFeatures():
@@ -704,12 +703,21 @@ class ExtractLandTypes(QgsProcessingAlgorithm):
         return {}
         
     def transformedGeom(self, g, orig_crs, target_crs, transform_context):
-        geom_copy = QgsGeometry().fromWkt(g.asWkt())
-        if orig_crs != target_crs:
-            xform = QgsCoordinateTransform(orig_crs, target_crs, transform_context)
-            geom_copy.transform(xform)
-        return geom_copy
-        
+        return transformed_geom(g, orig_crs, target_crs, transform_context)
+        
+    def paddockWateredAreas(self, paddocks, waterpoints, distance, workers, orig_crs, target_crs, context, feedback):
+        '''Returns a list of (paddock feature, transformed paddock geometry, watered area geometry)
+        for each paddock. Watered areas of paddocks (and waterpoints) which have not changed since
+        the last run come from the cache, the others are calculated one paddock at a time, or in
+        parallel processes if workers is not 1.'''
+        pdk_fts = list(paddocks.getFeatures())
+        pdk_geoms = [self.transformedGeom(pdk_ft.geometry(), orig_crs, target_crs, context.transformContext()) for pdk_ft in pdk_fts]
+        wa_items = [(pdk_geom, [ft.geometry() for ft in waterpoints.getFeatures() if ft.geometry().intersects(pdk_geom)], distance)
+                    for pdk_geom in pdk_geoms]
+        with WateredAreaCache(target_crs, feedback=feedback) as wa_cache:
+            wa_geoms = wa_cache.watered_areas(wa_items, workers, feedback)
+        return list(zip(pdk_fts, pdk_geoms, wa_geoms))
+    
     def returnLandTypeAttributesForGeometry(self, land_type_geom, pdk_geom, ellipsoidal_crs, calc_method, context=None):
         if calc_method == 1:# Planar
             plt_area_m2 = round(land_type_geom.area(), 3)
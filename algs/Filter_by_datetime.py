@@ -16,6 +16,7 @@ from qgis.gui import (QgsMapLayerComboBox, QgsFieldComboBox)
 
 from qgis.utils import iface
 
+from time_index import TimeIndex
 import os
 
                        
@@ -173,11 +174,10 @@ class CustomInputWidget(QWidget):
         self.set_widget_date_ranges()
         
     def set_widget_date_ranges(self):
-        gps_fts = [ft for ft in self.gps_lyr.getFeatures()]
         dt_fld = self.dt_fld_cb.currentField()
-        dt_fld_idx = self.gps_lyr.fields().lookupField(dt_fld)
-        dt_fld_obj = self.gps_lyr.fields()[dt_fld_idx]
-        if not dt_fld or not gps_fts:
+        # Earliest & latest datetimes come from the time index (only built when the layer changes)
+        time_index = TimeIndex.for_layer(self.gps_lyr, dt_fld) if dt_fld else None
+        if not dt_fld or not time_index:
             self.start_dt_edit.setMinimumDateTime(QDateTime.currentDateTime())
             self.start_dt_edit.setMaximumDateTime(QDateTime.currentDateTime())
             self.start_dt_edit.setStyleSheet('color: red')
@@ -187,10 +187,8 @@ class CustomInputWidget(QWidget):
             return
         self.start_dt_edit.setStyleSheet('color: black')
         self.end_dt_edit.setStyleSheet('color: black')
-        first_feat = gps_fts[0]
-        last_feat = gps_fts[-1]
-        first_dt = first_feat[dt_fld]
-        last_dt = last_feat[dt_fld]
+        first_dt = time_index.minimum()
+        last_dt = time_index.maximum()
 
         start_y = first_dt.date().year()
         start_m = first_dt.date().month()
@@ -5,18 +5,27 @@ from qgis.core import (QgsVectorLayer, QgsField, QgsFeature,
                         QgsProcessingParameterRasterLayer,
                         QgsProcessingParameterVectorLayer,
                         QgsProcessingParameterFileDestination,
+                        QgsProcessingParameterBoolean,
+                        QgsProcessingParameterDefinition,
                         QgsProcessingMultiStepFeedback)
 
-from osgeo import gdalnumeric
-import processing
+from zonal_stats import zonal_class_counts
+from zone_cache import cached_district_zone_grid
+from class_bins import ClassBins
+import processing
 import os
 
+# Fire risk: low (0, 20], moderate (20, 30], high (30, 40]
+# Pixel values are -2 to 253 (-2 water; 0 nodata; 253 firescars)
+FIRE_RISK_BINS = ClassBins([0, 20, 30, 40], special_values=[253, -2])
+
                        
 class FireRiskSummary(QgsProcessingAlgorithm):
     FIRE_RISK = 'FIRE_RISK'
     DISTRICTS = 'DISTRICTS'
     
     XL_SUMMARY = 'XL_SUMMARY'
+    PARALLEL = 'PARALLEL'
  
     def __init__(self):
         super().__init__()
@@ -51,6 +60,9 @@ class FireRiskSummary(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterRasterLayer(self.FIRE_RISK, 'AussieGRASS Fire Risk raster'))
         self.addParameter(QgsProcessingParameterVectorLayer(self.DISTRICTS, 'Pastoral Districts layer', [QgsProcessing.TypeVectorPolygon]))
             
+        self.addParameter(QgsProcessingParameterBoolean(self.PARALLEL, 'Count pixels in parallel processes (uses all CPU cores)', defaultValue=False))
+        self.parameterDefinition(self.PARALLEL).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
+        
         self.addParameter(QgsProcessingParameterFileDestination(self.XL_SUMMARY, 'Fire Risk summary spreadsheet', 'Microsoft Excel (*.xlsx);;Open Document Spreadsheet (*.ods)'))
  
     def processAlgorithm(self, parameters, context, model_feedback):
@@ -63,26 +75,14 @@ class FireRiskSummary(QgsProcessingAlgorithm):
 #        districts = QgsVectorLayer(d)
         
         dest_spreadsheet = parameters[self.XL_SUMMARY]
+        workers = 0 if self.parameterAsBool(parameters, self.PARALLEL, context) else 1
         
-        steps = 12
+        steps = 3
         feedback = QgsProcessingMultiStepFeedback(steps, model_feedback)
         step = 1
         
-        ###Create temporary copy of district layer#########################
-        temp_districts = QgsVectorLayer(f'polygon?&crs={districts.crs().authid()}', 'Temp_Districts', 'memory')
-        temp_districts.dataProvider().addAttributes(districts.fields())
-        temp_districts.updateFields()
-        for f in districts.getFeatures():
-            feat = QgsFeature()
-            feat.setGeometry(f.geometry())
-            feat.setAttributes(f.attributes())
-            temp_districts.dataProvider().addFeatures([feat])
-        ####################################################################
-        
         temp_layers = []
         
-        district_names = [f['DISTRICT'] for f in temp_districts.getFeatures()]
-        
         fire_risk_temp = QgsVectorLayer('Point', 'Fire Risk Summary', 'memory')
         fire_risk_temp.dataProvider().addAttributes([
             QgsField('District', QVariant.String),
@@ -96,34 +96,22 @@ class FireRiskSummary(QgsProcessingAlgorithm):
         ])
         fire_risk_temp.updateFields()
         
-        for district_name in district_names:
-            
-            temp_districts.setSubsetString(f""""DISTRICT" LIKE '{district_name}'""")
-            
-            mask_params = {'INPUT':fire_risk,
-                'MASK':temp_districts,
-                'SOURCE_CRS':None,
-                'TARGET_CRS':None,
-                'NODATA':None,
-                'ALPHA_BAND':False,
-                'CROP_TO_CUTLINE':True,
-                'KEEP_RESOLUTION':False,
-                'SET_RESOLUTION':False,
-                'X_RESOLUTION':None,
-                'Y_RESOLUTION':None,
-                'MULTITHREADING':False,
-                'OPTIONS':'',
-                'DATA_TYPE':0,
-                'EXTRA':'',
-                'OUTPUT':'TEMPORARY_OUTPUT'}
-                        
-            feedback.setCurrentStep(step)
-            step+=1
-            outputs[f'clipped_to_{district_name}'] = processing.run("gdal:cliprasterbymasklayer", mask_params, context=context, feedback=feedback, is_child_algorithm=True)
-            results[f'clipped_to_{district_name}'] = outputs[f'clipped_to_{district_name}']['OUTPUT']
-            
-            raster1 = gdalnumeric.LoadFile(results[f'clipped_to_{district_name}'])
-            counts = self.fire_risk_counts(raster1)
+        ###Get (cached) zone grid of districts aligned to the fire risk raster###
+        feedback.setCurrentStep(step)
+        step+=1
+        zone_ds, district_names = cached_district_zone_grid(districts, 'DISTRICT', fire_risk.source(), context.transformContext(), feedback)
+        
+        ###Count fire risk classes for every district in one read###############
+        feedback.setCurrentStep(step)
+        step+=1
+        zone_counts = zonal_class_counts(fire_risk.source(), zone_ds, len(district_names), {'Fire risk': FIRE_RISK_BINS}, feedback, workers)
+        zone_ds = None
+        if feedback.isCanceled():
+            # counts stop at the cancelled block, so they are incomplete
+            return {}
+        
+        for i, district_name in enumerate(district_names):
+            counts = self.fire_risk_counts(zone_counts['Fire risk'][i][:FIRE_RISK_BINS.bin_count])
             feat = QgsFeature()
             feat.setAttributes([
                 district_name,
@@ -153,16 +141,8 @@ class FireRiskSummary(QgsProcessingAlgorithm):
         return results
         
         
-    def fire_risk_counts(self, raster):
-        low_count = ((raster > 0)&(raster <= 20)).sum()
-        moderate_count = ((raster > 20)&(raster <= 30)).sum()
-        high_count = ((raster > 30)&(raster <= 40)).sum()
-        firescar_count = (raster == 253).sum()
-        #water_count = (raster == 254).sum()
-        # Aussie products have changed
-        # Pixel values are now -2 to 253 (-2 water; 0 nodata; 253 firescars)
-        water_count = (raster == -2).sum()
-        no_data_count = (raster == 0).sum()
+    def fire_risk_counts(self, class_counts):
+        low_count, moderate_count, high_count = class_counts
         
         total_risk_classes = sum([low_count, moderate_count, high_count])
         
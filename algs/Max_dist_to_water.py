@@ -24,7 +24,8 @@ from qgis.core import (QgsFeatureRequest,
                         QgsMapLayerType,
                         NULL)
 
-from osgeo import gdal
+from virtual_rasters import memory_raster, clip_by_geometries
+from osgeo import gdal, ogr
 from pathlib import Path
 import os
 import re
@@ -201,7 +202,7 @@ class MaxDistToWater(QgsProcessingAlgorithm):
         analyzed_paddocks = [ft for ft in prepared_paddocks.getFeatures() if [f for f in prepared_waterpoints.getFeatures() if f.geometry().intersects(ft.geometry())]]
 #        model_feedback.pushInfo(repr(analyzed_paddocks))
         ########################################################################
-        steps = (len(analyzed_paddocks)*3)+1
+        steps = len(analyzed_paddocks)+1
         feedback = QgsProcessingMultiStepFeedback(steps, model_feedback)
         step = 1
         
@@ -237,88 +238,48 @@ class MaxDistToWater(QgsProcessingAlgorithm):
             paddock_info.append(paddock.geometry().area()/10000)# area in hectares
             paddock_info.append(len(waterpoint_feats))
             model_feedback.pushInfo(repr(crs))
-            # Create a temporary layer to hold waterpoint features which fall within each paddock
-            tmp_lyr = QgsVectorLayer(f'Point?crs={crs.authid()}', '', 'memory')
-            tmp_lyr.dataProvider().addFeatures(waterpoint_feats)
-            
+            feedback.setCurrentStep(step)
+            step+=1
             ############################################################################
-            # Rasterise temporary waterpoint layer to create a binary raster where pixel value
-            # is 1 at water locations and 0 everywhere else
+            # Rasterise waterpoints which fall within each paddock to an in-memory binary
+            # raster where pixel value is 1 at water locations and 0 everywhere else
+            # (equivalent to gdal:rasterize with georeferenced WIDTH/HEIGHT units)
             raster_extent = paddock.geometry().boundingBox()
             xmin = raster_extent.xMinimum()
             xmax = raster_extent.xMaximum()
             ymin = raster_extent.yMinimum()
             ymax = raster_extent.yMaximum()
             
-            extent_string = f'{xmin},{xmax},{ymin},{ymax} [{tmp_lyr.crs().authid()}]'
-            #extent_string = '670539.640100000,674839.662800000,8101017.562800000,8103145.602500000 [EPSG:28352]'
+            x_size = max(1, int((xmax-xmin)/output_resolution+0.5))
+            y_size = max(1, int((ymax-ymin)/output_resolution+0.5))
+            geotransform = (xmin, output_resolution, 0, ymax, 0, -output_resolution)
             
-            rasterize_params = {'INPUT':tmp_lyr,
-                                'FIELD':'',
-                                'BURN':1,
-                                'USE_Z':False,
-                                'UNITS':1,
-                                'WIDTH':output_resolution,
-                                'HEIGHT':output_resolution,
-                                'EXTENT':extent_string,
-                                'NODATA':-1,
-                                'OPTIONS':'',
-                                'DATA_TYPE':0,
-                                'INIT':0,
-                                'INVERT':False,
-                                'EXTRA':'',
-                                'OUTPUT':'TEMPORARY_OUTPUT'}
+            ogr_ds = ogr.GetDriverByName('Memory').CreateDataSource('waterpoints')
+            ogr_lyr = ogr_ds.CreateLayer('waterpoints', geom_type=ogr.wkbPoint)
+            for f in waterpoint_feats:
+                ogr_feat = ogr.Feature(ogr_lyr.GetLayerDefn())
+                ogr_feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(f.geometry().asWkb())))
+                ogr_lyr.CreateFeature(ogr_feat)
             
-            feedback.setCurrentStep(step)
-            step+=1
-            outputs[f'rasterized_{paddock_name}'] = processing.run("gdal:rasterize", rasterize_params, context=context, feedback=feedback, is_child_algorithm=True)
-            results[f'rasterized_{paddock_name}'] = outputs[f'rasterized_{paddock_name}']['OUTPUT']
+            water_ds = memory_raster(x_size, y_size, geotransform, crs.toWkt(), data_type=gdal.GDT_Byte, init=0)
+            gdal.RasterizeLayer(water_ds, [1], ogr_lyr, burn_values=[1])
+            feedback.setProgress(25)
             #####################################################################################
-            # Calculate Proximity Raster for each waterpoint binary raster...
-            proximity_params = {'INPUT':results[f'rasterized_{paddock_name}'],
-                                'BAND':1,
-                                'VALUES':'1',
-                                'UNITS':0,
-                                'MAX_DISTANCE':0,
-                                'REPLACE':0,
-                                'NODATA':0,
-                                'OPTIONS':'',
-                                'EXTRA':'',
-                                'DATA_TYPE':5,
-                                'OUTPUT':'TEMPORARY_OUTPUT'}
-                                
-            feedback.setCurrentStep(step)
-            step+=1
-            outputs[f'proximity_{paddock_name}'] = processing.run("gdal:proximity", proximity_params, context=context, feedback=feedback, is_child_algorithm=True)
-            results[f'proximity_{paddock_name}'] = outputs[f'proximity_{paddock_name}']['OUTPUT']
+            # Calculate in-memory proximity raster for each waterpoint binary raster
+            # (equivalent to gdal:proximity with georeferenced distance units)
+            proximity_ds = memory_raster(x_size, y_size, geotransform, crs.toWkt(), data_type=gdal.GDT_Float32, nodata=0)
+            gdal.ComputeProximity(water_ds.GetRasterBand(1), proximity_ds.GetRasterBand(1), ['VALUES=1', 'DISTUNITS=GEO', 'NODATA=0'])
+            water_ds = None
+            ogr_ds = None
+            feedback.setProgress(50)
             ############################################################################
-            #*Use materialize()
-            paddock_layer_subset = prepared_paddocks.materialize(QgsFeatureRequest(paddock.id()))
-            
+            # Clip the proximity raster to the paddock; this is the only file written
             clipped_path = os.path.join(output_folder, f'{paddock_name}.tif')
-            
-            clip_params = {'INPUT':results[f'proximity_{paddock_name}'],
-                            'MASK':paddock_layer_subset,
-                            'SOURCE_CRS':None,
-                            'TARGET_CRS':None,
-                            'NODATA':-9999,
-                            'ALPHA_BAND':False,
-                            'CROP_TO_CUTLINE':True,
-                            'KEEP_RESOLUTION':False,
-                            'SET_RESOLUTION':False,
-                            'X_RESOLUTION':None,
-                            'Y_RESOLUTION':None,
-                            'MULTITHREADING':False,
-                            'OPTIONS':'',
-                            'DATA_TYPE':0,
-                            'EXTRA':'',
-                            'OUTPUT':clipped_path}
-
-            feedback.setCurrentStep(step)
-            step+=1
+            clip_by_geometries(proximity_ds, [paddock.geometry().asWkb()], crs.toWkt(), clipped_path, 'GTiff', nodata=-9999)
+            proximity_ds = None
+            feedback.setProgress(100)
             outputLayers.append(clipped_path)
-            outputs[f'clipped_{paddock_name}'] = processing.run("gdal:cliprasterbymasklayer", clip_params, context=context, feedback=feedback, is_child_algorithm=True)
-            results[f'clipped_{paddock_name}'] = outputs[f'clipped_{paddock_name}']['OUTPUT']
+            results[f'clipped_{paddock_name}'] = clipped_path
             result_raster = gdal.Open(results[f'clipped_{paddock_name}'])
             b1_stats = result_raster.GetRasterBand(1).GetStatistics(0, 1)
 #            max = result_raster.dataProvider().bandStatistics(1).maximumValue# in meters
@@ -5,13 +5,16 @@ from qgis.core import (QgsField, QgsFeature, QgsFeatureSink,
                         QgsProcessing, QgsProcessingAlgorithm,
                         QgsProcessingParameterFeatureSource,
                         QgsProcessingParameterEnum,
+                        QgsProcessingParameterBoolean,
                         QgsProcessingParameterFeatureSink,
                         QgsCoordinateReferenceSystem, QgsWkbTypes,
-                        QgsCoordinateTransform, QgsGeometry,
                         QgsProcessingParameterField,
                         QgsProcessingParameterDefinition,
                         QgsDistanceArea, QgsUnitTypes,
                         QgsProcessingException)
+from transforms import transform_in_place
+from waterpoint_index import WaterpointIndex
+from watered_area_cache import WateredAreaCache
                         
 import os
                        
@@ -21,6 +24,7 @@ class PaddockWateredAreas(QgsProcessingAlgorithm):
     WA_BUFFER_DIST = 'WA_BUFFER_DIST'
     TARGET_FIELDS = 'TARGET_FIELDS'
     AREA_METHOD = 'AREA_METHOD'
+    PARALLEL = 'PARALLEL'
     WATERED_AREA = 'WATERED_AREA'
     
     wa_distances = ['3km', '5km']
@@ -100,6 +104,9 @@ class PaddockWateredAreas(QgsProcessingAlgorithm):
                 
         self.parameterDefinition(self.AREA_METHOD).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
         
+        self.addParameter(QgsProcessingParameterBoolean(self.PARALLEL, 'Process paddocks in parallel processes (uses all CPU cores)', defaultValue=False))
+        self.parameterDefinition(self.PARALLEL).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
+        
         self.addParameter(QgsProcessingParameterFeatureSink(
             self.WATERED_AREA,
             "Output watered area",
@@ -135,6 +142,9 @@ class PaddockWateredAreas(QgsProcessingAlgorithm):
             # simply store feature geometries
             waterpoint_geoms = [f.geometry() for f in source_waterpoints.getFeatures()]
         
+        # spatial index so that each paddock only tests nearby waterpoints
+        waterpoint_index = WaterpointIndex(waterpoint_geoms)
+        
         selected_fields = self.parameterAsFields(parameters, self.TARGET_FIELDS, context)
         
         target_fields = [fld for fld in source_paddocks.fields() if fld.name() in selected_fields]
@@ -154,11 +164,16 @@ class PaddockWateredAreas(QgsProcessingAlgorithm):
                                                
         area_method = self.parameterAsEnum(parameters, self.AREA_METHOD, context)
         
+        workers = 0 if self.parameterAsBool(parameters, self.PARALLEL, context) else 1
+        
         # Define QgsDistanceArea object and set crs & ellipsoid to that used by output layer crs
         da = QgsDistanceArea()
         da.setSourceCrs(dest_crs, context.transformContext())
         da.setEllipsoid(dest_crs.ellipsoidAcronym())
         
+        # paddocks with waterpoints: (feature, transformed geometry, waterpoint geometries)
+        paddocks = []
+        
         for ft in source_paddocks.getFeatures():
             if not ft.geometry().isGeosValid():
                 geom = ft.geometry().makeValid()
@@ -169,16 +184,23 @@ class PaddockWateredAreas(QgsProcessingAlgorithm):
                             source_paddocks.sourceCrs(),
                             dest_crs, context.transformContext())
                             
-            pdk_wpts = [pt for pt in waterpoint_geoms if pt.intersects(paddock_geom)]
+            pdk_wpts = waterpoint_index.paddock_waterpoints(paddock_geom)
             
             if not pdk_wpts:
                 continue
             
-            buffers = [p.buffer(wa_buffer_dist, 25) for p in pdk_wpts]
-                                               
-            dissolved_buffer = QgsGeometry.unaryUnion(buffers)
-            
-            clipped_buffer = dissolved_buffer.intersection(paddock_geom)
+            paddocks.append((ft, paddock_geom, pdk_wpts))
+        
+        # watered areas of paddocks (and waterpoints) which have not changed since the last run come from the cache,
+        # the others are calculated one paddock at a time, or in parallel processes
+        with WateredAreaCache(dest_crs, feedback=feedback) as wa_cache:
+            watered_areas = wa_cache.watered_areas([(paddock_geom, pdk_wpts, wa_buffer_dist) for ft, paddock_geom, pdk_wpts in paddocks],
+                                                    workers, feedback)
+        feedback.pushInfo(f'Watered areas from cache: {wa_cache.hits}, calculated: {wa_cache.misses}')
+        
+        for (ft, paddock_geom, pdk_wpts), clipped_buffer in zip(paddocks, watered_areas):
+            if feedback.isCanceled():
+                break
             
             clipped_buffer.convertGeometryCollectionToSubclass(QgsWkbTypes.PolygonGeometry)
             
@@ -208,10 +230,8 @@ class PaddockWateredAreas(QgsProcessingAlgorithm):
                     details.name = f'{self.wa_distances[param_wa_buffer_dist]}_watered_area'
                     details.forceName = True
 
+
         return {self.WATERED_AREA: dest_id}
         
     def transformedGeom(self, g, src_crs, target_crs, transform_context):
-        if src_crs != target_crs:
-            xform = QgsCoordinateTransform(src_crs, target_crs, transform_context)
-            g.transform(xform)
-        return g
\ No newline at end of file
+        return transform_in_place(g, src_crs, target_crs, transform_context)
\ No newline at end of file
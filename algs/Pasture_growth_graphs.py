@@ -10,14 +10,18 @@ from qgis.core import (QgsProcessing, QgsProcessingAlgorithm, QgsProcessingParam
                     QgsProcessingParameterVectorLayer, QgsProcessingParameterEnum,
                     QgsProcessingParameterBoolean, QgsProcessingParameterFolderDestination,
                     QgsProcessingParameterFile, QgsProcessingMultiStepFeedback, QgsMessageLog,
-                    QgsProcessingParameterMatrix, QgsMapLayerProxyModel, QgsVectorLayer, NULL)
+                    QgsProcessingParameterMatrix, QgsMapLayerProxyModel, QgsVectorLayer,
+                    QgsProcessingException, QgsProject, QgsFeatureRequest,
+                    QgsProcessingParameterDefinition, NULL)
                     
 from qgis.gui import (QgsMapLayerComboBox, QgsFieldComboBox, QgsFileWidget)
                     
-import processing
+from zonal_stats import cumulative_zonal_stats
+from zone_cache import cached_district_zone_grid
+from yearly_stats_cache import yearly_district_stats
+from growth_graphs import graph_job, render_graphs
 import os
 import datetime
-import matplotlib.pyplot as plt
 import numpy as np
 import statistics
 #from scipy.interpolate import make_interp_spline
@@ -28,8 +32,13 @@ class PastureGrowthGraphs(QgsProcessingAlgorithm):
     FY = 'FY'
     CUSTOM_PARAMS = 'CUSTOM_PARAMS'
     SMOOTH = 'SMOOTH'
+    GRAPH_FORMAT = 'GRAPH_FORMAT'
+    CACHE_GRAPHS = 'CACHE_GRAPHS'
+    PARALLEL = 'PARALLEL'
     OUTPUT_GRAPHS = 'OUTPUT_GRAPHS'
     
+    graph_formats = ['PNG', 'SVG']
+    
     msg_log = QgsMessageLog()
         
     financial_yrs = []
@@ -127,11 +136,16 @@ class PastureGrowthGraphs(QgsProcessingAlgorithm):
         self.addParameter(custom_params)
         
         self.addParameter(QgsProcessingParameterBoolean(self.SMOOTH, 'Interpolate monthly growth values for smooth graph lines (requires scipy module)'))
+        self.addParameter(QgsProcessingParameterEnum(self.GRAPH_FORMAT, 'Graph image format', self.graph_formats, defaultValue=0))
+        self.parameterDefinition(self.GRAPH_FORMAT).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(QgsProcessingParameterBoolean(self.CACHE_GRAPHS, 'Reuse cached images of graphs whose data has not changed', defaultValue=True))
+        self.parameterDefinition(self.CACHE_GRAPHS).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(QgsProcessingParameterBoolean(self.PARALLEL, 'Render graphs in parallel processes (uses all CPU cores)', defaultValue=False))
+        self.parameterDefinition(self.PARALLEL).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
         self.addParameter(QgsProcessingParameterFolderDestination(self.OUTPUT_GRAPHS, 'Output District Graphs'))
  
     def processAlgorithm(self, parameters, context, model_feedback):
         results = {}
-        outputs = {}
         
         growth_folder_path = self.parameterAsString(parameters, self.INDIR, context)
         
@@ -148,6 +162,9 @@ class PastureGrowthGraphs(QgsProcessingAlgorithm):
         
         out_folder_path = self.parameterAsString(parameters, self.OUTPUT_GRAPHS, context)
         smooth_graphs = self.parameterAsBoolean(parameters, self.SMOOTH, context)
+        graph_ext = self.graph_formats[self.parameterAsEnum(parameters, self.GRAPH_FORMAT, context)].lower()
+        use_graph_cache = self.parameterAsBoolean(parameters, self.CACHE_GRAPHS, context)
+        workers = 0 if self.parameterAsBoolean(parameters, self.PARALLEL, context) else 1
         
         months = ['January', 'February',  'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
 
@@ -168,22 +185,15 @@ class PastureGrowthGraphs(QgsProcessingAlgorithm):
         district_results = [list() for i in range(11)]
         ############################################################################################
         # Number of processing steps will be sum of all .img files in all 3 folders
-        # Addition nested loop required to get count of all input files *is there a better way???
         steps = 0
         for fy_folder in fy_folders:
-            fyear = fy_folder.split(' ')[0]
             dir_path = os.path.join(growth_folder_path, fy_folder)
-            file_count = [file for file in os.scandir(dir_path) if file.name.split('.')[-1] == 'img' or file.name.split('.')[-1] == 'tiff']
-            if len(file_count) == 1:
-                steps += len(file_count)# Just zonal stats will be run (1 alg)
-            else:
-                steps += len(file_count)*2 # Cell stats (sum) and zonal stats will be run (2 algs)
-        steps += 11 # number of districts (1 step for each district graph)
+            steps += len([file for file in os.scandir(dir_path) if file.name.split('.')[-1] == 'img' or file.name.split('.')[-1] == 'tiff'])
+        steps += 1 # render all district graphs
         self.msg_log.logMessage(f'Calculated Steps {steps}')
         feedback = QgsProcessingMultiStepFeedback(steps, model_feedback)
         step = 1
         ###########################################################################################
-        #TODO: set (increment) step, feedback, child alg etc. for each processing call (DONE?)
         for fy_folder in fy_folders:
             fyear = fy_folder.split(' ')[0]
             raw_inputs = []
@@ -195,67 +205,35 @@ class PastureGrowthGraphs(QgsProcessingAlgorithm):
             # os.scandir() does not return files in directory order...
             # we need to return a sorted (yyyymm) version of the input list e.g. [202107, 202108, 202109] etc.
             inputs = sorted(raw_inputs)
-            for i in range(len(inputs)):
-                ##########Get calendar year and month###################
-                calendar_yr = inputs[i].split('/')[-1].split('.')[0][:4]
-                mnth_digit = inputs[i].split('/')[-1].split('.')[0][-2:]
-                mnth_name = months[int(mnth_digit)-1]
-                ########################################################
-                # add next input to stack on each iteration e.g. [1], [1,2], [1,2,3] etc
-                rstack = inputs[:i+1]
-                if len(rstack) == 1:
-                    # just run zonal stats on single input
-                    zonal_stats_params = {'INPUT':district_layer,
-                                'INPUT_RASTER':rstack[0],
-                                'RASTER_BAND':1,
-                                'COLUMN_PREFIX':'_',
-                                'STATISTICS':[2,3],
-                                'OUTPUT':'TEMPORARY_OUTPUT'}
-                    
-                    feedback.setCurrentStep(step)
-                    step+=1
-                    outputs['stats'] = processing.run("native:zonalstatisticsfb", zonal_stats_params, context=context, feedback=feedback, is_child_algorithm=True)
-                    results['stats'] = outputs['stats']['OUTPUT']
-
-                elif len(rstack) > 1:
-                    # run cell stats to sum pixels of rasters in rstack, then zonal stats for mean & median for each district
-                    cell_stat_params = {'INPUT':rstack,
-                            'STATISTIC':0,
-                            'IGNORE_NODATA':True,
-                            'REFERENCE_LAYER':rstack[0],
-                            'OUTPUT_NODATA_VALUE':-9999,
-                            'OUTPUT':'TEMPORARY_OUTPUT'}
-                    
-                    feedback.setCurrentStep(step)
+            if not inputs:
+                continue
+            zone_ds, zone_names = cached_district_zone_grid(district_layer, district_name_field, inputs[0], context.transformContext(), feedback)
+            # Each monthly raster is read once and added to a running sum (stack [1], [1,2], [1,2,3] etc)
+            # from which the cumulative mean & median for each district are calculated
+            feedback.setCurrentStep(step)
+            cumulative_stats = cumulative_zonal_stats(inputs, zone_ds, len(zone_names), feedback)
+            try:
+                for i, (means, medians) in enumerate(cumulative_stats):
+                    ##########Get calendar year and month###################
+                    calendar_yr = inputs[i].split('/')[-1].split('.')[0][:4]
+                    mnth_digit = inputs[i].split('/')[-1].split('.')[0][-2:]
+                    mnth_name = months[int(mnth_digit)-1]
+                    ########################################################
                     step+=1
-                    outputs['cell_sum'] = processing.run("native:cellstatistics", cell_stat_params)
-                    results['cell_sum'] = outputs['cell_sum']['OUTPUT']
-                    
-                    zonal_stats_params = {'INPUT':district_layer,
-                                'INPUT_RASTER':results['cell_sum'],
-                                'RASTER_BAND':1,
-                                'COLUMN_PREFIX':'_',
-                                'STATISTICS':[2,3],
-                                'OUTPUT':'TEMPORARY_OUTPUT'}
-
                     feedback.setCurrentStep(step)
-                    step+=1
-                    outputs['stats'] = processing.run("native:zonalstatisticsfb", zonal_stats_params, context=context, feedback=feedback, is_child_algorithm=True)
-                    results['stats'] = outputs['stats']['OUTPUT']
-                    
-                for f in context.getMapLayer(results['stats']).getFeatures():
-                    for i, district in enumerate(all_districts):
-                        if f[district_name_field].title() == district or (district == 'Victoria River' and f[district_name_field] == 'V.R.D.'):
-                            '''
-                            if district in northern_district_medians.keys():
-                                long_term_median = northern_district_medians[district]
-                            elif district in southern_district_medians.keys():
-                                long_term_median = southern_district_medians[district]
-                            '''
-                            long_term_median = custom_y_axis_values[district][2]
-                            # Write all column values as a row/feature attributes
-                            district_results[i].append([fyear, calendar_yr, mnth_name, f[district_name_field].title(), f['_mean'], long_term_median, f['_median']])
-        
+                    for zone_idx, zone_name in enumerate(zone_names):
+                        for j, district in enumerate(all_districts):
+                            if zone_name.title() == district or (district == 'Victoria River' and zone_name == 'V.R.D.'):
+                                long_term_median = custom_y_axis_values[district][2]
+                                mean = None if np.isnan(means[zone_idx]) else float(means[zone_idx])
+                                median = None if np.isnan(medians[zone_idx]) else float(medians[zone_idx])
+                                # Write all column values as a row/feature attributes
+                                district_results[j].append([fyear, calendar_yr, mnth_name, zone_name.title(), mean, long_term_median, median])
+            except ValueError as e:
+                raise QgsProcessingException(str(e))
+            zone_ds = None
+        
+        graph_jobs = []
         for district_result in district_results:
             district_name = district_result[0][3]
             
@@ -282,7 +260,7 @@ class PastureGrowthGraphs(QgsProcessingAlgorithm):
             y_axis_info = []
             # If use_custom_y_axis_props is checked, get the upper-tick & step values
             # for the correct (current) district and set to y_axis_info then pass the
-            # list e.g. [2000, 250] to the make_plot() func
+            # list e.g. [2000, 250] to the graph_job() func
             #use_custom_y_axis_values = custom_param_array[2]
             #custom_y_axis_values = custom_param_array[3]# A dictionary {'Darwin': [2500, 500]} etc
             if use_custom_y_axis_values and custom_y_axis_values:
@@ -293,92 +271,18 @@ class PastureGrowthGraphs(QgsProcessingAlgorithm):
                 y_axis_info = y_axis_vals
             
             
-            graph = self.make_plot(region, district_name, long_term_district_median, f_yr1, f_yr2, f_yr3, yr_labels, y_axis_info, smooth_graphs)
-            graph.gcf().set_size_inches(10, 7)
-            out_png = os.path.join(out_folder_path, f'{district_name}.png')
-            graph.savefig(out_png, bbox_inches='tight')
-            graph.clf() # Clear figure and all axes
-            
-            feedback.setCurrentStep(step)
-            step+=1
-            model_feedback.pushInfo(f'Creating pasture growth graph for {district_name} District')
-        graph.close()# This should close the window after all graphs have been created
+            out_graph = os.path.join(out_folder_path, f'{district_name}.{graph_ext}')
+            graph_jobs.append(graph_job(region, district_name, long_term_district_median, f_yr1, f_yr2, f_yr3, yr_labels, y_axis_info, smooth_graphs, out_graph))
+        
+        feedback.setCurrentStep(step)
+        step+=1
+        for job, out_graph in zip(graph_jobs, render_graphs(graph_jobs, use_graph_cache, workers, feedback)):
+            model_feedback.pushInfo(f'Created pasture growth graph for {job["district"]} District')
+            results[job['district']] = out_graph
 ##################################################################################################
         return results
         
         
-    def make_plot(self, region, district, median, values1=[], values2=[], values3=[], labels=[], y_axis_props=[], smooth=False):
-        
-        max_value = max([max(values1), max(values2), max(values3)])
-        self.msg_log.logMessage(f'Maximum District Value {district} ({region}): {max_value}')
-        
-        fy_months = ['Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec', 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun']
-        
-        district_median = [median for i in range(12)]
-        
-        # Median is constant (doesn't need smoothing)
-        plt.plot(fy_months, district_median, label='Median', color='grey', linewidth=5)
-
-        if smooth:
-            from scipy.interpolate import make_interp_spline
-            # Interpolate data points for smooth lines
-            idx_for_12_months = range(len(fy_months))
-            xnew_for_12_months = np.linspace(min(idx_for_12_months), max(idx_for_12_months), 300)
-
-            idx_for_part_yr = range(len(values3))
-            xnew_for_part_yr = np.linspace(min(idx_for_part_yr), max(idx_for_part_yr), 300)
-
-            spl_1 = make_interp_spline(idx_for_12_months, values1, k=3)
-            smooth_1 = spl_1(xnew_for_12_months)
-
-            spl_2 = make_interp_spline(idx_for_12_months, values2, k=3)
-            smooth_2 = spl_2(xnew_for_12_months)
-            
-            # k value must be less than number of given points for interpolation
-            spl_3 = make_interp_spline(idx_for_part_yr, values3, k=len(values3)-1 if len(values3)<4 else 3)
-            smooth_3 = spl_3(xnew_for_part_yr)
-            
-            # Plot smoothed lines
-            plt.plot(xnew_for_12_months, smooth_1, label=labels[0], color='blue', linewidth=5)
-            plt.plot(xnew_for_12_months, smooth_2, label=labels[1], color='red', linewidth=5)
-            plt.plot(xnew_for_part_yr, smooth_3, label=labels[2], color='lawngreen', linewidth=5)
-
-        else:
-            # plot lines without smoothing
-            plt.plot(fy_months, values1, label=labels[0], color='blue', linewidth=5)
-            plt.plot(fy_months, values2, label=labels[1], color='red', linewidth=5)
-            plt.plot(fy_months[:len(values3)], values3, label=labels[2], color='lawngreen', linewidth=5)
-
-        plt.legend(fontsize=18)
-        plt.xticks(fontsize=18, rotation=90)
-        
-        if not y_axis_props:
-            # y_axis_props argument is an empty list (Set custom Y-axis properties checkbox NOT checked)
-            # We use default upper tick & step values
-            if region == 'Northern':
-                upper_tick = 2600
-                step = 500
-            elif region == 'Southern':
-                upper_tick = 800
-                step = 250
-        elif y_axis_props:
-            # (Set custom Y-axis properties checkbox IS checked)
-            # We use the custom upper-tick & step values passed in the y_axis_props list
-            # We also need to add 50 or 100 to the upper tick value to get the correct Y-axis
-            step = y_axis_props[1]
-            if step%100:
-                # Check if divisible by 100 (e.g. 500 etc); Probably northern district
-                upper_tick = y_axis_props[0]+100
-            else:
-                # Not divisible by 100 (e.g. 250 etc); Probably southern district
-                upper_tick = y_axis_props[0]+50
-                
-        self.msg_log.logMessage(f'Y-Axis Props: {region} | {district} | {upper_tick} | {step}')
-        plt.yticks(np.arange(0, upper_tick, step=step), fontsize=18)
-        plt.gca().yaxis.grid(linestyle='dashed')
-        return plt
-
-
 class CustomParametersWidgetWrapper(WidgetWrapper):
 
     def createWidget(self):
@@ -501,12 +405,13 @@ class CustomDistrictGraphWidget(QWidget):
     def district_long_term_medians(self):
         uri = os.path.join(os.path.dirname(__file__), "../data/DISTRICTS.gpkg")
         data_lyr = QgsVectorLayer(uri, 'data', 'ogr')
-        current_medians = [ft['LONG_TERM_MEDIAN'] for ft in data_lyr.getFeatures()]
-        if any([i==NULL for i in current_medians]):
-            #current_medians = [ft['OLD_MEDIAN'] for ft in data_lyr.getFeatures()]
-            return {ft['NAME']:ft['OLD_MEDIAN'] for ft in data_lyr.getFeatures()}
+        # Read the (small) attribute table once, without geometries
+        req = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(['NAME', 'LONG_TERM_MEDIAN', 'OLD_MEDIAN'], data_lyr.fields())
+        rows = [(ft['NAME'], ft['LONG_TERM_MEDIAN'], ft['OLD_MEDIAN']) for ft in data_lyr.getFeatures(req)]
+        if any([row[1]==NULL for row in rows]):
+            return {name:old_median for name, lt_median, old_median in rows}
         else:
-            return {ft['NAME']:ft['LONG_TERM_MEDIAN'] for ft in data_lyr.getFeatures()}
+            return {name:lt_median for name, lt_median, old_median in rows}
     
     def populate_table(self):
         self.district_table.setRowCount(11)
@@ -688,25 +593,9 @@ class UpdateMediansDialog(QDialog):
         
         districts = [ft['NAME'] for ft in district_lyr.getFeatures()]
         
-        results_all_years = {}
-
-        for file in os.scandir(src_folder):
-            ext = file.name.split('.')[-1]
-            if ext != 'tiff':
-                continue
-            yr = file.name[:4]
-            input_file = os.path.join(src_folder, file.name)
-            dist_stats_params = {'INPUT':district_lyr,
-                                'INPUT_RASTER':input_file,
-                                'RASTER_BAND':1,
-                                'COLUMN_PREFIX':'_',
-                                'STATISTICS':[2,3],
-                                'OUTPUT':'TEMPORARY_OUTPUT'}
-            yr_district_stats = processing.run("native:zonalstatisticsfb", dist_stats_params)['OUTPUT']
-            yr_results = {}
-            for ft in yr_district_stats.getFeatures():
-                yr_results[ft['NAME']] = {'Mean': ft['_mean'], 'Median': ft['_median']}
-            results_all_years[yr] = yr_results
+        # Yearly district statistics are cached, so only years which have been
+        # added (or changed) since the last update are calculated
+        results_all_years = yearly_district_stats(src_folder, district_lyr, 'NAME', QgsProject.instance().transformContext())
 
         for district in districts:
             district_yr_medians = []
@@ -4,10 +4,13 @@ from qgis.core import (QgsProcessing, QgsProcessingAlgorithm, QgsProcessingParam
                     QgsProcessingParameterVectorLayer, QgsProcessingParameterEnum,
                     QgsProcessingParameterFileDestination, QgsProcessingParameterFile,
                     QgsProcessingMultiStepFeedback, QgsVectorLayer, QgsField,
-                    QgsFeature, QgsMessageLog)
+                    QgsFeature, QgsMessageLog, QgsProcessingException)
+from zonal_stats import cumulative_zonal_stats
+from zone_cache import cached_district_zone_grid
 import processing
 import os
 import datetime
+import numpy as np
 
                   
 class PastureGrowthSpreadsheet(QgsProcessingAlgorithm):
@@ -95,22 +98,15 @@ class PastureGrowthSpreadsheet(QgsProcessingAlgorithm):
         district_results = [list() for i in range(11)]
         ############################################################################################
         # Number of processing steps will be sum of all .img files in all 3 folders
-        # Addition nested loop required to get count of all input files *is there a better way???
         steps = 0
         for fy_folder in fy_folders:
-            fyear = fy_folder.split(' ')[0]
             dir_path = os.path.join(growth_folder_path, fy_folder)
-            file_count = [file for file in os.scandir(dir_path) if file.name.split('.')[-1] == 'img']
-            if len(file_count) == 1:
-                steps += len(file_count)# Just zonal stats will be run (1 alg)
-            else:
-                steps += len(file_count)*2 # Cell stats (sum) and zonal stats will be run (2 algs)
+            steps += len([file for file in os.scandir(dir_path) if file.name.split('.')[-1] == 'img'])
         steps += 12 # number of districts (1 step for each district) + export to xlsx alg
         self.msg_log.logMessage(f'Calculated Steps {steps}')
         feedback = QgsProcessingMultiStepFeedback(steps, model_feedback)
         step = 1
         ###########################################################################################
-        #TODO: set (increment) step, feedback, child alg etc. for each processing call
         for fy_folder in fy_folders:
             fyear = fy_folder.split(' ')[0]
             raw_inputs = []
@@ -122,63 +118,36 @@ class PastureGrowthSpreadsheet(QgsProcessingAlgorithm):
             # os.scandir() does not return files in directory order...
             # we need to return a sorted (yyyymm) version of the input list e.g. [202107, 202108, 202109] etc.
             inputs = sorted(raw_inputs)
-            for i in range(len(inputs)):
-                ##########Get calendar year and month###################
-                calendar_yr = os.path.split(inputs[i])[-1][:4]
-                mnth_digit = os.path.split(inputs[i])[-1].split('.')[0][-2:]
-                mnth_name = months[int(mnth_digit)-1]
-                ########################################################
-                # add next input to stack on each iteration e.g. [1], [1,2], [1,2,3] etc
-                rstack = inputs[:i+1]
-                if len(rstack) == 1:
-                    # just run zonal stats on single input
-                    zonal_stats_params = {'INPUT':district_layer,
-                                'INPUT_RASTER':rstack[0],
-                                'RASTER_BAND':1,
-                                'COLUMN_PREFIX':'_',
-                                'STATISTICS':[2,3],
-                                'OUTPUT':'TEMPORARY_OUTPUT'}
-                    
-                    feedback.setCurrentStep(step)
-                    step+=1
-                    outputs['stats'] = processing.run("native:zonalstatisticsfb", zonal_stats_params, context=context, feedback=feedback, is_child_algorithm=True)
-                    results['stats'] = outputs['stats']['OUTPUT']
-
-                elif len(rstack) > 1:
-                    # run cell stats to sum pixels of rasters in rstack, then zonal stats for mean & median for each district
-                    cell_stat_params = {'INPUT':rstack,
-                            'STATISTIC':0,
-                            'IGNORE_NODATA':True,
-                            'REFERENCE_LAYER':rstack[0],
-                            'OUTPUT_NODATA_VALUE':-9999,
-                            'OUTPUT':'TEMPORARY_OUTPUT'}
-                    
-                    feedback.setCurrentStep(step)
+            if not inputs:
+                continue
+            zone_ds, zone_names = cached_district_zone_grid(district_layer, 'DISTRICT', inputs[0], context.transformContext(), feedback)
+            # Each monthly raster is read once and added to a running sum (stack [1], [1,2], [1,2,3] etc)
+            # from which the cumulative mean & median for each district are calculated
+            feedback.setCurrentStep(step)
+            cumulative_stats = cumulative_zonal_stats(inputs, zone_ds, len(zone_names), feedback)
+            try:
+                for i, (means, medians) in enumerate(cumulative_stats):
+                    ##########Get calendar year and month###################
+                    calendar_yr = os.path.split(inputs[i])[-1][:4]
+                    mnth_digit = os.path.split(inputs[i])[-1].split('.')[0][-2:]
+                    mnth_name = months[int(mnth_digit)-1]
+                    ########################################################
                     step+=1
-                    outputs['cell_sum'] = processing.run("native:cellstatistics", cell_stat_params)
-                    results['cell_sum'] = outputs['cell_sum']['OUTPUT']
-                    
-                    zonal_stats_params = {'INPUT':district_layer,
-                                'INPUT_RASTER':results['cell_sum'],
-                                'RASTER_BAND':1,
-                                'COLUMN_PREFIX':'_',
-                                'STATISTICS':[2,3],
-                                'OUTPUT':'TEMPORARY_OUTPUT'}
-
                     feedback.setCurrentStep(step)
-                    step+=1
-                    outputs['stats'] = processing.run("native:zonalstatisticsfb", zonal_stats_params, context=context, feedback=feedback, is_child_algorithm=True)
-                    results['stats'] = outputs['stats']['OUTPUT']
-                    
-                for f in context.getMapLayer(results['stats']).getFeatures():
-                    for i, district in enumerate(all_districts):
-                        if f['DISTRICT'] == district or (district == 'Victoria River' and f['DISTRICT'] == 'V.R.D.'):
-                            if district in northern_district_medians.keys():
-                                long_term_median = northern_district_medians[district]
-                            elif district in southern_district_medians.keys():
-                                long_term_median = southern_district_medians[district]
-                            # Write all column values as a row/feature attributes
-                            district_results[i].append([fyear, calendar_yr, mnth_name, f['DISTRICT'], f['_mean'], long_term_median, f['_median']])
+                    for zone_idx, zone_name in enumerate(zone_names):
+                        for j, district in enumerate(all_districts):
+                            if zone_name == district or (district == 'Victoria River' and zone_name == 'V.R.D.'):
+                                if district in northern_district_medians.keys():
+                                    long_term_median = northern_district_medians[district]
+                                elif district in southern_district_medians.keys():
+                                    long_term_median = southern_district_medians[district]
+                                mean = None if np.isnan(means[zone_idx]) else float(means[zone_idx])
+                                median = None if np.isnan(medians[zone_idx]) else float(medians[zone_idx])
+                                # Write all column values as a row/feature attributes
+                                district_results[j].append([fyear, calendar_yr, mnth_name, zone_name, mean, long_term_median, median])
+            except ValueError as e:
+                raise QgsProcessingException(str(e))
+            zone_ds = None
         
             
         output_layers = []
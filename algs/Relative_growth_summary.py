@@ -10,17 +10,27 @@ from qgis.core import (QgsVectorLayer,
                         QgsProcessingParameterFeatureSource,
                         QgsProcessingParameterField,
                         QgsProcessingParameterFileDestination,
-                        QgsProcessingMultiStepFeedback)
+                        QgsProcessingParameterBoolean,
+                        QgsProcessingParameterDefinition,
+                        QgsProcessingMultiStepFeedback)
 
-from osgeo import gdal
+from zonal_stats import zonal_class_counts
+from zone_cache import cached_district_zone_grid
+from class_bins import ClassBins
 import processing
 import os
+
+# Growth category bins: extremely low (0, 10], well below average (10, 20], below average (20, 30],
+# average (30, 70], above average (70, 80], well above average (80, 90], extremely high (90, 100]
+# Seasonally low growth (255), water (254) & fire scars (253) are counted separately (not included in total)
+PERCENTILE_GROWTH_BINS = ClassBins([0, 10, 20, 30, 70, 80, 90, 100], special_values=[255, 254, 253])
                        
 class RelativeGrowthSummary(QgsProcessingAlgorithm):
     PERCENTILE_GROWTH_RASTER = 'PERCENTILE_GROWTH_RASTER'
     DISTRICT_LAYER = 'DISTRICT_LAYER'
     DISTRICT_NAME_FIELD = 'DISTRICT_NAME_FIELD'
     OUTPUT_XLSX = 'OUTPUT_XSLX'
+    PARALLEL = 'PARALLEL'
  
     def __init__(self):
         super().__init__()
@@ -59,6 +69,9 @@ class RelativeGrowthSummary(QgsProcessingAlgorithm):
                                                     "Field containing district name",
                                                     parentLayerParameterName=self.DISTRICT_LAYER,
                                                     type=QgsProcessingParameterField.String))
+        self.addParameter(QgsProcessingParameterBoolean(self.PARALLEL, 'Count pixels in parallel processes (uses all CPU cores)', defaultValue=False))
+        self.parameterDefinition(self.PARALLEL).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
+        
         self.addParameter(QgsProcessingParameterFileDestination(self.OUTPUT_XLSX, 'Percentile growth summary spreadsheet', 'Microsoft Excel (*.xlsx);;Open Document Spreadsheet (*.ods)'))
  
     def processAlgorithm(self, parameters, context, model_feedback):
@@ -69,17 +82,8 @@ class RelativeGrowthSummary(QgsProcessingAlgorithm):
         districts = self.parameterAsSource(parameters, self.DISTRICT_LAYER, context)
         district_name_field = self.parameterAsString(parameters, self.DISTRICT_NAME_FIELD, context)
         destination_spreadsheet = self.parameterAsString(parameters, self.OUTPUT_XLSX, context)
+        workers = 0 if self.parameterAsBool(parameters, self.PARALLEL, context) else 1
         
-        #################Create temporary copy of district layer###############
-        temp_districts = QgsVectorLayer(f'polygon?&crs={districts.sourceCrs().authid()}', 'Temp_Districts', 'memory')
-        temp_districts.dataProvider().addAttributes(districts.fields())
-        temp_districts.updateFields()
-        for f in districts.getFeatures():
-            feat = QgsFeature()
-            feat.setGeometry(f.geometry())
-            feat.setAttributes(f.attributes())
-            temp_districts.dataProvider().addFeatures([feat])
-            
         ##Create temporary layer to hold counts/ percentages for each district##
         pcnt_growth_temp = QgsVectorLayer('point', 'Relative Growth Summary', 'memory')
         
@@ -104,46 +108,28 @@ class RelativeGrowthSummary(QgsProcessingAlgorithm):
         pcnt_growth_temp.updateFields()
         
         #######################################################################
-        steps = districts.featureCount()+1
+        steps = 3
         feedback = QgsProcessingMultiStepFeedback(steps, model_feedback)
         step = 1
         #######################################################################
         
-        district_names = [f[district_name_field] for f in temp_districts.getFeatures()]
+        # get (cached) zone grid of districts aligned to the relative growth raster
+        feedback.setCurrentStep(step)
+        step+=1
+        zone_ds, district_names = cached_district_zone_grid(districts, district_name_field, percentile_growth_raster.source(), context.transformContext(), feedback)
         
-        for district_name in district_names:
-            # filter district layer to current distict name
-            filtered_district = temp_districts.setSubsetString(f'"{district_name_field}" LIKE \'{district_name}\'')
-            if not filtered_district:
-                feedback.pushDebugInfo('Unable to filter districts to create mask layer')
-                continue
-            # clip relative growth raster to district (no_data -999)
-            mask_params = {'INPUT':percentile_growth_raster,
-                'MASK':temp_districts,
-                'SOURCE_CRS':None,
-                'TARGET_CRS':None,
-                'NODATA':-999,
-                'ALPHA_BAND':False,
-                'CROP_TO_CUTLINE':True,
-                'KEEP_RESOLUTION':False,
-                'SET_RESOLUTION':False,
-                'X_RESOLUTION':None,
-                'Y_RESOLUTION':None,
-                'MULTITHREADING':False,
-                'OPTIONS':'',
-                'DATA_TYPE':2,
-                'EXTRA':'',
-                'OUTPUT':'TEMPORARY_OUTPUT'}
-
-            feedback.setCurrentStep(step)
-            step+=1
-            
-            outputs[f'clipped_to_{district_name}'] = processing.run("gdal:cliprasterbymasklayer", mask_params, context=context, feedback=feedback, is_child_algorithm=True)
-            results[f'clipped_to_{district_name}'] = outputs[f'clipped_to_{district_name}']['OUTPUT']
+        # count percentile growth classes for every district in one read
+        feedback.setCurrentStep(step)
+        step+=1
+        zone_counts = zonal_class_counts(percentile_growth_raster.source(), zone_ds, len(district_names), {'Percentile growth': PERCENTILE_GROWTH_BINS}, feedback, workers)
+        zone_ds = None
+        if feedback.isCanceled():
+            # counts stop at the cancelled block, so they are incomplete
+            return {}
+        
+        for i, district_name in enumerate(district_names):
             # run percentile_growth_counts and add results as feature to pcnt_growth_temp
-            ds = gdal.Open(results[f'clipped_to_{district_name}'])
-            ds_as_array = ds.ReadAsArray()
-            all_counts = self.percentile_growth_counts(ds_as_array)
+            all_counts = self.percentile_growth_counts(zone_counts['Percentile growth'][i][:PERCENTILE_GROWTH_BINS.bin_count])
             feat = QgsFeature(pcnt_growth_temp.fields())
             feat.setAttributes([district_name,
                                 int(all_counts[0]),#extremeley low count
@@ -167,7 +153,6 @@ class RelativeGrowthSummary(QgsProcessingAlgorithm):
                 feedback.pushDebugInfo(f'District row successfully added: {repr(feature_added[0])}')
             elif feature_added[0] is False:
                 feedback.pushWarning(repr(pcnt_growth_temp.dataProvider().lastError()))
-            ds = None
         # save pcnt_growth_temp to output spreadsheet
         save_2_xlsx_params = {'LAYERS':[pcnt_growth_temp],
             'USE_ALIAS':False,
@@ -185,22 +170,15 @@ class RelativeGrowthSummary(QgsProcessingAlgorithm):
         return results
                 
                 
-    def percentile_growth_counts(self, arr):
-        # get pixel counts for growth category bins
-        extremely_low_count = ((arr > 0)&(arr <= 10)).sum()
-        well_below_average_count = ((arr > 10)&(arr <= 20)).sum()
-        below_average_count = ((arr > 20)&(arr <= 30)).sum()
-        average_count = ((arr > 30)&(arr <= 70)).sum()
-        above_average_count = ((arr > 70)&(arr <= 80)).sum()
-        well_above_average_count = ((arr > 80)&(arr <= 90)).sum()
-        extremely_high_count = ((arr > 90)&(arr <= 100)).sum()
-        
-        # get pixel counts for seasonally low growth, fire scars & water bodies (not included in total)
-        seasonally_low_growth_count = (arr == 255).sum()
-        water_count = (arr == 254).sum()
-        fire_scar_count = (arr == 253).sum()
-        # get no data count (also excluded from total)
-        no_data_count = (arr == -999).sum()
+    def percentile_growth_counts(self, class_counts):
+        # pixel counts for growth category bins
+        (extremely_low_count,
+        well_below_average_count,
+        below_average_count,
+        average_count,
+        above_average_count,
+        well_above_average_count,
+        extremely_high_count) = class_counts
         
         # get total count of relevant pixels
         total_valid_pixel_count = sum([extremely_low_count,
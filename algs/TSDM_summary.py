@@ -8,13 +8,21 @@ from qgis.core import (QgsVectorLayer, QgsField, QgsFeature,
                         QgsProcessingParameterVectorLayer,
                         QgsProcessingParameterMatrix,
                         QgsProcessingParameterFileDestination,
+                        QgsProcessingParameterBoolean,
+                        QgsProcessingParameterDefinition,
                         QgsProcessingMultiStepFeedback)
 
 from processing.gui.wrappers import WidgetWrapper
-from osgeo import gdalnumeric
+from zonal_stats import zonal_class_counts
+from zone_cache import cached_district_zone_grid
+from class_bins import ClassBins, scale_bins, scale_error
 import processing
 import os
 
+# TSDM percentile: below average [0, 30], average (30, 70], above average (70, 100]
+# (firescars 253 and water 254 are counted separately and excluded from the totals)
+TSDM_PERCENTILE_BINS = ClassBins([0, 30, 70, 100], special_values=[253, 254], include_lowest=True)
+
                        
 class TSDMSummary(QgsProcessingAlgorithm):
     TSDM = 'TSDM'
@@ -22,6 +30,7 @@ class TSDMSummary(QgsProcessingAlgorithm):
     DISTRICTS = 'DISTRICTS'
     CUSTOM_PARAMS = 'CUSTOM_PARAMS'
     XL_SUMMARY = 'XL_SUMMARY'
+    PARALLEL = 'PARALLEL'
  
     def __init__(self):
         super().__init__()
@@ -64,13 +73,18 @@ class TSDMSummary(QgsProcessingAlgorithm):
         custom_params.setMetadata({'widget_wrapper': {'class': CustomParametersWidgetWrapper}})
         self.addParameter(custom_params)
         
+        self.addParameter(QgsProcessingParameterBoolean(self.PARALLEL, 'Count pixels in parallel processes (uses all CPU cores)', defaultValue=False))
+        self.parameterDefinition(self.PARALLEL).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
+        
         self.addParameter(QgsProcessingParameterFileDestination(self.XL_SUMMARY, 'TSDM summary spreadsheet', 'Microsoft Excel (*.xlsx);;Open Document Spreadsheet (*.ods)'))
 
     def checkParameterValues(self, parameters, context):
         scale_vals, regions = self.parameterAsMatrix(parameters, self.CUSTOM_PARAMS, context)
-        custom_value_list = scale_vals['Custom Scale']
-        if 'Custom' in regions.values() and custom_value_list == [0, 0, 0, 0]:
-            return False, 'A custom scale with invalid values is set for one or more districts.'
+        # every scale used by a district must give strictly increasing bin edges
+        for region in sorted(set(regions.values())):
+            error = scale_error(f'{region} Scale', scale_vals[f'{region} Scale'])
+            if error is not None:
+                return False, error
         return super().checkParameterValues(parameters, context)
  
     def processAlgorithm(self, parameters, context, model_feedback):
@@ -82,6 +96,7 @@ class TSDMSummary(QgsProcessingAlgorithm):
         tsdm_pcnt = self.parameterAsRasterLayer(parameters, self.TSDM_PCNT, context)
         districts = self.parameterAsVectorLayer(parameters, self.DISTRICTS, context)
         dest_spreadsheet = parameters[self.XL_SUMMARY]
+        workers = 0 if self.parameterAsBool(parameters, self.PARALLEL, context) else 1
     
     ############################################################################
         '''
@@ -97,25 +112,12 @@ class TSDMSummary(QgsProcessingAlgorithm):
         
     ############################################################################
     
-        steps = 23
+        steps = 4
         feedback = QgsProcessingMultiStepFeedback(steps, model_feedback)
         step = 1
         
-        ###Create temporary copy of district layer#########################
-        temp_districts = QgsVectorLayer(f'polygon?&crs={districts.crs().authid()}', 'Temp_Districts', 'memory')
-        temp_districts.dataProvider().addAttributes(districts.fields())
-        temp_districts.updateFields()
-        for f in districts.getFeatures():
-            feat = QgsFeature()
-            feat.setGeometry(f.geometry())
-            feat.setAttributes(f.attributes())
-            temp_districts.dataProvider().addFeatures([feat])
-        ####################################################################
-        
         temp_layers = []
         
-        district_names = [f['DISTRICT'] for f in temp_districts.getFeatures()]
-        
         tsdm_temp = QgsVectorLayer('Point', 'TSDM Summary', 'memory')
         tsdm_temp.dataProvider().addAttributes([
             QgsField('District', QVariant.String),
@@ -141,38 +143,37 @@ class TSDMSummary(QgsProcessingAlgorithm):
             QgsField('Above_average_percent', QVariant.Double),
             QgsField('Check_Sum', QVariant.Int)])
         tsdm_pcnt_temp.updateFields()
-                
-        for district_name in district_names:
-            
-            temp_districts.setSubsetString(f""""DISTRICT" LIKE '{district_name}'""")
-            
-            ######## Clip tsdm (total) raster to filtered district layer########
-            mask1_params = {'INPUT':tsdm,
-                'MASK':temp_districts,
-                'SOURCE_CRS':None,
-                'TARGET_CRS':None,
-                'NODATA':-999,
-                'ALPHA_BAND':False,
-                'CROP_TO_CUTLINE':True,
-                'KEEP_RESOLUTION':False,
-                'SET_RESOLUTION':False,
-                'X_RESOLUTION':None,
-                'Y_RESOLUTION':None,
-                'MULTITHREADING':False,
-                'OPTIONS':'',
-                'DATA_TYPE':0,# Use input datatype (Float32)
-                'EXTRA':'',
-                'OUTPUT':'TEMPORARY_OUTPUT'}
-                        
-            feedback.setCurrentStep(step)
-            step+=1
-            outputs[f'tsdm_clipped_to_{district_name}'] = processing.run("gdal:cliprasterbymasklayer", mask1_params, context=context, feedback=feedback, is_child_algorithm=True)
-            results[f'tsdm_clipped_to_{district_name}'] = outputs[f'tsdm_clipped_to_{district_name}']['OUTPUT']
-            
+        
+        ###Get (cached) zone grid of districts aligned to the TSDM raster#######
+        feedback.setCurrentStep(step)
+        step+=1
+        zone_ds, district_names = cached_district_zone_grid(districts, 'DISTRICT', tsdm.source(), context.transformContext(), feedback)
+        
+        ###Count TSDM (total) classes for every district in one read###########
+        region_scales = {'Northern': northern_value_list,
+                        'Southern': southern_value_list,
+                        'Custom': custom_value_list}
+        used_regions = set(district_regions[district_name] for district_name in district_names)
+        tsdm_bins = {region: scale_bins(region_scales[region]) for region in used_regions}
+        feedback.setCurrentStep(step)
+        step+=1
+        tsdm_zone_counts = zonal_class_counts(tsdm.source(), zone_ds, len(district_names), tsdm_bins, feedback, workers)
+        
+        ###Count TSDM (percentile) classes for every district in one read#######
+        # Both AussieGRASS products normally share a grid, so this is a cache hit
+        zone_ds, district_names = cached_district_zone_grid(districts, 'DISTRICT', tsdm_pcnt.source(), context.transformContext(), feedback)
+        feedback.setCurrentStep(step)
+        step+=1
+        tsdm_pcnt_zone_counts = zonal_class_counts(tsdm_pcnt.source(), zone_ds, len(district_names), {'Percentile': TSDM_PERCENTILE_BINS}, feedback, workers)
+        zone_ds = None
+        if feedback.isCanceled():
+            # counts stop at the cancelled block, so they are incomplete
+            return {}
+        
+        for i, district_name in enumerate(district_names):
             ###Save TSDM (total) counts to tempory layer
             region = district_regions[district_name]
-            raster_1 = gdalnumeric.LoadFile(results[f'tsdm_clipped_to_{district_name}'])
-            counts_1 = self.tsdm_counts(raster_1, region, northern_value_list, southern_value_list, custom_value_list)
+            counts_1 = self.tsdm_counts(tsdm_zone_counts[region][i])
             feat1 = QgsFeature()
             feat1.setAttributes([
                 district_name,
@@ -187,33 +188,9 @@ class TSDMSummary(QgsProcessingAlgorithm):
                 int(round(counts_1[8], 0))
                 ])
             add1 = tsdm_temp.dataProvider().addFeature(feat1)
-            
-            ######## Clip tsdm (percentile) raster to filtered district layer########
-            mask2_params = {'INPUT':tsdm_pcnt,
-                'MASK':temp_districts,
-                'SOURCE_CRS':None,
-                'TARGET_CRS':None,
-                'NODATA':-999,
-                'ALPHA_BAND':False,
-                'CROP_TO_CUTLINE':True,
-                'KEEP_RESOLUTION':False,
-                'SET_RESOLUTION':False,
-                'X_RESOLUTION':None,
-                'Y_RESOLUTION':None,
-                'MULTITHREADING':False,
-                'OPTIONS':'',
-                'DATA_TYPE':5,# Int32 (required for -999 nodata value)
-                'EXTRA':'',
-                'OUTPUT':'TEMPORARY_OUTPUT'}
-                
-            feedback.setCurrentStep(step)
-            step+=1
-            outputs[f'tsdm_pcnt_clipped_to_{district_name}'] = processing.run("gdal:cliprasterbymasklayer", mask2_params, context=context, feedback=feedback, is_child_algorithm=True)
-            results[f'tsdm_pcnt_clipped_to_{district_name}'] = outputs[f'tsdm_pcnt_clipped_to_{district_name}']['OUTPUT']
                         
             ###Save TSDM (percentile) counts to tempory layer
-            raster_2 = gdalnumeric.LoadFile(results[f'tsdm_pcnt_clipped_to_{district_name}'])
-            counts_2 = self.tsdm_percentile_counts(raster_2)
+            counts_2 = self.tsdm_percentile_counts(tsdm_pcnt_zone_counts['Percentile'][i][:TSDM_PERCENTILE_BINS.bin_count])
             feat2 = QgsFeature()
             feat2.setAttributes([
                 district_name,
@@ -245,47 +222,10 @@ class TSDMSummary(QgsProcessingAlgorithm):
     
     #############Methods which return counts and percentages##################
         
-    def tsdm_counts(self, raster, region, northern_scale_vals, southern_scale_vals, custom_scale_vals):
-        if region == 'Northern':
-            # Northern Districts
-            northern_val_bottom = northern_scale_vals[0] #zero
-            northern_val_low = northern_scale_vals[1] # e.g. 1000
-            northern_val_mod = northern_scale_vals[2] # e.g. 2000
-            northern_val_high = northern_scale_vals[3] # e.g. 3000
-            
-            low_count = ((raster >= northern_val_bottom)&(raster <= northern_val_low)).sum()
-            low_moderate_count = ((raster > northern_val_low)&(raster <= northern_val_mod)).sum()
-            moderate_count = ((raster > northern_val_mod)&(raster <= northern_val_high)).sum()
-            high_count = (raster > northern_val_high).sum()
-            #water_count = (raster == -2).sum()
-            #no_data_count = (raster == -999).sum()
-
-        elif region == 'Southern':
-            # Southern Districts
-            southern_val_bottom = southern_scale_vals[0] #zero
-            southern_val_low = southern_scale_vals[1] # e.g. 250
-            southern_val_mod = southern_scale_vals[2] # e.g. 500
-            southern_val_high = southern_scale_vals[3] # e.g. 1000
-            
-            low_count = ((raster >= southern_val_bottom)&(raster <= southern_val_low)).sum()
-            low_moderate_count = ((raster > southern_val_low)&(raster <= southern_val_mod)).sum()
-            moderate_count = ((raster > southern_val_mod)&(raster <= southern_val_high)).sum()
-            high_count = (raster > southern_val_high).sum()
-            #water_count = (raster == -2).sum()
-            #no_data_count = (raster == -999).sum()
-
-        elif region == 'Custom':
-            # Custom scale
-            custom_val_bottom = custom_scale_vals[0] #zero
-            custom_val_low = custom_scale_vals[1] # e.g. 250
-            custom_val_mod = custom_scale_vals[2] # e.g. 500
-            custom_val_high = custom_scale_vals[3] # e.g. 1000
-            
-            low_count = ((raster >= custom_val_bottom)&(raster <= custom_val_low)).sum()
-            low_moderate_count = ((raster > custom_val_low)&(raster <= custom_val_mod)).sum()
-            moderate_count = ((raster > custom_val_mod)&(raster <= custom_val_high)).sum()
-            high_count = (raster > custom_val_high).sum()
-            #no_data_count = (raster == -999).sum()
+    def tsdm_counts(self, class_counts):
+        low_count, low_moderate_count, moderate_count, high_count = class_counts
+        #water_count = (raster == -2).sum()
+        #no_data_count = (raster == -999).sum()
 
         #total_pixel_count = sum([low_count, low_moderate_count, moderate_count, high_count, no_data_count])
         total_pixel_count = sum([low_count, low_moderate_count, moderate_count, high_count])
@@ -308,10 +248,8 @@ class TSDMSummary(QgsProcessingAlgorithm):
                 check_sum]
     
     
-    def tsdm_percentile_counts(self, raster):
-        below_average_count = ((raster >= 0)&(raster <= 30)).sum()
-        average_count = ((raster > 30)&(raster <= 70)).sum()
-        above_average_count = ((raster > 70)&(raster <= 100)).sum()
+    def tsdm_percentile_counts(self, class_counts):
+        below_average_count, average_count, above_average_count = class_counts
         #firescar_count = (raster == 253).sum()
         #water_count = (raster == 254).sum()
         #no_data_count = (raster == -999).sum()
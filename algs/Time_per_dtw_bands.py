@@ -11,10 +11,13 @@ from qgis.core import (QgsFeature, QgsFeatureRequest,
                         QgsProcessingParameterField,
                         QgsProcessingParameterString,
                         QgsProcessingParameterFileDestination,
-                        QgsProcessingMultiStepFeedback)
+                        QgsProcessingMultiStepFeedback, NULL)
                         
-import processing
-
+from collar_tracks import day_groups, fix_times
+from watered_bands import WateredBands
+import processing
+import numpy as np
+
 import os
 
                        
@@ -140,9 +143,10 @@ class TimePerWateredBand(QgsProcessingAlgorithm):
         
         output_path = self.parameterAsString(parameters, self.OUTPUT_XLSX, context)
         
-        all_bands = sorted(dtw_band_lyr.uniqueValues(dtw_band_lyr.fields().lookupField(watered_band_field)))
+        # Band names, geometries & distance intervals are read once
+        bands = WateredBands(dtw_band_lyr, watered_band_field)
         
-        all_dates = list(set([v.date() for v in gps_lyr.uniqueValues(gps_lyr.fields().lookupField(datetime_field))]))
+        all_bands = sorted(bands.keys)
             
         temp_lyr = QgsVectorLayer('None', '', 'memory')
         temp_flds = QgsFields()
@@ -165,69 +169,60 @@ class TimePerWateredBand(QgsProcessingAlgorithm):
         #Incrementally sum daily time ranges (will be written to last row of spreadsheet)
         all_t_ranges = 0
         
-        all_dtw_band_times = {ft[watered_band_field]: 0 for ft in dtw_band_lyr.getFeatures()}
+        # Minutes in each band (in bands.keys order) for all dates
+        all_dtw_band_times = np.zeros(len(bands))
         
-        total = len(all_dates)
-        for idx, date in enumerate(sorted(all_dates)):############################SORTED DATE LIST
+        # The gps layer is read once, in chronological order, one date at a time
+        gps_request = QgsFeatureRequest().setSubsetOfAttributes([datetime_field, dtw_field], gps_lyr.fields())
+        for date, date_feats_chronological in day_groups(gps_lyr, datetime_field, feedback, gps_request):
             if feedback.isCanceled():
                 return {}
-            pcnt = ((idx+1)/total)*100
-            feedback.setProgress(pcnt)
-            date_fts = [ft for ft in gps_lyr.getFeatures() if ft[datetime_field].date() == date]
-            date_feats_chronological = sorted(date_fts, key=lambda ft: ft[datetime_field])
-
-            t1 = date_feats_chronological[0][datetime_field]
-            tn = date_feats_chronological[-1][datetime_field]
-            t_range_secs = t1.secsTo(tn)
+            t = fix_times(date_feats_chronological, datetime_field)
+            t_range_secs = float(t[-1]-t[0])
             all_t_ranges += t_range_secs
             t_range = t_range_secs/3600# (Hrs) Write to Total time field
 
-            dtw_band_times = {}
-
-            for feat in dtw_band_lyr.getFeatures():
-                dtw_band_times[feat[watered_band_field]] = 0
-                            
-            min_idx = 0
-            max_idx = len(date_feats_chronological)-1
-
-            for i in range(min_idx, max_idx):
-                if feedback.isCanceled():
-                    return {}
+            dtw_band_times = np.zeros(len(bands))
+            
+            dtws = [np.nan if ft[dtw_field] == NULL else ft[dtw_field] for ft in date_feats_chronological]
+            band_idxs = bands.band_indices(dtws)
+            current_bands = band_idxs[:-1]
+            next_bands = band_idxs[1:]
+            delta_t_mins = np.diff(t)/60
+            
+            outside = (current_bands < 0) | (next_bands < 0)
+            if outside.any():
+                feedback.pushWarning(f'{int(outside.sum())} pairs of GPS features on {date.toString("d/M/yyyy")} have a distance to water outside all watered bands and were skipped')
+            
+            # Consecutive points in the same band: all of the time delta is spent in that band
+            same_band = (current_bands == next_bands) & ~outside
+            np.add.at(dtw_band_times, current_bands[same_band], delta_t_mins[same_band])
+            
+            for i in np.flatnonzero((current_bands != next_bands) & ~outside).tolist():
+                # Get dtw band geometry which contains the current gps ft,
+                # construct a line between current and next ft,
+                # intersect the line geom with dtw band polygon geom, to get % in each band,
+                # then calculate approximate time in each different band based on
+                # time delta between the two consecutive points.
                 ft = date_feats_chronological[i]
                 next_ft = date_feats_chronological[i+1]
-                current_band = self.get_dtw_band_key(dtw_band_times, ft[dtw_field])
-                next_band = self.get_dtw_band_key(dtw_band_times, next_ft[dtw_field])
-                if current_band == next_band:
-                    delta_t_mins = (ft[datetime_field].secsTo(next_ft[datetime_field]))/60
-                    dtw_band_times[current_band]+=delta_t_mins
-                    all_dtw_band_times[current_band]+=delta_t_mins
-                elif current_band != next_band:
-                    # Get dtw band feature which contains the current gps ft,
-                    # construct a line between current and next ft,
-                    # difference the line geom with dtw band polygon geom, to get % in each band,
-                    # then calculate approximate time in each different band based on
-                    # time delta between the two consecutive points.
-                    current_pt = ft.geometry().asPoint() # QgsPointXY
-                    next_pt = next_ft.geometry().asPoint() # QgsPointXY
-                    current_dtw_band_ft = [ft for ft in dtw_band_lyr.getFeatures() if ft[watered_band_field] == current_band][0]
-                    current_band_geom = current_dtw_band_ft.geometry()
-                    next_dtw_band_ft = [ft for ft in dtw_band_lyr.getFeatures() if ft[watered_band_field] == next_band][0]
-                    next_band_geom = next_dtw_band_ft.geometry()
-                    line_geom = QgsGeometry.fromPolylineXY([current_pt, next_pt])
-                    if (not line_geom.intersects(current_band_geom)) and (not line_geom.intersects(next_band_geom)):
-                        feedback.pushWarning(f'GPS features {ft.id()} & {next_ft.id()} are not within a watered band in the supplied layer')####
-                    line_in_current_band = line_geom.intersection(current_band_geom)
-                    current_factor = line_in_current_band.length()/line_geom.length()
+                current_band = current_bands[i]
+                next_band = next_bands[i]
+                current_pt = ft.geometry().asPoint() # QgsPointXY
+                next_pt = next_ft.geometry().asPoint() # QgsPointXY
+                line_geom = QgsGeometry.fromPolylineXY([current_pt, next_pt])
+                if (not bands.engine(current_band).intersects(line_geom.constGet())) and (not bands.engine(next_band).intersects(line_geom.constGet())):
+                    feedback.pushWarning(f'GPS features {ft.id()} & {next_ft.id()} are not within a watered band in the supplied layer')####
+                line_in_current_band = line_geom.intersection(bands.geometries[current_band])
+                current_factor = line_in_current_band.length()/line_geom.length()
 
-                    delta_t_mins = (ft[datetime_field].secsTo(next_ft[datetime_field]))/60
-                    time_in_current_band = delta_t_mins*current_factor
-                    time_in_next_band = delta_t_mins-time_in_current_band
+                time_in_current_band = delta_t_mins[i]*current_factor
+                time_in_next_band = delta_t_mins[i]-time_in_current_band
 
-                    dtw_band_times[current_band]+=time_in_current_band
-                    dtw_band_times[next_band]+=time_in_next_band
-
-                    all_dtw_band_times[current_band]+=time_in_current_band
-                    all_dtw_band_times[next_band]+=time_in_next_band
+                dtw_band_times[current_band]+=time_in_current_band
+                dtw_band_times[next_band]+=time_in_next_band
+                
+            all_dtw_band_times += dtw_band_times
                     
             # For each date, create a feature and write attributes
             feat = QgsFeature(temp_lyr.fields())
@@ -236,12 +231,15 @@ class TimePerWateredBand(QgsProcessingAlgorithm):
                     date.toString('d/M/yyyy'),
                     round(t_range, 4)]
             checksum = 0
-            for k, v in dtw_band_times.items():
+            for v in dtw_band_times.tolist():
                 atts.append(round(v/60, 2))
                 checksum+=v/60
             atts.append(round(checksum, 4))
             feat.setAttributes(atts)
             output_feats.append(feat)
+        # day_groups() stops quietly when canceled, so check again after the loop
+        if feedback.isCanceled():
+            return {}
         #######################################################
         # Add final feature with totals for all dates in collar period
         # Retrieve from all_dtw_band_times
@@ -252,7 +250,7 @@ class TimePerWateredBand(QgsProcessingAlgorithm):
                 'All Dates',
                 round(all_t_ranges/3600, 4)]
         total_checksum = 0
-        for k, v in all_dtw_band_times.items():
+        for v in all_dtw_band_times.tolist():
             total_atts.append(round(v/60, 2))
             total_checksum+=v/60
         total_atts.append(round(total_checksum, 4))
@@ -299,9 +297,3 @@ class TimePerWateredBand(QgsProcessingAlgorithm):
                 dtw_layer = gps_collar_lyr.materialize(QgsFeatureRequest())
                 return [gps_layer, dtw_layer]
             
-    def get_dtw_band_key(self, in_dict, dtw):
-        for k in in_dict.keys():
-            inner_dist = int(k.split('-')[0])
-            outer_dist = int(k.split('-')[1][:-1])
-            if inner_dist < dtw < outer_dist:
-                return k
\ No newline at end of file
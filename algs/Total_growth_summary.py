@@ -7,10 +7,14 @@ from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsFeature,
                         QgsProcessingParameterVectorLayer, QgsVectorLayer,
                         QgsProcessingParameterMatrix,
                         QgsProcessingParameterFileDestination,
-                        QgsProcessingMultiStepFeedback)
+                        QgsProcessingParameterBoolean,
+                        QgsProcessingParameterDefinition,
+                        QgsProcessingMultiStepFeedback)
                         
 from processing.gui.wrappers import WidgetWrapper
-from osgeo import gdalnumeric
+from zonal_stats import zonal_class_counts
+from zone_cache import cached_district_zone_grid
+from class_bins import scale_bins, scale_error
 import processing
 import os
                        
@@ -19,6 +23,7 @@ class TotalGrowthSummary(QgsProcessingAlgorithm):
     DISTRICT_LAYER = 'DISTRICT_LAYER'
     CUSTOM_PARAMS = 'CUSTOM_PARAMS'
     OUTPUT_XLSX = 'OUTPUT_XSLX'
+    PARALLEL = 'PARALLEL'
  
     def __init__(self):
         super().__init__()
@@ -57,13 +62,18 @@ class TotalGrowthSummary(QgsProcessingAlgorithm):
         custom_params.setMetadata({'widget_wrapper': {'class': CustomParametersWidgetWrapper}})
         self.addParameter(custom_params)
         
+        self.addParameter(QgsProcessingParameterBoolean(self.PARALLEL, 'Count pixels in parallel processes (uses all CPU cores)', defaultValue=False))
+        self.parameterDefinition(self.PARALLEL).setFlags(QgsProcessingParameterDefinition.FlagAdvanced)
+        
         self.addParameter(QgsProcessingParameterFileDestination(self.OUTPUT_XLSX, 'Total growth summary spreadsheet', 'Microsoft Excel (*.xlsx);;Open Document Spreadsheet (*.ods)'))
 
     def checkParameterValues(self, parameters, context):
         scale_vals, regions = self.parameterAsMatrix(parameters, self.CUSTOM_PARAMS, context)
-        custom_value_list = scale_vals['Custom Scale']
-        if 'Custom' in regions.values() and custom_value_list == [0, 0, 0, 0]:
-            return False, 'A custom scale with invalid values is set for one or more districts.'
+        # every scale used by a district must give strictly increasing bin edges
+        for region in sorted(set(regions.values())):
+            error = scale_error(f'{region} Scale', scale_vals[f'{region} Scale'])
+            if error is not None:
+                return False, error
         return super().checkParameterValues(parameters, context)
  
     def processAlgorithm(self, parameters, context, model_feedback):
@@ -74,6 +84,7 @@ class TotalGrowthSummary(QgsProcessingAlgorithm):
         monthly_growth_folder = self.parameterAsString(parameters, self.INPUT_FOLDER, context)
         districts = self.parameterAsVectorLayer(parameters, self.DISTRICT_LAYER, context)
         destination_spreadsheet = parameters[self.OUTPUT_XLSX]
+        workers = 0 if self.parameterAsBool(parameters, self.PARALLEL, context) else 1
         ####################################################################
         '''
         scale_vals is a dictionary like: {'Northern Scale': [0, 1000, 2000, 3000], 'Southern Scale': [0, 250, 500, 1000]}
@@ -101,17 +112,6 @@ class TotalGrowthSummary(QgsProcessingAlgorithm):
             'V.R.D.': 'northern',
             'Victoria River': 'northern'}
         '''
-        ###Create temporary copy of district layer#########################
-        temp_districts = QgsVectorLayer(f'polygon?&crs={districts.crs().authid()}', 'Temp_Districts', 'memory')
-        temp_districts.dataProvider().addAttributes(districts.fields())
-        temp_districts.updateFields()
-        for f in districts.getFeatures():
-            feat = QgsFeature()
-            feat.setGeometry(f.geometry())
-            feat.setAttributes(f.attributes())
-            temp_districts.dataProvider().addFeatures([feat])
-        ####################################################################
-        
         input_rasters = []
 
         for file in os.scandir(monthly_growth_folder):
@@ -119,7 +119,7 @@ class TotalGrowthSummary(QgsProcessingAlgorithm):
                 raster_path = os.path.join(monthly_growth_folder, file.name)
                 input_rasters.append(raster_path)
                 
-        steps = 13
+        steps = 4
         feedback = QgsProcessingMultiStepFeedback(steps, model_feedback)
         step = 1
         
@@ -137,8 +137,6 @@ class TotalGrowthSummary(QgsProcessingAlgorithm):
         outputs['total_growth_raster'] = processing.run('native:cellstatistics', cell_sum_params, context=context, feedback=feedback, is_child_algorithm=True)
         results['total_growth_raster'] = outputs['total_growth_raster']['OUTPUT']
         
-        district_names = [f['DISTRICT'] for f in temp_districts.getFeatures()]
-        
         total_growth_temp = QgsVectorLayer('Point', 'Total Growth Summary', 'memory')
         total_growth_temp.dataProvider().addAttributes([
             QgsField('District', QVariant.String),
@@ -154,35 +152,28 @@ class TotalGrowthSummary(QgsProcessingAlgorithm):
         ])
         total_growth_temp.updateFields()
         
-        for district_name in district_names:
-            
-            temp_districts.setSubsetString(f""""DISTRICT" LIKE '{district_name}'""")
-            
-            mask_params = {'INPUT':results['total_growth_raster'],
-                'MASK':temp_districts,
-                'SOURCE_CRS':None,
-                'TARGET_CRS':None,
-                'NODATA':-999,
-                'ALPHA_BAND':False,
-                'CROP_TO_CUTLINE':True,
-                'KEEP_RESOLUTION':False,
-                'SET_RESOLUTION':False,
-                'X_RESOLUTION':None,
-                'Y_RESOLUTION':None,
-                'MULTITHREADING':False,
-                'OPTIONS':'',
-                'DATA_TYPE':0,
-                'EXTRA':'',
-                'OUTPUT':'TEMPORARY_OUTPUT'}
-            
-            feedback.setCurrentStep(step)
-            step+=1
-            outputs[f'clipped_to_{district_name}'] = processing.run("gdal:cliprasterbymasklayer", mask_params, context=context, feedback=feedback, is_child_algorithm=True)
-            results[f'clipped_to_{district_name}'] = outputs[f'clipped_to_{district_name}']['OUTPUT']
-            
-            raster1 = gdalnumeric.LoadFile(results[f'clipped_to_{district_name}'])
+        ###Get (cached) zone grid of districts aligned to the total growth raster###
+        feedback.setCurrentStep(step)
+        step+=1
+        zone_ds, district_names = cached_district_zone_grid(districts, 'DISTRICT', results['total_growth_raster'], context.transformContext(), feedback)
+        
+        ###Count total growth classes for every district in one read###########
+        region_scales = {'Northern': northern_value_list,
+                        'Southern': southern_value_list,
+                        'Custom': custom_value_list}
+        used_regions = set(regions[district_name] for district_name in district_names)
+        growth_bins = {region: scale_bins(region_scales[region]) for region in used_regions}
+        feedback.setCurrentStep(step)
+        step+=1
+        zone_counts = zonal_class_counts(results['total_growth_raster'], zone_ds, len(district_names), growth_bins, feedback, workers)
+        zone_ds = None
+        if feedback.isCanceled():
+            # counts stop at the cancelled block, so they are incomplete
+            return {}
+        
+        for i, district_name in enumerate(district_names):
             region = regions[district_name]
-            count_results = self.total_growth_counts(raster1, region, northern_value_list, southern_value_list, custom_value_list)
+            count_results = self.total_growth_counts(zone_counts[region][i])
             feat = QgsFeature()
             feat.setAttributes([
                     district_name,
@@ -213,46 +204,10 @@ class TotalGrowthSummary(QgsProcessingAlgorithm):
 
 ##############################################################################
         
-    def total_growth_counts(self, raster, region, northern_scale_vals, southern_scale_vals, custom_scale_vals):
-        if region == 'Northern':
-            # Northern Districts
-            northern_val_bottom = northern_scale_vals[0] #zero
-            northern_val_low = northern_scale_vals[1] # e.g. 1000
-            northern_val_mod = northern_scale_vals[2] # e.g. 2000
-            northern_val_high = northern_scale_vals[3] # e.g. 3000
-            
-            low_count = ((raster >= northern_val_bottom)&(raster <= northern_val_low)).sum()
-            low_moderate_count = ((raster > northern_val_low)&(raster <= northern_val_mod)).sum()
-            moderate_count = ((raster > northern_val_mod)&(raster <= northern_val_high)).sum()
-            high_count = (raster > northern_val_high).sum()
-            #no_data_count = (raster == -999).sum()
-
-        elif region == 'Southern':
-            # Southern Districts
-            southern_val_bottom = southern_scale_vals[0] #zero
-            southern_val_low = southern_scale_vals[1] # e.g. 250
-            southern_val_mod = southern_scale_vals[2] # e.g. 500
-            southern_val_high = southern_scale_vals[3] # e.g. 1000
-            
-            low_count = ((raster >= southern_val_bottom)&(raster <= southern_val_low)).sum()
-            low_moderate_count = ((raster > southern_val_low)&(raster <= southern_val_mod)).sum()
-            moderate_count = ((raster > southern_val_mod)&(raster <= southern_val_high)).sum()
-            high_count = (raster > southern_val_high).sum()
-            #no_data_count = (raster == -999).sum()
-            
-        elif region == 'Custom':
-            # Custom scale
-            custom_val_bottom = custom_scale_vals[0] #zero
-            custom_val_low = custom_scale_vals[1] # e.g. 250
-            custom_val_mod = custom_scale_vals[2] # e.g. 500
-            custom_val_high = custom_scale_vals[3] # e.g. 1000
-            
-            low_count = ((raster >= custom_val_bottom)&(raster <= custom_val_low)).sum()
-            low_moderate_count = ((raster > custom_val_low)&(raster <= custom_val_mod)).sum()
-            moderate_count = ((raster > custom_val_mod)&(raster <= custom_val_high)).sum()
-            high_count = (raster > custom_val_high).sum()
-            #no_data_count = (raster == -999).sum()
-
+    def total_growth_counts(self, class_counts):
+        low_count, low_moderate_count, moderate_count, high_count = class_counts
+        #no_data_count = (raster == -999).sum()
+
         #total_pixel_count = sum([low_count, low_moderate_count, moderate_count, high_count, no_data_count])
         total_pixel_count = sum([low_count, low_moderate_count, moderate_count, high_count])
 
@@ -0,0 +1,149 @@
+'''
+Distance to water bands (dissolved buffer rings) around the waterpoints of a
+paddock, clipped to the paddock.
+
+Each dissolved buffer is computed once, by buffering all waterpoints as a
+single multipoint geometry (GEOS dissolves the buffers as it builds them),
+and the outer buffer of one band is reused as the inner buffer of the next.
+Bands are tested against a prepared paddock geometry, so only bands which
+reach the paddock are intersected with it.
+For paddocks with many waterpoints or narrow bands, raster_bands() instead
+classifies a Euclidean distance transform of a grid over the paddock, so
+band areas come from pixel counts and no buffers are built at all.
+'''
+
+from qgis.core import QgsGeometry
+
+from virtual_rasters import memory_raster
+from osgeo import gdal, ogr
+import numpy as np
+import math
+
+# buffer segments per quarter circle
+SEGMENTS = 25
+# maximum number of bands per paddock
+MAX_BANDS = 500
+
+
+def distance_bands(waterpoint_geoms, pdk_geom, band_width, segments=SEGMENTS, max_bands=MAX_BANDS):
+    '''Returns a list of (inner distance, outer distance, band geometry
+    clipped to pdk_geom) for each band of band_width around
+    waterpoint_geoms, from the waterpoints out. The first band is the
+    dissolved buffer of the waterpoints; bands continue until one no longer
+    intersects the paddock (or max_bands is reached). The first band is
+    left out if it does not intersect the paddock. The maximum distance to
+    water in the paddock is the outer distance of the last band (or
+    band_width if there are none).'''
+    if not waterpoint_geoms:
+        return []
+    pdk_engine = QgsGeometry.createGeometryEngine(pdk_geom.constGet())
+    pdk_engine.prepareGeometry()
+    waterpoints = QgsGeometry.collectGeometry(waterpoint_geoms)
+    bands = []
+    inner_buffer = None
+    for band_count in range(1, max_bands+1):
+        outer_distance = band_count*band_width
+        outer_buffer = waterpoints.buffer(outer_distance, segments)
+        band = outer_buffer if inner_buffer is None else outer_buffer.difference(inner_buffer)
+        if pdk_engine.intersects(band.constGet()):
+            bands.append((outer_distance-band_width, outer_distance, band.intersection(pdk_geom)))
+        elif inner_buffer is not None:
+            break
+        inner_buffer = outer_buffer
+    return bands
+
+
+def geometry_from_wkb(wkb):
+    '''Returns a QgsGeometry from WKB bytes'''
+    geom = QgsGeometry()
+    geom.fromWkb(wkb)
+    return geom
+
+
+def burned_raster(geoms, x_size, y_size, geotransform, crs_wkt):
+    '''Returns a byte MEM dataset with 1 in the cells of geoms (QgsGeometry
+    list) and 0 elsewhere'''
+    ogr_ds = ogr.GetDriverByName('Memory').CreateDataSource('geoms')
+    ogr_lyr = ogr_ds.CreateLayer('geoms', geom_type=ogr.wkbUnknown)
+    for geom in geoms:
+        ogr_feat = ogr.Feature(ogr_lyr.GetLayerDefn())
+        ogr_feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geom.asWkb())))
+        ogr_lyr.CreateFeature(ogr_feat)
+    ds = memory_raster(x_size, y_size, geotransform, crs_wkt, gdal.GDT_Byte, init=0)
+    gdal.RasterizeLayer(ds, [1], ogr_lyr, burn_values=[1])
+    return ds
+
+
+def raster_bands(waterpoint_geoms, pdk_geom, band_width, cell_size, crs_wkt, polygonize=False, max_bands=MAX_BANDS):
+    '''Returns a list of (inner distance, outer distance, band geometry,
+    area, percent of paddock) for each band of band_width around
+    waterpoint_geoms (which should be inside the paddock), from a distance
+    transform of a grid of cell_size over pdk_geom. A cell is in the paddock
+    when its centre is, and in the band containing the distance from its
+    centre to the centre of the nearest waterpoint cell. Areas and
+    percentages come from cell counts. Band geometries are the polygonized
+    cells of each band if polygonize is True, otherwise None.'''
+    extent = pdk_geom.boundingBox()
+    x_size = max(1, math.ceil(extent.width()/cell_size))
+    y_size = max(1, math.ceil(extent.height()/cell_size))
+    geotransform = (extent.xMinimum(), cell_size, 0, extent.yMaximum(), 0, -cell_size)
+    in_paddock = burned_raster([pdk_geom], x_size, y_size, geotransform, crs_wkt).ReadAsArray() == 1
+    water_ds = burned_raster(waterpoint_geoms, x_size, y_size, geotransform, crs_wkt)
+    if not in_paddock.any() or not water_ds.ReadAsArray().any():
+        return []
+    dist_ds = memory_raster(x_size, y_size, geotransform, crs_wkt, gdal.GDT_Float32)
+    gdal.ComputeProximity(water_ds.GetRasterBand(1), dist_ds.GetRasterBand(1), ['VALUES=1', 'DISTUNITS=GEO'])
+    # band number of each cell: 1 up to band_width (inclusive), 2 up to 2*band_width...
+    # and 0 outside the paddock
+    band_grid = np.ceil(dist_ds.ReadAsArray()/band_width).astype(np.int64)
+    band_grid = np.maximum(band_grid, 1)
+    band_grid[~in_paddock | (band_grid > max_bands)] = 0
+    water_ds = None
+    dist_ds = None
+    counts = np.bincount(band_grid.ravel(), minlength=2)
+    paddock_count = counts[1:].sum()
+    if not paddock_count:
+        return []
+    geoms = {}
+    if polygonize:
+        band_ds = memory_raster(x_size, y_size, geotransform, crs_wkt, gdal.GDT_UInt16, init=0)
+        band_ds.GetRasterBand(1).WriteArray(band_grid.astype(np.uint16))
+        ogr_ds = ogr.GetDriverByName('Memory').CreateDataSource('bands')
+        ogr_lyr = ogr_ds.CreateLayer('bands', geom_type=ogr.wkbPolygon)
+        ogr_lyr.CreateField(ogr.FieldDefn('band', ogr.OFTInteger))
+        # cells outside the paddock (0) are masked out
+        gdal.Polygonize(band_ds.GetRasterBand(1), band_ds.GetRasterBand(1), ogr_lyr, 0)
+        parts = {}
+        for ogr_feat in ogr_lyr:
+            geom = geometry_from_wkb(bytes(ogr_feat.GetGeometryRef().ExportToWkb()))
+            parts.setdefault(ogr_feat.GetField(0), []).append(geom)
+        geoms = {band: QgsGeometry.collectGeometry(band_parts) for band, band_parts in parts.items()}
+        band_ds = None
+    bands = []
+    for band in np.flatnonzero(counts).tolist():
+        if band == 0:
+            continue
+        area = counts[band]*cell_size*cell_size
+        bands.append(((band-1)*band_width, band*band_width, geoms.get(band), area, counts[band]/paddock_count*100))
+    return bands
+
+
+def paddock_bands(waterpoint_geoms, pdk_geom, band_width, cell_size=None, crs_wkt=None, polygonize=False):
+    '''Returns a list of (inner distance, outer distance, band geometry,
+    area, percent of paddock) for each band around waterpoint_geoms in
+    pdk_geom: from raster_bands() if cell_size is given, otherwise from
+    distance_bands()'''
+    if cell_size:
+        return raster_bands(waterpoint_geoms, pdk_geom, band_width, cell_size, crs_wkt, polygonize)
+    pdk_area = pdk_geom.area()
+    return [(inner_distance, outer_distance, clipped_to_pdk, clipped_to_pdk.area(), clipped_to_pdk.area()/pdk_area*100)
+            for inner_distance, outer_distance, clipped_to_pdk in distance_bands(waterpoint_geoms, pdk_geom, band_width)]
+
+
+def paddock_bands_job(waterpoint_wkbs, pdk_wkb, band_width, cell_size=None, crs_wkt=None, polygonize=False):
+    '''Process pool job: paddock_bands() of WKB geometries, with band
+    geometries returned as WKB (or None)'''
+    bands = paddock_bands([geometry_from_wkb(wkb) for wkb in waterpoint_wkbs], geometry_from_wkb(pdk_wkb),
+                          band_width, cell_size, crs_wkt, polygonize)
+    return [(inner_distance, outer_distance, None if geom is None else bytes(geom.asWkb()), area, pcnt)
+            for inner_distance, outer_distance, geom, area, pcnt in bands]
@@ -0,0 +1,70 @@
+'''
+Table driven classification of raster pixel values into category bins.
+
+A category scale is described by a list of bin edges and a list of special
+values (e.g. water or firescar codes), so adding or changing a scale is a
+matter of configuration. Pixel values are classified with a single
+np.digitize pass, and counted with a single np.bincount pass.
+'''
+
+import numpy as np
+
+
+class ClassBins:
+    '''Bin i holds values in (edges[i], edges[i+1]]. If include_lowest is True
+    bin 0 also holds edges[0] itself, i.e. [edges[0], edges[1]]. Use np.inf as
+    the last edge for an open ended top bin.
+    Class indices are numbered bins first, then special values in the order
+    given, and values matching neither (or NaN) get the index class_count so
+    that they drop out of a bincount. Special values take precedence over
+    bins.'''
+
+    def __init__(self, edges, special_values=(), include_lowest=False):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        if not edges_increase(self.edges.tolist()):
+            raise ValueError(f'Bin edges must be strictly increasing: {list(edges)}')
+        self.special_values = np.asarray(special_values, dtype=np.float64)
+        self.include_lowest = include_lowest
+        self.bin_count = len(self.edges)-1
+        self.class_count = self.bin_count+len(self.special_values)
+        # sorted special values and their class index, for a searchsorted lookup
+        special_order = np.argsort(self.special_values)
+        self._sorted_specials = self.special_values[special_order]
+        self._special_classes = self.bin_count+special_order
+
+    def classify(self, values):
+        '''Returns an integer array of class indices, the same shape as values'''
+        classes = np.digitize(values, self.edges, right=True)-1
+        if self.include_lowest:
+            classes[values == self.edges[0]] = 0
+        classes[(classes < 0)|(classes >= self.bin_count)] = self.class_count
+        if len(self.special_values):
+            is_special = np.isin(values, self._sorted_specials)
+            special_idx = np.searchsorted(self._sorted_specials, values[is_special])
+            classes[is_special] = self._special_classes[special_idx]
+        return classes
+
+    def counts(self, values):
+        '''Returns the pixel count of each class (bins then special values)'''
+        classes = self.classify(np.asarray(values)).ravel()
+        return np.bincount(classes, minlength=self.class_count+1)[:self.class_count]
+
+
+def edges_increase(edges):
+    '''True if edges are strictly increasing, as ClassBins needs'''
+    return len(edges) >= 2 and all(low < high for low, high in zip(edges[:-1], edges[1:]))
+
+
+def scale_error(scale_name, scale_vals):
+    '''Returns a message describing why a regional scale can't be used as
+    bins (see scale_bins()), or None if it can'''
+    if edges_increase(list(scale_vals)):
+        return None
+    return f'The {scale_name} values must increase from one category to the next (got {list(scale_vals)}).'
+
+
+def scale_bins(scale_vals):
+    '''ClassBins for a regional scale [bottom, low, mod, high] as set in the
+    custom scale widgets: low [bottom, low], low-moderate (low, mod],
+    moderate (mod, high] and high (> high)'''
+    return ClassBins(list(scale_vals)+[np.inf], include_lowest=True)
@@ -0,0 +1,157 @@
+'''
+Helpers for processing GPS collar fixes one day at a time.
+
+Fixes are read in a single pass over the source, ordered by their datetime
+attribute, and handed out in day groups, so that processing time is linear
+in the number of fixes and only one day of features is held in memory.
+Layers holding many collars are read in the same way, ordered by collar and
+then datetime, and handed out as coordinate and time arrays per collar.
+'''
+
+from qgis.core import QgsExpression, QgsFeatureRequest, NULL
+
+import numpy as np
+import re
+
+# consecutive fixes less than this many seconds apart are not used for distance and speed stats
+MIN_TIME_GAP = 300
+# longest sheet name Excel allows
+SHEET_NAME_LENGTH = 31
+
+
+def chronological_request(datetime_field, request=None):
+    '''Returns request (or a new request) ordered by datetime_field, ascending'''
+    if request is None:
+        request = QgsFeatureRequest()
+    request.addOrderBy(QgsExpression.quotedColumnRef(datetime_field), True)
+    return request
+
+
+def day_groups(source, datetime_field, feedback=None, request=None):
+    '''Generator of (QDate, [features]) for each date with fixes in source
+    (a vector layer or feature source), in date order. The features of each
+    day are in chronological order. Features without a datetime are skipped.
+    request may be used to limit the attributes or features which are read.'''
+    total = source.featureCount()
+    day_date = None
+    day_feats = []
+    for current, ft in enumerate(source.getFeatures(chronological_request(datetime_field, request))):
+        if feedback is not None:
+            if feedback.isCanceled():
+                return
+            if total > 0:
+                feedback.setProgress(round((current+1)/total*100, 1))
+        ft_datetime = ft[datetime_field]
+        if ft_datetime == NULL or ft_datetime is None:
+            continue
+        ft_date = ft_datetime.date()
+        if ft_date != day_date:
+            if day_feats:
+                yield day_date, day_feats
+            day_date = ft_date
+            day_feats = []
+        day_feats.append(ft)
+    if day_feats:
+        yield day_date, day_feats
+
+
+def collar_fixes(source, datetime_field, collar_field=None, paddock_field=None, feedback=None):
+    '''Generator of (collar id, paddock, x, y, t, days) for each collar in
+    source, where x and y are arrays of fix coordinates in the source CRS, t
+    the fix times in seconds since the epoch and days the Julian day of each
+    fix, in chronological order. Without a collar_field every fix belongs to
+    one collar (with id None). paddock is the paddock_field value of the
+    first fix of the collar, or None. Features without a datetime or
+    geometry are skipped.'''
+    fields = [fld for fld in (datetime_field, collar_field, paddock_field) if fld]
+    request = QgsFeatureRequest().setSubsetOfAttributes(fields, source.fields())
+    if collar_field:
+        request.addOrderBy(QgsExpression.quotedColumnRef(collar_field), True)
+    chronological_request(datetime_field, request)
+    total = source.featureCount()
+    collar_id = None
+    paddock = None
+    x, y, t, days = [], [], [], []
+    for current, ft in enumerate(source.getFeatures(request)):
+        if feedback is not None:
+            if feedback.isCanceled():
+                return
+            if total > 0:
+                feedback.setProgress(round((current+1)/total*100, 1))
+        ft_datetime = ft[datetime_field]
+        if ft_datetime == NULL or ft_datetime is None or ft.geometry().isEmpty():
+            continue
+        ft_collar = ft[collar_field] if collar_field else None
+        if ft_collar != collar_id or not t:
+            if t:
+                yield collar_id, paddock, np.array(x), np.array(y), np.array(t, dtype=np.float64), np.array(days)
+            collar_id = ft_collar
+            paddock = ft[paddock_field] if paddock_field else None
+            x, y, t, days = [], [], [], []
+        # first vertex of Point and MultiPoint geometries alike
+        pt = ft.geometry().vertexAt(0)
+        x.append(pt.x())
+        y.append(pt.y())
+        t.append(ft_datetime.toSecsSinceEpoch())
+        days.append(ft_datetime.date().toJulianDay())
+    if t:
+        yield collar_id, paddock, np.array(x), np.array(y), np.array(t, dtype=np.float64), np.array(days)
+
+
+def fix_times(features, datetime_field):
+    '''Returns an array of the datetimes of features in seconds since the epoch'''
+    return np.array([ft[datetime_field].toSecsSinceEpoch() for ft in features], dtype=np.float64)
+
+
+def segment_stats(x, y, t, min_gap=MIN_TIME_GAP):
+    '''Returns arrays of time gaps (seconds), distances (map units) and speeds
+    (km/h if map units are meters) between consecutive fixes at (x, y) at
+    times t, for segments whose time gap is at least min_gap seconds'''
+    gaps = np.diff(t)
+    distances = np.hypot(np.diff(x), np.diff(y))
+    keep = gaps >= min_gap
+    gaps = gaps[keep]
+    distances = distances[keep]
+    return gaps, distances, distances/gaps*3.6
+
+
+def daily_stats(x, y, t, days, min_gap=MIN_TIME_GAP):
+    '''Returns a list of (Julian day, first fix index, end fix index, total
+    distance, max time gap, min distance, max distance, mean distance, min
+    speed, max speed, mean speed) for each day of one collar's fixes (arrays
+    as yielded by collar_fixes() with x and y in a projected CRS). Days with
+    fewer than two fixes are left out. Distance and speed stats only use
+    segments with a time gap of at least min_gap seconds, and are 0 when a day
+    has none. Plain numpy, so it can run in a worker process.'''
+    stats = []
+    breaks = np.flatnonzero(np.diff(days))+1
+    for start, end in zip(np.r_[0, breaks], np.r_[breaks, len(days)]):
+        if end-start < 2:
+            continue
+        total_distance = float(np.hypot(np.diff(x[start:end]), np.diff(y[start:end])).sum())
+        gaps, distances, speeds = segment_stats(x[start:end], y[start:end], t[start:end], min_gap)
+        if not gaps.size:
+            stats.append((int(days[start]), int(start), int(end), total_distance, 0, 0, 0, 0, 0, 0, 0))
+            continue
+        stats.append((int(days[start]), int(start), int(end), total_distance,
+                      float(gaps.max()),
+                      float(distances.min()), float(distances.max()), float(distances.mean()),
+                      float(speeds.min()), float(speeds.max()), float(speeds.mean())))
+    return stats
+
+
+def sheet_name(collar_no, paddock, used_names):
+    '''Returns a spreadsheet sheet name of at most SHEET_NAME_LENGTH
+    characters for the tracks of a collar: the collar id, then as much of the
+    paddock name as fits, with a numbered suffix if it would otherwise repeat
+    one of used_names (Excel sheet names are not case sensitive). The name is
+    added to used_names.'''
+    # characters which Excel does not allow in sheet names
+    name = re.sub(r'[\[\]:*?/\\]', '_', f'{collar_no}_{paddock}')
+    unique_name = name[:SHEET_NAME_LENGTH]
+    suffix = 1
+    while unique_name.lower() in used_names:
+        suffix += 1
+        unique_name = name[:SHEET_NAME_LENGTH-len(f'_{suffix}')]+f'_{suffix}'
+    used_names.add(unique_name.lower())
+    return unique_name
@@ -0,0 +1,113 @@
+'''
+Fast parsing of date and time strings with strptime style formats.
+
+datetime.strptime() interprets its format again for every string it parses.
+datetime_parser() looks at the format once and returns a parse function:
+ISO 8601 formats are parsed with datetime.fromisoformat(), other formats made
+up of numeric directives with a regular expression compiled once, and
+anything else with strptime(). Strings which do not match fall back to
+strptime(), so errors are the same as before. Date fields in collar data
+repeat the same few values millions of times, so parsed values can also be
+kept in a cache.
+'''
+
+from datetime import datetime
+import functools
+import re
+
+# format (without an optional trailing literal Z): length of the string
+ISO_FORMATS = {'%Y-%m-%d': 10,
+               '%Y-%m-%d %H:%M:%S': 19,
+               '%Y-%m-%dT%H:%M:%S': 19}
+
+# same patterns as strptime uses for these directives
+DIRECTIVE_PATTERNS = {'d': r'(?P<d>3[0-1]|[1-2]\d|0[1-9]|[1-9]| [1-9])',
+                      'f': r'(?P<f>[0-9]{1,6})',
+                      'H': r'(?P<H>2[0-3]|[0-1]\d|\d)',
+                      'M': r'(?P<M>[0-5]\d|\d)',
+                      'S': r'(?P<S>6[0-1]|[0-5]\d|\d)',
+                      'm': r'(?P<m>1[0-2]|0[1-9]|[1-9])',
+                      'y': r'(?P<y>\d\d)',
+                      'Y': r'(?P<Y>\d\d\d\d)'}
+
+
+def iso_parser(fmt):
+    '''Returns a parse function for an ISO 8601 format, or None if fmt is not
+    one of ISO_FORMATS (optionally followed by a literal Z)'''
+    zulu = fmt.endswith('Z')
+    length = ISO_FORMATS.get(fmt[:-1] if zulu else fmt)
+    if length is None:
+        return None
+    # fromisoformat() accepts more than fmt does (e.g. UTC offsets and
+    # single digit fields), so the layout is checked first
+    layout = r'\d{4}-\d\d-\d\d'
+    if length > 10:
+        layout += re.escape(fmt[8])+r'\d\d:\d\d:\d\d'
+    if zulu:
+        layout += '[Zz]'
+    layout = re.compile(layout, re.ASCII)
+
+    def parse(value):
+        if layout.fullmatch(value):
+            try:
+                return datetime.fromisoformat(value[:length])
+            except ValueError:
+                pass
+        return datetime.strptime(value, fmt)
+    return parse
+
+
+def regex_parser(fmt):
+    '''Returns a parse function using a compiled regular expression, or None
+    if fmt uses directives other than those in DIRECTIVE_PATTERNS (or uses
+    one twice)'''
+    pattern = []
+    for directive, space, literal in re.findall(r'%(.)|(\s+)|([^%\s]+)', fmt):
+        if space:
+            pattern.append(r'\s+')
+        elif literal:
+            pattern.append(re.escape(literal))
+        elif directive == '%':
+            pattern.append('%')
+        elif directive in DIRECTIVE_PATTERNS and f'(?P<{directive}>' not in ''.join(pattern):
+            pattern.append(DIRECTIVE_PATTERNS[directive])
+        else:
+            return None
+    regex = re.compile(''.join(pattern), re.IGNORECASE)
+    # (group index, default) for each datetime() argument up to seconds
+    two_digit_year = 'y' in regex.groupindex
+    year_group = 'y' if two_digit_year else 'Y'
+    spec = [(regex.groupindex[name]-1, None) if name in regex.groupindex else (None, default)
+            for name, default in ((year_group, 1900), ('m', 1), ('d', 1), ('H', 0), ('M', 0), ('S', 0))]
+    microsecond_index = regex.groupindex['f']-1 if 'f' in regex.groupindex else None
+
+    def parse(value):
+        match = regex.fullmatch(value)
+        if match is not None:
+            groups = match.groups()
+            args = [default if i is None else int(groups[i]) for i, default in spec]
+            if two_digit_year:
+                # same pivot as strptime
+                args[0] += 2000 if args[0] <= 68 else 1900
+            if microsecond_index is not None:
+                args.append(int(groups[microsecond_index].ljust(6, '0')))
+            try:
+                return datetime(*args)
+            except ValueError:
+                pass
+        return datetime.strptime(value, fmt)
+    return parse
+
+
+def datetime_parser(fmt, cache_size=0):
+    '''Returns a function which parses a string with the strptime format fmt
+    and returns a datetime, raising ValueError like strptime() when the string
+    does not match. If cache_size is given, that many of the most recently
+    parsed strings are remembered (useful for date only fields).'''
+    parse = iso_parser(fmt) or regex_parser(fmt)
+    if parse is None:
+        def parse(value):
+            return datetime.strptime(value, fmt)
+    if cache_size:
+        parse = functools.lru_cache(maxsize=cache_size)(parse)
+    return parse
@@ -0,0 +1,191 @@
+'''
+Rendering backend for the district pasture growth graphs.
+
+One Agg figure (no pyplot state machine, so it is safe off the GUI thread and
+in worker processes) is built per process and its line artists, labels and
+ticks are updated in place for each district. Graphs can be rendered in
+parallel processes, and rendered images can be kept in a cache keyed by a
+hash of everything which is drawn, so unchanged graphs are copied rather
+than drawn again when a report is regenerated. Least recently used images are
+evicted once the cache exceeds CACHE_SIZE_LIMIT bytes.
+'''
+
+from qgis.core import QgsApplication
+
+from parallel import ordered_results
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+
+CACHE_SIZE_LIMIT = 64*1024*1024
+# change when the appearance of the graphs changes, so that old images are not reused
+RENDER_VERSION = 1
+
+FY_MONTHS = ['Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec', 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun']
+SMOOTH_POINTS = 300
+
+_renderer = None
+
+
+def cache_dir():
+    '''Folder of the graph cache. Only valid in the QGIS process (worker
+    processes do not initialise QgsApplication), so it is resolved there and
+    passed to the jobs.'''
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), 'rangeland_tools', 'graph_cache')
+
+
+def y_ticks(region, y_axis_props):
+    '''Returns the y axis tick positions. y_axis_props is an empty list when
+    the Set custom Y-axis properties checkbox is not checked, otherwise
+    [upper tick, step].'''
+    if not y_axis_props:
+        # We use default upper tick & step values
+        if region == 'Northern':
+            upper_tick = 2600
+            step = 500
+        else:
+            upper_tick = 800
+            step = 250
+    else:
+        # We use the custom upper-tick & step values passed in the y_axis_props list
+        # We also need to add 50 or 100 to the upper tick value to get the correct Y-axis
+        step = y_axis_props[1]
+        if step%100:
+            # Check if divisible by 100 (e.g. 500 etc); Probably northern district
+            upper_tick = y_axis_props[0]+100
+        else:
+            # Not divisible by 100 (e.g. 250 etc); Probably southern district
+            upper_tick = y_axis_props[0]+50
+    return np.arange(0, upper_tick, step=step)
+
+
+def smooth_line(values):
+    '''Interpolate values (at x = 0, 1, 2...) with a spline for a smooth line.
+    Returns x and y arrays.'''
+    from scipy.interpolate import make_interp_spline
+    idx = np.arange(len(values))
+    xnew = np.linspace(idx.min(), idx.max(), SMOOTH_POINTS)
+    # k value must be less than number of given points for interpolation
+    spl = make_interp_spline(idx, values, k=len(values)-1 if len(values)<4 else 3)
+    return xnew, spl(xnew)
+
+
+class GrowthGraphRenderer:
+    '''A reusable figure holding the median line and three financial year lines'''
+
+    def __init__(self):
+        self.figure = Figure(figsize=(10, 7))
+        FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot()
+        self.median_line, = self.axes.plot([], [], label='Median', color='grey', linewidth=5)
+        self.year_lines = [self.axes.plot([], [], color=color, linewidth=5)[0] for color in ('blue', 'red', 'lawngreen')]
+        self.axes.set_xticks(range(len(FY_MONTHS)))
+        self.axes.set_xticklabels(FY_MONTHS, fontsize=18, rotation=90)
+        self.axes.yaxis.grid(linestyle='dashed')
+        self.axes.set_axisbelow(True)
+
+    def render(self, job, out_path):
+        '''Draw the graph described by job (see graph_job()) and save it to out_path'''
+        x = np.arange(len(FY_MONTHS))
+        # Median is constant (doesn't need smoothing)
+        self.median_line.set_data(x, [job['median']]*len(FY_MONTHS))
+        for line, values, label in zip(self.year_lines, job['values'], job['labels']):
+            if job['smooth']:
+                line.set_data(*smooth_line(values))
+            else:
+                line.set_data(x[:len(values)], values)
+            line.set_label(label)
+        self.axes.legend(fontsize=18)
+        # rescale to this graph's data before setting ticks (which may extend the y axis)
+        self.axes.relim()
+        self.axes.autoscale_view()
+        self.axes.set_yticks(y_ticks(job['region'], job['y_axis_props']))
+        self.axes.tick_params(axis='y', labelsize=18)
+        self.figure.savefig(out_path, bbox_inches='tight')
+        return out_path
+
+
+def graph_job(region, district, median, values1, values2, values3, labels, y_axis_props, smooth, out_path):
+    '''Returns a picklable description of one district graph'''
+    return {'region': region,
+            'district': district,
+            'median': float(median),
+            'values': [[np.nan if v is None else float(v) for v in values] for values in (values1, values2, values3)],
+            'labels': list(labels),
+            'y_axis_props': list(y_axis_props),
+            'smooth': bool(smooth),
+            'out_path': out_path}
+
+
+def graph_hash(job):
+    '''Hash of everything which is drawn for job, plus the output format'''
+    drawn = {key: value for key, value in job.items() if key != 'out_path'}
+    drawn['format'] = os.path.splitext(job['out_path'])[1].lower()
+    drawn['version'] = RENDER_VERSION
+    return hashlib.sha1(json.dumps(drawn, sort_keys=True).encode()).hexdigest()
+
+
+def render_graph(job, graph_cache_dir=None):
+    '''Render one graph (with a renderer which is reused for every graph drawn
+    by this process), or copy it from the cache in graph_cache_dir (no cache
+    if None). Also the process pool job.'''
+    global _renderer
+    out_path = job['out_path']
+    if graph_cache_dir is not None:
+        cache_path = os.path.join(graph_cache_dir, graph_hash(job)+os.path.splitext(out_path)[1].lower())
+        if os.path.isfile(cache_path):
+            shutil.copyfile(cache_path, out_path)
+            # touch entry so that it is the most recently used
+            os.utime(cache_path)
+            return out_path
+    if _renderer is None:
+        _renderer = GrowthGraphRenderer()
+    _renderer.render(job, out_path)
+    if graph_cache_dir is not None:
+        try:
+            os.makedirs(graph_cache_dir, exist_ok=True)
+            shutil.copyfile(out_path, cache_path)
+        except OSError:
+            pass
+    return out_path
+
+
+def evict_graphs(graph_cache_dir, size_limit=CACHE_SIZE_LIMIT):
+    '''Delete least recently used graph images until the cache is no larger
+    than size_limit bytes'''
+    if not os.path.isdir(graph_cache_dir):
+        return
+    entries = [(file.stat().st_mtime, file.stat().st_size, file.path) for file in os.scandir(graph_cache_dir) if file.is_file()]
+    total_size = sum(entry[1] for entry in entries)
+    for mtime, size, path in sorted(entries):
+        if total_size <= size_limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_size -= size
+
+
+def render_graphs(jobs, use_cache=False, workers=1, feedback=None):
+    '''Generator which renders each graph job and yields the output paths in
+    job order. If workers is not 1 (0 means all cores) graphs are rendered in
+    parallel processes.'''
+    graph_cache_dir = cache_dir() if use_cache else None
+    try:
+        if workers == 1:
+            for i, job in enumerate(jobs):
+                if feedback is not None:
+                    if feedback.isCanceled():
+                        return
+                    feedback.setProgress(i/len(jobs)*100)
+                yield render_graph(job, graph_cache_dir)
+        else:
+            yield from ordered_results(render_graph, [(job, graph_cache_dir) for job in jobs], workers, feedback)
+    finally:
+        if graph_cache_dir is not None:
+            evict_graphs(graph_cache_dir)
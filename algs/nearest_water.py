@@ -0,0 +1,73 @@
+'''
+Nearest waterpoint lookups for many points at once.
+
+Waterpoint coordinates, names and types are read into arrays once, and the
+nearest waterpoint to every query point is found in one vectorised query:
+with a scipy KD-tree when scipy is available, otherwise by comparing each
+chunk of query points with every waterpoint in numpy (waterpoint layers are
+small, so this is still fast).
+'''
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# number of point to waterpoint distances held in memory at once by the numpy fallback
+CHUNK_DISTANCES = 4000000
+
+
+class NearestWaterIndex:
+    '''Nearest waterpoint index over the vertices of a waterpoint layer or
+    feature source (point or multipoint). Coordinates are in the CRS of the
+    source, which should be projected.'''
+
+    def __init__(self, source, name_field, type_field=None):
+        x, y, names, types = [], [], [], []
+        for ft in source.getFeatures():
+            geom = ft.geometry()
+            if geom.isEmpty():
+                continue
+            name = str(ft[name_field])
+            wp_type = str(ft[type_field]) if type_field else None
+            # every part of a multipoint is a waterpoint with the feature's attributes
+            for pt in geom.vertices():
+                x.append(pt.x())
+                y.append(pt.y())
+                names.append(name)
+                types.append(wp_type)
+        self.x = np.array(x, dtype=np.float64)
+        self.y = np.array(y, dtype=np.float64)
+        self.names = np.array(names, dtype=object)
+        self.types = np.array(types, dtype=object)
+        self.tree = cKDTree(np.column_stack((self.x, self.y))) if cKDTree is not None and len(x) else None
+
+    def __len__(self):
+        return len(self.x)
+
+    def query(self, x, y):
+        '''Returns (distances, indices) of the nearest waterpoint to each point
+        of the x and y arrays. Indices refer to the names and types arrays.'''
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if self.tree is not None:
+            return self.tree.query(np.column_stack((x, y)))
+        distances = np.empty(len(x), dtype=np.float64)
+        indices = np.empty(len(x), dtype=np.int64)
+        chunk = max(1, CHUNK_DISTANCES//max(1, len(self.x)))
+        for start in range(0, len(x), chunk):
+            dx = x[start:start+chunk, None]-self.x[None, :]
+            dy = y[start:start+chunk, None]-self.y[None, :]
+            sq_distances = dx*dx+dy*dy
+            nearest = sq_distances.argmin(axis=1)
+            indices[start:start+chunk] = nearest
+            distances[start:start+chunk] = np.sqrt(sq_distances[np.arange(len(nearest)), nearest])
+        return distances, indices
+
+    def nearest(self, x, y):
+        '''Returns arrays of the distance to, and name and type of, the nearest
+        waterpoint to each point of the x and y arrays'''
+        distances, indices = self.query(x, y)
+        return distances, self.names[indices], self.types[indices]
@@ -0,0 +1,92 @@
+'''
+Process pool helpers for fanning independent jobs out across CPU cores from
+inside a processing algorithm.
+
+Workers are started with the 'spawn' method (forking the QGIS application is
+not safe) and with the python interpreter which ships with QGIS rather than
+the QGIS executable. If no python interpreter can be found the jobs are run
+serially in this process instead. Job functions must be top level functions
+of a module on the algs path, and their arguments must be picklable (paths,
+WKB, numpy arrays etc. rather than layers or gdal datasets).
+'''
+
+from qgis.core import QgsProcessingException
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+import os
+import sys
+
+
+def worker_count(requested=0):
+    '''Number of worker processes to use; 0 (or less) means all available cores'''
+    if requested > 0:
+        return requested
+    if hasattr(os, 'sched_getaffinity'):
+        return max(1, len(os.sched_getaffinity(0)))
+    return max(1, os.cpu_count() or 1)
+
+
+def python_executable():
+    '''Returns the path of a python interpreter to start worker processes
+    with, or None if none can be found. Inside QGIS sys.executable is the
+    QGIS executable (qgis-bin.exe on Windows, the QGIS binary of the app
+    bundle on macOS and of some Linux builds), which can't run a worker.'''
+    if sys.platform == 'win32':
+        candidates = [os.path.join(sys.exec_prefix, 'python.exe'),
+                      os.path.join(sys.exec_prefix, 'python3.exe')]
+    else:
+        version = f'{sys.version_info.major}.{sys.version_info.minor}'
+        candidates = [os.path.join(sys.exec_prefix, 'bin', f'python{version}'),
+                      os.path.join(sys.exec_prefix, 'bin', 'python3')]
+    candidates = [sys.executable, getattr(sys, '_base_executable', '')]+candidates
+    for path in candidates:
+        if path and os.path.basename(path).lower().startswith('python') and os.path.isfile(path):
+            return path
+    return None
+
+
+def process_pool(workers=0, python_exe=None):
+    '''Returns a ProcessPoolExecutor which is safe to start from within QGIS,
+    with workers started by python_exe (default: python_executable())'''
+    mp_context = multiprocessing.get_context('spawn')
+    python_exe = python_exe or python_executable()
+    if python_exe is not None:
+        mp_context.set_executable(python_exe)
+    return ProcessPoolExecutor(max_workers=worker_count(workers), mp_context=mp_context)
+
+
+def ordered_results(func, jobs, workers=0, feedback=None):
+    '''Run func(*job) for each job (a tuple of arguments) in a process pool and
+    yield the results in job order as soon as they are available, regardless of
+    which job finishes first. If no python interpreter can be found for the
+    worker processes the jobs are run one by one in this process. If feedback
+    is canceled, pending jobs are cancelled and a QgsProcessingException is
+    raised, so that callers never use partial results.'''
+    jobs = list(jobs)
+    if not jobs:
+        return
+    python_exe = python_executable()
+    if python_exe is None:
+        if feedback is not None:
+            feedback.pushWarning('No python interpreter found for parallel processes, running serially')
+        for i, job in enumerate(jobs):
+            if feedback is not None:
+                if feedback.isCanceled():
+                    raise QgsProcessingException('Canceled')
+                feedback.setProgress(i/len(jobs)*100)
+            yield func(*job)
+        return
+    pool = process_pool(min(worker_count(workers), len(jobs)), python_exe)
+    try:
+        futures = [pool.submit(func, *job) for job in jobs]
+        for i, future in enumerate(futures):
+            while not future.done():
+                if feedback is not None and feedback.isCanceled():
+                    raise QgsProcessingException('Canceled')
+                wait([future], timeout=0.2, return_when=FIRST_COMPLETED)
+            if feedback is not None:
+                feedback.setProgress((i+1)/len(futures)*100)
+            yield future.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,148 @@
+'''
+Point in polygon lookups of a polygon attribute (e.g. land type) for many
+points at once.
+
+Only polygons which intersect the extent of the points are read, and each is
+prepared for repeated containment tests the first time a point falls inside
+its bounding box. Points are processed in spatially sorted blocks: the
+spatial index is queried once per block, candidate polygons are screened
+against the block's points with numpy bounding box tests, and each point
+stops at the first polygon containing it.
+For very large point sets the polygons can instead be burned into a grid,
+so that each lookup is an array index (exact only to the grid cell size at
+polygon edges).
+'''
+
+from qgis.core import QgsFeatureRequest, QgsGeometry, QgsPoint, QgsRectangle, QgsSpatialIndex
+
+from virtual_rasters import memory_raster
+from osgeo import gdal, ogr
+import numpy as np
+import math
+
+# average number of points in each spatial block
+BLOCK_POINTS = 1024
+
+
+def spatial_blocks(x, y, block_points=BLOCK_POINTS):
+    '''Generator of index arrays which split the points (x, y) into blocks of
+    nearby points (cells of a regular grid over their extent)'''
+    if not len(x):
+        return
+    cells = max(1, math.ceil(math.sqrt(len(x)/block_points)))
+    width = max(x.max()-x.min(), y.max()-y.min()) or 1
+    col = np.minimum(((x-x.min())/width*cells).astype(np.int64), cells-1)
+    row = np.minimum(((y-y.min())/width*cells).astype(np.int64), cells-1)
+    keys = row*cells+col
+    order = np.argsort(keys, kind='stable')
+    breaks = np.flatnonzero(np.diff(keys[order]))+1
+    yield from np.split(order, breaks)
+
+
+class PolygonLookup:
+    '''Looks up value_field of the polygon of source (a vector layer or
+    feature source) containing each of many points. Coordinates are in the
+    CRS of source. If extent is given, only polygons intersecting it are used.'''
+
+    def __init__(self, source, value_field, extent=None):
+        request = QgsFeatureRequest().setSubsetOfAttributes([value_field], source.fields())
+        if extent is not None:
+            request.setFilterRect(extent)
+        self.crs = source.sourceCrs()
+        self.geometries = []
+        self.values = []
+        self.index = QgsSpatialIndex()
+        bounds = []
+        for ft in source.getFeatures(request):
+            geom = ft.geometry()
+            if geom.isEmpty():
+                continue
+            bbox = geom.boundingBox()
+            self.index.addFeature(len(self.geometries), bbox)
+            self.geometries.append(geom)
+            self.values.append(ft[value_field])
+            bounds.append((bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum()))
+        self.bounds = np.array(bounds, dtype=np.float64).reshape(-1, 4)
+        self.engines = {}
+
+    def engine(self, i):
+        '''Prepared geometry engine of polygon i (created on first use)'''
+        geom_engine = self.engines.get(i)
+        if geom_engine is None:
+            geom_engine = QgsGeometry.createGeometryEngine(self.geometries[i].constGet())
+            geom_engine.prepareGeometry()
+            self.engines[i] = geom_engine
+        return geom_engine
+
+    def lookup(self, x, y):
+        '''Returns a list with the value of the (first) polygon containing each
+        point of the x and y arrays, or None for points outside all polygons'''
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        results = [None]*len(x)
+        for block in spatial_blocks(x, y):
+            block_x = x[block]
+            block_y = y[block]
+            block_rect = QgsRectangle(block_x.min(), block_y.min(), block_x.max(), block_y.max())
+            unassigned = np.ones(len(block), dtype=bool)
+            # candidates in the order the polygons were read, so that overlaps resolve like a feature loop
+            for i in sorted(self.index.intersects(block_rect)):
+                xmin, ymin, xmax, ymax = self.bounds[i]
+                in_bounds = np.flatnonzero(unassigned & (block_x >= xmin) & (block_x <= xmax) & (block_y >= ymin) & (block_y <= ymax))
+                if not in_bounds.size:
+                    continue
+                geom_engine = self.engine(i)
+                for j in in_bounds.tolist():
+                    if geom_engine.contains(QgsPoint(block_x[j], block_y[j])):
+                        results[block[j]] = self.values[i]
+                        unassigned[j] = False
+                if not unassigned.any():
+                    break
+        return results
+
+    def grid(self, extent, cell_size):
+        '''Returns a PolygonGrid of this lookup's polygons covering extent'''
+        return PolygonGrid(self.geometries, self.values, self.crs, extent, cell_size)
+
+
+class PolygonGrid:
+    '''Polygons burned into a grid of polygon indices, for lookups which are
+    exact only to cell_size at polygon edges. A cell belongs to a polygon
+    when its centre falls inside it; where polygons overlap the first one
+    wins, as with PolygonLookup.'''
+
+    def __init__(self, geometries, values, crs, extent, cell_size):
+        self.values = [None]+list(values)
+        self.x_min = extent.xMinimum()
+        self.y_max = extent.yMaximum()
+        self.cell_size = cell_size
+        # one cell more than the extent needs, so that points on its eastern
+        # and southern edges are inside the grid even when the extent is an
+        # exact multiple of cell_size
+        cols = math.floor(extent.width()/cell_size)+1
+        rows = math.floor(extent.height()/cell_size)+1
+        ogr_ds = ogr.GetDriverByName('Memory').CreateDataSource('polygons')
+        ogr_lyr = ogr_ds.CreateLayer('polygons', geom_type=ogr.wkbMultiPolygon)
+        ogr_lyr.CreateField(ogr.FieldDefn('idx', ogr.OFTInteger))
+        # burn in reverse so that the first of any overlapping polygons is burned last
+        for i in reversed(range(len(geometries))):
+            ogr_feat = ogr.Feature(ogr_lyr.GetLayerDefn())
+            ogr_feat.SetField('idx', i+1)
+            ogr_feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geometries[i].asWkb())))
+            ogr_lyr.CreateFeature(ogr_feat)
+        grid_ds = memory_raster(cols, rows, (self.x_min, cell_size, 0, self.y_max, 0, -cell_size),
+                                crs.toWkt(), gdal.GDT_UInt32, init=0)
+        gdal.RasterizeLayer(grid_ds, [1], ogr_lyr, options=['ATTRIBUTE=idx'])
+        self.grid = grid_ds.GetRasterBand(1).ReadAsArray()
+        grid_ds = None
+
+    def lookup(self, x, y):
+        '''Returns a list with the value of the polygon in the grid cell of
+        each point of the x and y arrays, or None for points outside all
+        polygons (or outside the grid)'''
+        cols = np.floor((np.asarray(x, dtype=np.float64)-self.x_min)/self.cell_size).astype(np.int64)
+        rows = np.floor((self.y_max-np.asarray(y, dtype=np.float64))/self.cell_size).astype(np.int64)
+        inside = (cols >= 0) & (cols < self.grid.shape[1]) & (rows >= 0) & (rows < self.grid.shape[0])
+        indices = np.zeros(len(cols), dtype=np.int64)
+        indices[inside] = self.grid[rows[inside], cols[inside]]
+        return [self.values[i] for i in indices.tolist()]
@@ -0,0 +1,211 @@
+'''
+Persistent time index of GPS collar layers.
+
+The index holds the timestamps of a datetime field sorted ascending, with the
+feature id of each. Timestamps are wall clock times (the date and time as
+stored, whatever their time zone), so ranges match the datetime filter
+expressions, which compare the stored values as text. Date range filters,
+the fixes of one day and the earliest and latest fix are then found by
+binary search, and only the matching features need to be read.
+Indexes of file based layers are saved as .npz sidecar files in the QGIS
+settings folder, keyed by the layer source and datetime field and checked
+against the modification time and size of the file (and of the files edits
+may be saved in instead: a GeoPackage write-ahead log, a shapefile's .dbf),
+so a layer is only read in full again once it changes. Layers with a subset
+string share the index of their whole source, narrowed to the features of the
+subset. Least recently used indexes are evicted once the cache exceeds
+CACHE_SIZE_LIMIT bytes. Layers which do not come from a file (e.g. memory
+layers), or have unsaved edits, are indexed in memory.
+'''
+
+from qgis.core import (QgsApplication, QgsFeatureRequest, QgsProviderRegistry,
+                        QgsVectorLayer, NULL)
+
+from qgis.PyQt.QtCore import Qt, QDateTime, QTime
+
+import numpy as np
+import hashlib
+import os
+
+CACHE_DIR = os.path.join(QgsApplication.qgisSettingsDirPath(), 'rangeland_tools', 'time_index')
+CACHE_SIZE_LIMIT = 256*1024*1024
+# change when the timestamps in the index change meaning, so that old sidecar files are not loaded
+INDEX_VERSION = 2
+
+
+def layer_file(layer):
+    '''Returns the path of the file behind a vector layer, or None'''
+    if not isinstance(layer, QgsVectorLayer) or layer.isModified():
+        return None
+    uri_parts = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source())
+    path = uri_parts.get('path', '')
+    return path if path and os.path.isfile(path) else None
+
+
+def layer_fids(layer):
+    '''Returns an array of the feature ids of layer (within its subset string)'''
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+    request.setNoAttributes()
+    return np.fromiter((ft.id() for ft in layer.getFeatures(request)), dtype=np.int64)
+
+
+def evict_indexes(keep=None, size_limit=CACHE_SIZE_LIMIT):
+    '''Delete least recently used index files until the cache is no larger
+    than size_limit bytes. The file at keep is never deleted.'''
+    if not os.path.isdir(CACHE_DIR):
+        return
+    entries = [(file.stat().st_mtime, file.stat().st_size, file.path) for file in os.scandir(CACHE_DIR)
+               if file.name.endswith('.npz') and not file.name.endswith('.tmp.npz')]
+    total_size = sum(entry[1] for entry in entries)
+    for mtime, size, path in sorted(entries):
+        if total_size <= size_limit:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_size -= size
+
+
+def file_stamp(path):
+    '''Returns the version of the index format and the modification time and
+    size of path and of the files its edits may be saved in instead (-1 for
+    files which do not exist)'''
+    stem = os.path.splitext(path)[0]
+    stamp = [INDEX_VERSION]
+    for file_path in (path, f'{path}-wal', f'{stem}.dbf', f'{stem}.DBF'):
+        try:
+            stat = os.stat(file_path)
+            stamp += [stat.st_mtime_ns, stat.st_size]
+        except OSError:
+            stamp += [-1, -1]
+    return np.array(stamp, dtype=np.int64)
+
+
+def msecs(value):
+    '''Wall clock time of a QDateTime (its date and time, ignoring its time
+    zone) as milliseconds'''
+    return QDateTime(value.date(), value.time(), Qt.UTC).toMSecsSinceEpoch()
+
+
+def from_msecs(value):
+    '''Returns the local QDateTime with the wall clock time of value (see msecs())'''
+    utc_datetime = QDateTime.fromMSecsSinceEpoch(int(value), Qt.UTC)
+    return QDateTime(utc_datetime.date(), utc_datetime.time())
+
+
+class TimeIndex:
+    '''Sorted (timestamp, fid) index of the datetime_field of a vector layer.
+    Features without a datetime are not in the index.'''
+
+    def __init__(self, times, fids):
+        self.times = times
+        self.fids = fids
+
+    @classmethod
+    def build(cls, layer, datetime_field, feedback=None):
+        '''Reads the datetime of every feature of layer and returns the index'''
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([datetime_field], layer.fields())
+        total = layer.featureCount()
+        times, fids = [], []
+        for current, ft in enumerate(layer.getFeatures(request)):
+            if feedback is not None:
+                if feedback.isCanceled():
+                    break
+                if total > 0:
+                    feedback.setProgress(round((current+1)/total*100, 1))
+            ft_datetime = ft[datetime_field]
+            if ft_datetime == NULL or ft_datetime is None:
+                continue
+            times.append(msecs(ft_datetime))
+            fids.append(ft.id())
+        times = np.array(times, dtype=np.int64)
+        order = np.argsort(times, kind='stable')
+        return cls(times[order], np.array(fids, dtype=np.int64)[order])
+
+    @classmethod
+    def for_layer(cls, layer, datetime_field, feedback=None):
+        '''Returns the index of layer, loaded from its sidecar file when it is
+        up to date, otherwise built (and saved when layer is file based). The
+        index of a layer with a subset string is that of its whole source,
+        narrowed to the features of the subset.'''
+        path = layer_file(layer)
+        if path is None:
+            return cls.build(layer, datetime_field, feedback)
+        if layer.subsetString():
+            # the index of the whole source is saved once and shared by every subset of it
+            source_layer = QgsVectorLayer(layer.source(), layer.name(), layer.providerType())
+            source_layer.setSubsetString('')
+            return cls.for_layer(source_layer, datetime_field, feedback).subset(layer_fids(layer))
+        h = hashlib.sha1()
+        for part in (layer.providerType(), layer.source(), datetime_field):
+            h.update(part.encode())
+            h.update(b'\0')
+        index_path = os.path.join(CACHE_DIR, f'{h.hexdigest()}.npz')
+        stamp = file_stamp(path)
+        if os.path.isfile(index_path):
+            try:
+                with np.load(index_path) as data:
+                    if np.array_equal(data['stamp'], stamp):
+                        # touch entry so that it is the most recently used
+                        os.utime(index_path)
+                        return cls(data['times'], data['fids'])
+            except (OSError, KeyError, ValueError):
+                pass
+        index = cls.build(layer, datetime_field, feedback)
+        if feedback is not None and feedback.isCanceled():
+            return index
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            # write to a temporary file first so that a partly written index is never loaded
+            tmp_path = os.path.join(CACHE_DIR, f'{h.hexdigest()}.tmp.npz')
+            np.savez(tmp_path, times=index.times, fids=index.fids, stamp=stamp)
+            os.replace(tmp_path, index_path)
+            evict_indexes(keep=index_path)
+        except OSError as e:
+            if feedback is not None:
+                feedback.pushWarning(f'Could not save time index: {e}')
+        return index
+
+    def subset(self, fids):
+        '''Returns the index of the features of fids (an array) only'''
+        keep = np.isin(self.fids, fids)
+        return type(self)(self.times[keep], self.fids[keep])
+
+    def __len__(self):
+        return len(self.times)
+
+    def range_slice(self, start, end):
+        '''Returns the slice of times and fids with start <= datetime <= end
+        (QDateTimes)'''
+        first = np.searchsorted(self.times, msecs(start), side='left')
+        last = np.searchsorted(self.times, msecs(end), side='right')
+        return slice(first, max(first, last))
+
+    def range_fids(self, start, end):
+        '''Returns the fids of features with start <= datetime <= end
+        (compared as wall clock times), in chronological order'''
+        return self.fids[self.range_slice(start, end)].tolist()
+
+    def range_count(self, start, end):
+        '''Returns the number of features with start <= datetime <= end'''
+        selected = self.range_slice(start, end)
+        return selected.stop-selected.start
+
+    def day_fids(self, date):
+        '''Returns the fids of features on date (a QDate), in chronological order'''
+        start = msecs(QDateTime(date, QTime(0, 0)))
+        end = msecs(QDateTime(date.addDays(1), QTime(0, 0)))
+        first, last = np.searchsorted(self.times, [start, end], side='left')
+        return self.fids[first:last].tolist()
+
+    def minimum(self):
+        '''Returns the earliest datetime as a QDateTime, or None when empty'''
+        return from_msecs(self.times[0]) if len(self.times) else None
+
+    def maximum(self):
+        '''Returns the latest datetime as a QDateTime, or None when empty'''
+        return from_msecs(self.times[-1]) if len(self.times) else None
@@ -0,0 +1,69 @@
+'''
+Coordinate transforms shared by every algorithm.
+
+Creating a QgsCoordinateTransform means looking up PROJ operations for the
+pair of CRSs, which costs far more than transforming a geometry, so one
+transform per (source CRS, destination CRS, transform context) is created
+and reused. Transforms are held per thread because processing algorithms
+may run in background threads.
+'''
+
+from qgis.core import QgsCoordinateTransform, QgsGeometry, QgsLineString, QgsProject
+
+import numpy as np
+import threading
+
+_local = threading.local()
+
+
+def crs_key(crs):
+    '''Hashable key of a QgsCoordinateReferenceSystem'''
+    return crs.authid() or crs.toWkt()
+
+
+def coordinate_transform(src_crs, dst_crs, context):
+    '''Returns a (cached) QgsCoordinateTransform from src_crs to dst_crs.
+    context may be a QgsProject or a QgsCoordinateTransformContext.'''
+    if isinstance(context, QgsProject):
+        context = context.transformContext()
+    if not hasattr(_local, 'contexts'):
+        _local.contexts = []
+    # transform contexts are not hashable, but compare equal when they hold the same operations
+    for cached_context, transforms in _local.contexts:
+        if cached_context == context:
+            break
+    else:
+        transforms = {}
+        _local.contexts.append((context, transforms))
+    key = (crs_key(src_crs), crs_key(dst_crs))
+    xform = transforms.get(key)
+    if xform is None:
+        xform = QgsCoordinateTransform(src_crs, dst_crs, context)
+        transforms[key] = xform
+    return xform
+
+
+def transform_in_place(geom, src_crs, dst_crs, context):
+    '''Transforms geom from src_crs to dst_crs (if they differ) and returns it'''
+    if src_crs != dst_crs:
+        geom.transform(coordinate_transform(src_crs, dst_crs, context))
+    return geom
+
+
+def transformed_geom(geom, src_crs, dst_crs, context):
+    '''Returns a copy of geom transformed from src_crs to dst_crs. geom itself
+    is not changed.'''
+    # QgsGeometry copies are implicitly shared; the copy detaches when it is transformed
+    return transform_in_place(QgsGeometry(geom), src_crs, dst_crs, context)
+
+
+def transform_coords(x, y, src_crs, dst_crs, context):
+    '''Returns x and y arrays of coordinates transformed from src_crs to
+    dst_crs. All coordinates are handed to PROJ in one call.'''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if src_crs == dst_crs or not x.size:
+        return x.copy(), y.copy()
+    line = QgsLineString(x.tolist(), y.tolist())
+    line.transform(coordinate_transform(src_crs, dst_crs, context))
+    return np.array(line.xVector(), dtype=np.float64), np.array(line.yVector(), dtype=np.float64)
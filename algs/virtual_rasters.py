@@ -0,0 +1,75 @@
+'''
+Helpers for clipping rasters without materialising temporary GeoTIFFs.
+
+Intermediate rasters are kept in memory (MEM datasets or /vsimem/ files) and
+clip products can be written as lightweight warped VRTs, which reference the
+source raster and carry their cutline in the VRT XML. Only outputs which the
+user keeps need to be written as real raster files.
+'''
+
+from osgeo import gdal, ogr, osr
+import uuid
+
+
+def vsimem_path(name, extension='.tif'):
+    '''Returns a unique path in GDAL's in-memory file system'''
+    return f'/vsimem/rangeland_tools/{uuid.uuid4().hex}_{name}{extension}'
+
+
+def release(path):
+    '''Free an in-memory (/vsimem/) file; real files are left alone'''
+    if path.startswith('/vsimem/'):
+        gdal.Unlink(path)
+
+
+def memory_raster(x_size, y_size, geotransform, crs_wkt, data_type=gdal.GDT_Float32, nodata=None, init=None):
+    '''Returns a single band MEM dataset (never written to disk)'''
+    ds = gdal.GetDriverByName('MEM').Create('', x_size, y_size, 1, data_type)
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(crs_wkt)
+    band = ds.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    if init is not None:
+        band.Fill(init)
+    return ds
+
+
+def cutline_dataset(wkb_geometries, crs_wkt):
+    '''Write geometries (WKB bytes) to an in-memory GeoJSON file for use as a
+    gdalwarp cutline. Returns the /vsimem/ path; free it with release().'''
+    path = vsimem_path('cutline', '.geojson')
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(crs_wkt)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    ogr_ds = ogr.GetDriverByName('GeoJSON').CreateDataSource(path)
+    ogr_lyr = ogr_ds.CreateLayer('cutline', srs=srs, geom_type=ogr.wkbMultiPolygon)
+    for wkb in wkb_geometries:
+        ogr_feat = ogr.Feature(ogr_lyr.GetLayerDefn())
+        ogr_feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(wkb)))
+        ogr_lyr.CreateFeature(ogr_feat)
+    ogr_ds = None
+    return path
+
+
+def clip_by_geometries(src, wkb_geometries, crs_wkt, output_path, output_format='GTiff', nodata=None, data_type=gdal.GDT_Unknown):
+    '''Clip src (a path or gdal dataset) to the union of wkb_geometries (in the
+    crs given by crs_wkt), cropping to the cutline extent on the source pixel
+    grid, like gdal:cliprasterbymasklayer with CROP_TO_CUTLINE.
+    With output_format='VRT' only a small warped VRT referencing src is
+    written (src must then be a file which outlives the VRT).'''
+    cutline_path = cutline_dataset(wkb_geometries, crs_wkt)
+    try:
+        warp_options = gdal.WarpOptions(format=output_format,
+                                        cutlineDSName=cutline_path,
+                                        cropToCutline=True,
+                                        dstNodata=nodata,
+                                        outputType=data_type)
+        out_ds = gdal.Warp(output_path, src, options=warp_options)
+        if out_ds is None:
+            return None
+        # the cutline is embedded in a VRT only once it is closed
+        out_ds = None
+    finally:
+        release(cutline_path)
+    return output_path
@@ -0,0 +1,169 @@
+'''
+Persistent cache of paddock watered areas (dissolved waterpoint buffers
+clipped to a paddock).
+
+Watered areas are stored as WKB in a SQLite database in the QGIS settings
+folder. Each entry is keyed by a hash of the paddock geometry, the set of
+paddock waterpoint geometries, the buffer distance, the number of buffer
+segments and the CRS, so an entry is only recalculated when one of those
+changes: after editing one paddock (or its waterpoints) only that paddock is
+buffered again. Least recently used entries are evicted once the cache holds
+more than CACHE_SIZE_LIMIT bytes of geometry.
+Watered areas which are not in the cache can be calculated for many
+paddocks at once in a process pool.
+'''
+
+from qgis.core import QgsApplication, QgsGeometry
+
+from band_rings import geometry_from_wkb
+from parallel import ordered_results
+import hashlib
+import sqlite3
+import time
+import os
+
+CACHE_PATH = os.path.join(QgsApplication.qgisSettingsDirPath(), 'rangeland_tools', 'watered_areas.sqlite')
+CACHE_SIZE_LIMIT = 256*1024*1024
+
+# buffer segments per quarter circle
+SEGMENTS = 25
+
+
+def watered_area(pdk_geom, waterpoint_geoms, distance, segments=SEGMENTS):
+    '''Returns the dissolved buffer of distance around waterpoint_geoms,
+    clipped to pdk_geom (an empty geometry if there are no waterpoints)'''
+    if not waterpoint_geoms:
+        return QgsGeometry()
+    # buffering all waterpoints as one multipoint dissolves the buffers as they are built
+    return QgsGeometry.collectGeometry(waterpoint_geoms).buffer(distance, segments).intersection(pdk_geom)
+
+
+def watered_area_job(pdk_wkb, waterpoint_wkbs, distance, segments=SEGMENTS):
+    '''Process pool job: watered_area() of WKB geometries, returned as WKB'''
+    geom = watered_area(geometry_from_wkb(pdk_wkb), [geometry_from_wkb(wkb) for wkb in waterpoint_wkbs], distance, segments)
+    return bytes(geom.asWkb())
+
+
+class WateredAreaCache:
+    '''Cached watered areas in crs (a projected
+    QgsCoordinateReferenceSystem). Falls back to calculating every watered
+    area if the cache database can't be opened.
+    Use as a context manager, or call close() when done.'''
+
+    def __init__(self, crs, segments=SEGMENTS, feedback=None):
+        self.segments = segments
+        self.prefix = f'{crs.toWkt()}\0{segments}\0'.encode()
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+            self.db = sqlite3.connect(CACHE_PATH, timeout=30)
+            self.db.execute('CREATE TABLE IF NOT EXISTS watered_areas '
+                            '(key TEXT PRIMARY KEY, wkb BLOB, last_used REAL)')
+        except (OSError, sqlite3.Error) as e:
+            if feedback is not None:
+                feedback.pushWarning(f'Could not open watered area cache: {e}')
+            self.db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def key(self, pdk_geom, waterpoint_geoms, distance):
+        '''Cache key of the watered area of distance around waterpoint_geoms
+        in pdk_geom'''
+        h = hashlib.sha1(self.prefix)
+        h.update(f'{float(distance)!r}\0'.encode())
+        h.update(bytes(pdk_geom.asWkb()))
+        # the waterpoints are a set, so their order does not matter
+        for wkb in sorted(bytes(geom.asWkb()) for geom in waterpoint_geoms):
+            h.update(b'\0')
+            h.update(wkb)
+        return h.hexdigest()
+
+    def cached(self, key):
+        '''Returns the cached watered area of key, or None'''
+        row = self.db.execute('SELECT wkb FROM watered_areas WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute('UPDATE watered_areas SET last_used = ? WHERE key = ?', (time.time(), key))
+        self.hits += 1
+        return geometry_from_wkb(row[0])
+
+    def store(self, key, geom):
+        '''Adds the watered area geom of key to the cache'''
+        self.db.execute('INSERT OR REPLACE INTO watered_areas VALUES (?, ?, ?)',
+                        (key, bytes(geom.asWkb()), time.time()))
+        self.misses += 1
+
+    def watered_area(self, pdk_geom, waterpoint_geoms, distance):
+        '''Returns the dissolved buffer of distance around waterpoint_geoms,
+        clipped to pdk_geom, from the cache when available'''
+        if self.db is None or not waterpoint_geoms:
+            return watered_area(pdk_geom, waterpoint_geoms, distance, self.segments)
+        key = self.key(pdk_geom, waterpoint_geoms, distance)
+        try:
+            geom = self.cached(key)
+            if geom is None:
+                geom = watered_area(pdk_geom, waterpoint_geoms, distance, self.segments)
+                self.store(key, geom)
+            return geom
+        except sqlite3.Error:
+            return watered_area(pdk_geom, waterpoint_geoms, distance, self.segments)
+
+    def watered_areas(self, items, workers=1, feedback=None):
+        '''Returns a list of the watered areas of items, a list of
+        (pdk_geom, waterpoint_geoms, distance), in order. If workers is not 1
+        (0 means all cores) watered areas which are not in the cache are
+        calculated in parallel processes (a QgsProcessingException is raised
+        if feedback is canceled).'''
+        items = list(items)
+        if workers == 1:
+            return [self.watered_area(*item) for item in items]
+        results = [None]*len(items)
+        keys = {}
+        for i, (pdk_geom, waterpoint_geoms, distance) in enumerate(items):
+            if not waterpoint_geoms:
+                results[i] = QgsGeometry()
+                continue
+            if self.db is not None:
+                keys[i] = self.key(pdk_geom, waterpoint_geoms, distance)
+                try:
+                    results[i] = self.cached(keys[i])
+                except sqlite3.Error:
+                    pass
+        missing = [i for i, geom in enumerate(results) if geom is None]
+        # geometries are passed to the worker processes as WKB
+        jobs = [(bytes(items[i][0].asWkb()), [bytes(geom.asWkb()) for geom in items[i][1]], items[i][2], self.segments)
+                for i in missing]
+        for i, wkb in zip(missing, ordered_results(watered_area_job, jobs, workers, feedback)):
+            results[i] = geometry_from_wkb(wkb)
+            if i in keys:
+                try:
+                    self.store(keys[i], results[i])
+                except sqlite3.Error:
+                    pass
+        return results
+
+    def close(self, size_limit=CACHE_SIZE_LIMIT):
+        '''Saves new entries, evicts least recently used entries until the
+        cache is no larger than size_limit bytes and closes the database'''
+        if self.db is None:
+            return
+        try:
+            total_size = self.db.execute('SELECT COALESCE(SUM(LENGTH(wkb)), 0) FROM watered_areas').fetchone()[0]
+            if total_size > size_limit:
+                evict = []
+                for key, size in self.db.execute('SELECT key, LENGTH(wkb) FROM watered_areas ORDER BY last_used'):
+                    if total_size <= size_limit:
+                        break
+                    evict.append((key,))
+                    total_size -= size
+                self.db.executemany('DELETE FROM watered_areas WHERE key = ?', evict)
+            self.db.commit()
+        except sqlite3.Error:
+            pass
+        self.db.close()
+        self.db = None
@@ -0,0 +1,70 @@
+'''
+Lookups of the distance to water band (e.g. '1000-1500m') which contains a
+distance to water.
+
+The bands of a watered bands layer are read once: band names in layer order,
+one geometry per band (with a prepared geometry engine created on first
+use) and the band limits as arrays sorted by inner distance, so that the
+band of every distance in an array is found with one searchsorted call
+instead of a scan of every band for each distance.
+'''
+
+from qgis.core import QgsFeatureRequest, QgsGeometry
+
+import numpy as np
+
+
+def band_limits(band_key):
+    '''Returns the (inner, outer) distances of a band name like '1000-1500m' '''
+    inner, outer = band_key.split('-')[:2]
+    return int(inner), int(outer[:-1])
+
+
+class WateredBands:
+    '''Bands of a watered bands layer (or feature source), where band_field
+    holds the band name'''
+
+    def __init__(self, source, band_field):
+        self.keys = []
+        self.geometries = []
+        request = QgsFeatureRequest().setSubsetOfAttributes([band_field], source.fields())
+        for ft in source.getFeatures(request):
+            if ft[band_field] in self.keys:
+                continue
+            self.keys.append(ft[band_field])
+            self.geometries.append(ft.geometry())
+        limits = np.array([band_limits(key) for key in self.keys], dtype=np.float64).reshape(-1, 2)
+        # band indices sorted by inner distance
+        self.order = np.argsort(limits[:, 0], kind='stable')
+        self.inner = limits[self.order, 0]
+        self.outer = limits[self.order, 1]
+        self.engines = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def band_indices(self, distances):
+        '''Returns an array with the index (into keys) of the band containing
+        each distance (inner < distance < outer), or -1 where no band does'''
+        distances = np.asarray(distances, dtype=np.float64)
+        # last band with inner < distance
+        pos = np.searchsorted(self.inner, distances, side='left')-1
+        valid = pos >= 0
+        valid[valid] = distances[valid] < self.outer[pos[valid]]
+        indices = np.full(len(distances), -1, dtype=np.int64)
+        indices[valid] = self.order[pos[valid]]
+        return indices
+
+    def band_key(self, distance):
+        '''Returns the name of the band containing distance, or None'''
+        index = self.band_indices([distance])[0]
+        return None if index < 0 else self.keys[index]
+
+    def engine(self, index):
+        '''Prepared geometry engine of band index (created on first use)'''
+        geom_engine = self.engines.get(index)
+        if geom_engine is None:
+            geom_engine = QgsGeometry.createGeometryEngine(self.geometries[index].constGet())
+            geom_engine.prepareGeometry()
+            self.engines[index] = geom_engine
+        return geom_engine
@@ -0,0 +1,36 @@
+'''
+Pairing of waterpoints with the paddocks they are in.
+
+Waterpoint geometries are put in a spatial index once, so each paddock only
+tests the waterpoints inside its bounding box, and those against a prepared
+paddock geometry, instead of testing every waterpoint against every paddock.
+'''
+
+from qgis.core import QgsGeometry, QgsSpatialIndex
+
+
+class WaterpointIndex:
+    '''Spatial index of waterpoint geometries (QgsGeometry list, all in the
+    CRS of the paddocks they will be paired with)'''
+
+    def __init__(self, waterpoint_geoms):
+        self.geoms = list(waterpoint_geoms)
+        self.index = QgsSpatialIndex()
+        for i, geom in enumerate(self.geoms):
+            if not geom.isEmpty():
+                self.index.addFeature(i, geom.boundingBox())
+
+    def __len__(self):
+        return len(self.geoms)
+
+    def paddock_waterpoints(self, pdk_geom, within=False):
+        '''Returns the waterpoint geometries which intersect pdk_geom (or are
+        within it, not on its boundary, if within is True), in the order they
+        were given'''
+        candidates = sorted(self.index.intersects(pdk_geom.boundingBox()))
+        if not candidates:
+            return []
+        pdk_engine = QgsGeometry.createGeometryEngine(pdk_geom.constGet())
+        pdk_engine.prepareGeometry()
+        test = pdk_engine.contains if within else pdk_engine.intersects
+        return [self.geoms[i] for i in candidates if test(self.geoms[i].constGet())]
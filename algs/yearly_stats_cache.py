@@ -0,0 +1,81 @@
+'''
+Persistent cache of per-district statistics of yearly total growth rasters,
+used to calculate long-term district medians.
+
+Statistics are stored in a json file in the QGIS settings folder, keyed by the
+district layer content hash and the source folder, with one entry per raster
+file holding its size and modification time. Only rasters which are new (or
+have changed) since the last update are read, so adding a year to the source
+folder costs one raster read rather than a pass over every year.
+'''
+
+from qgis.core import QgsApplication
+
+from zonal_stats import cumulative_zonal_stats
+from zone_cache import cached_district_zone_grid, district_layer_hash
+import numpy as np
+import json
+import os
+
+CACHE_PATH = os.path.join(QgsApplication.qgisSettingsDirPath(), 'rangeland_tools', 'yearly_growth_stats.json')
+
+
+def load_cache():
+    '''Returns the cached statistics, or an empty cache if there are none'''
+    try:
+        with open(CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache):
+    '''Write the cache, replacing the previous file in one step so that an
+    interrupted write never leaves a corrupt cache behind'''
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        tmp_path = f'{CACHE_PATH}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, CACHE_PATH)
+    except OSError:
+        pass
+
+
+def raster_district_stats(raster_path, districts, name_field, transform_context):
+    '''Returns {district name: {'Mean': mean, 'Median': median}} for the pixels
+    of raster_path in each district (None where a district has no valid pixels)'''
+    zone_ds, zone_names = cached_district_zone_grid(districts, name_field, raster_path, transform_context)
+    means, medians = next(cumulative_zonal_stats([raster_path], zone_ds, len(zone_names)))
+    zone_ds = None
+    stats = {}
+    for i, name in enumerate(zone_names):
+        stats[name] = {'Mean': None if np.isnan(means[i]) else float(means[i]),
+                       'Median': None if np.isnan(medians[i]) else float(medians[i])}
+    return stats
+
+
+def yearly_district_stats(src_folder, districts, name_field, transform_context, extension='tiff'):
+    '''Returns {year: {district name: {'Mean': mean, 'Median': median}}} for
+    every raster in src_folder with the given extension, where year is the
+    first 4 characters of the file name. Statistics for unchanged files come
+    from the cache.'''
+    cache = load_cache()
+    folder_key = f'{district_layer_hash(districts, name_field)}:{os.path.abspath(src_folder)}'
+    cached_files = cache.get(folder_key, {})
+    files = {}
+    for file in sorted(os.scandir(src_folder), key=lambda file: file.name):
+        if file.name.split('.')[-1] != extension:
+            continue
+        file_stat = file.stat()
+        entry = cached_files.get(file.name)
+        if entry is None or entry['mtime'] != file_stat.st_mtime or entry['size'] != file_stat.st_size:
+            entry = {'mtime': file_stat.st_mtime,
+                     'size': file_stat.st_size,
+                     'stats': raster_district_stats(file.path, districts, name_field, transform_context)}
+        files[file.name] = entry
+    # files which have been removed from the folder drop out of the cache
+    if files != cached_files:
+        cache[folder_key] = files
+        save_cache(cache)
+    return {file_name[:4]: entry['stats'] for file_name, entry in files.items()}
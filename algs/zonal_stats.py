@@ -0,0 +1,272 @@
+'''
+Helpers for summarising a raster by pastoral district without clipping it to
+a temporary file per district. The districts are burned once into a zone-id
+grid aligned to the input raster (0 = outside all districts, 1..n = district
+index + 1) and every class count for every district is then accumulated in
+one windowed read of the input raster. All reads walk the rasters in their
+natural block size, so peak memory is bounded by one block rather than by the
+size of a district or of the whole raster.
+'''
+
+from qgis.core import (QgsCoordinateTransform, QgsCoordinateReferenceSystem,
+                        QgsGeometry)
+
+from parallel import ordered_results, worker_count
+from osgeo import gdal, ogr
+import numpy as np
+import os
+
+
+def block_windows(band, window=None):
+    '''Generator of (x_off, y_off, x_size, y_size) windows which cover band
+    (or the pixel window (x_off, y_off, x_size, y_size) of band) in the natural
+    block size of band, so that every read touches as few blocks as possible'''
+    if window is None:
+        window = (0, 0, band.XSize, band.YSize)
+    win_x, win_y, win_cols, win_rows = window
+    block_cols, block_rows = band.GetBlockSize()
+    # start at the block boundary at or before the window origin
+    first_x = win_x-win_x%block_cols
+    first_y = win_y-win_y%block_rows
+    for y_off in range(first_y, win_y+win_rows, block_rows):
+        y_start = max(y_off, win_y)
+        y_end = min(y_off+block_rows, win_y+win_rows)
+        for x_off in range(first_x, win_x+win_cols, block_cols):
+            x_start = max(x_off, win_x)
+            x_end = min(x_off+block_cols, win_x+win_cols)
+            yield (x_start, y_start, x_end-x_start, y_end-y_start)
+
+
+def nodata_mask(values, nodata):
+    '''Boolean array which is True where values equal the nodata value (if any)'''
+    if nodata is None:
+        return np.zeros(values.shape, dtype=bool)
+    if np.isnan(nodata):
+        return np.isnan(values)
+    return values == nodata
+
+
+def district_zone_grid(districts, name_field, raster_path, transform_context, output_path=None):
+    '''Rasterize district polygons (a vector layer or feature source) onto the
+    grid of the raster at raster_path.
+    Returns a gdal dataset holding zone ids and the list of district names,
+    where zone id i+1 belongs to zone_names[i]. The zone grid is held in memory
+    unless output_path is given, in which case it is written there as a tiled,
+    compressed GeoTIFF. Pixels are assigned to a district when their centre
+    falls inside it, which matches the cutline rule used by
+    gdal:cliprasterbymasklayer.'''
+    raster_ds = gdal.Open(raster_path)
+    raster_crs = QgsCoordinateReferenceSystem.fromWkt(raster_ds.GetProjection())
+    xform = QgsCoordinateTransform(districts.sourceCrs(), raster_crs, transform_context)
+
+    ogr_ds = ogr.GetDriverByName('Memory').CreateDataSource('districts')
+    ogr_lyr = ogr_ds.CreateLayer('districts', geom_type=ogr.wkbMultiPolygon)
+    ogr_lyr.CreateField(ogr.FieldDefn('zone', ogr.OFTInteger))
+
+    zone_names = []
+    for f in districts.getFeatures():
+        district_name = f[name_field]
+        if district_name not in zone_names:
+            zone_names.append(district_name)
+        geom = QgsGeometry(f.geometry())
+        geom.transform(xform)
+        ogr_feat = ogr.Feature(ogr_lyr.GetLayerDefn())
+        ogr_feat.SetField('zone', zone_names.index(district_name)+1)
+        ogr_feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geom.asWkb())))
+        ogr_lyr.CreateFeature(ogr_feat)
+
+    if output_path is None:
+        zone_ds = gdal.GetDriverByName('MEM').Create('', raster_ds.RasterXSize, raster_ds.RasterYSize, 1, gdal.GDT_UInt16)
+    else:
+        zone_ds = gdal.GetDriverByName('GTiff').Create(output_path, raster_ds.RasterXSize, raster_ds.RasterYSize, 1, gdal.GDT_UInt16,
+                                                        options=['COMPRESS=DEFLATE', 'TILED=YES', 'SPARSE_OK=TRUE'])
+    zone_ds.SetGeoTransform(raster_ds.GetGeoTransform())
+    zone_ds.SetProjection(raster_ds.GetProjection())
+    gdal.RasterizeLayer(zone_ds, [1], ogr_lyr, options=['ATTRIBUTE=zone'])
+    zone_ds.FlushCache()
+    raster_ds = None
+    return zone_ds, zone_names
+
+
+def zonal_class_counts(raster_path, zone_ds, zone_count, class_bins, feedback=None, workers=1):
+    '''Count pixels per (zone, class) pair in a single block-by-block read of
+    raster_path.
+    class_bins is a dictionary of {key: ClassBins}; several category scales
+    can share one read of the raster (e.g. one per regional scale).
+    Returns a dictionary of {key: array} where each array has shape
+    (zone_count, class_count) and row i holds the class counts (bins, then
+    special values) for zone id i+1.
+    Source nodata pixels and pixels outside all zones are never counted, and
+    blocks which fall entirely outside all zones are not read at all.
+    If workers is not 1 (0 means all cores) the blocks are split into strips
+    which are counted in parallel processes. Counts are integers summed in
+    strip order, so the result is identical to a serial run. This needs a file
+    based zone grid (e.g. from the zone cache); in-memory zone grids are always
+    counted serially.'''
+    ds = gdal.Open(raster_path)
+    windows = list(block_windows(ds.GetRasterBand(1)))
+    ds = None
+    zone_path = zone_ds.GetDescription()
+
+    if workers == 1 or not os.path.isfile(zone_path):
+        totals = count_zone_classes(raster_path, zone_ds, windows, zone_count, class_bins, feedback)
+    else:
+        # several strips per worker so that slow (mostly in-zone) strips are balanced out
+        strip_count = min(len(windows), worker_count(workers)*4)
+        strips = [windows[i*len(windows)//strip_count:(i+1)*len(windows)//strip_count] for i in range(strip_count)]
+        jobs = [(raster_path, zone_path, strip, zone_count, class_bins) for strip in strips]
+        totals = {key: np.zeros((zone_count+1)*(bins.class_count+1), dtype=np.int64) for key, bins in class_bins.items()}
+        for strip_totals in ordered_results(count_zone_classes_job, jobs, workers, feedback):
+            for key in totals.keys():
+                totals[key] += strip_totals[key]
+
+    return {key: total.reshape(zone_count+1, class_bins[key].class_count+1)[1:, :class_bins[key].class_count]
+            for key, total in totals.items()}
+
+
+def count_zone_classes(raster_path, zone_ds, windows, zone_count, class_bins, feedback=None):
+    '''Accumulate flat (zone, class) bincounts of raster_path over a list of
+    block windows. Returns a dictionary of {key: 1d array} for class_bins.'''
+    ds = gdal.Open(raster_path)
+    band = ds.GetRasterBand(1)
+    zone_band = zone_ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+
+    totals = {key: np.zeros((zone_count+1)*(bins.class_count+1), dtype=np.int64) for key, bins in class_bins.items()}
+
+    for i, (x_off, y_off, cols, rows) in enumerate(windows):
+        if feedback is not None:
+            if feedback.isCanceled():
+                break
+            feedback.setProgress(i/len(windows)*100)
+        zones = zone_band.ReadAsArray(x_off, y_off, cols, rows)
+        counted = zones > 0
+        if not counted.any():
+            continue
+        values = band.ReadAsArray(x_off, y_off, cols, rows)
+        counted &= ~nodata_mask(values, nodata)
+        values = values[counted]
+        zones = zones[counted].astype(np.int64)
+        for key, bins in class_bins.items():
+            pairs = zones*(bins.class_count+1)+bins.classify(values)
+            totals[key] += np.bincount(pairs, minlength=totals[key].size)
+    ds = None
+    return totals
+
+
+def count_zone_classes_job(raster_path, zone_path, windows, zone_count, class_bins):
+    '''Process pool job for count_zone_classes() which opens the zone grid
+    from its file in the worker process'''
+    zone_ds = gdal.Open(zone_path)
+    totals = count_zone_classes(raster_path, zone_ds, windows, zone_count, class_bins)
+    zone_ds = None
+    return totals
+
+
+def cumulative_zonal_stats(raster_paths, zone_ds, zone_count, feedback=None):
+    '''Generator which yields (means, medians) for the running pixel-wise sum
+    of raster_paths[:i+1] for each i, reading every raster only once. Both are
+    arrays of length zone_count where element i belongs to zone id i+1 (NaN if
+    the zone has no valid pixels).
+    This replaces running native:cellstatistics (sum, ignoring nodata) over a
+    growing stack of rasters followed by zonal mean/median statistics, which
+    reads months 1..n again for every n. Like cellstatistics, source nodata
+    pixels are skipped in the sum, and a pixel only counts towards the zone
+    statistics once it has had at least one valid value. All rasters must share
+    the grid of the zone grid.'''
+    zone_band = zone_ds.GetRasterBand(1)
+    # in-zone pixel indices per block of the zone grid, read once
+    block_pixels = []
+    zone_ids = []
+    for window in block_windows(zone_band):
+        zones = zone_band.ReadAsArray(*window).ravel()
+        pixels = np.flatnonzero((zones > 0)&(zones <= zone_count))
+        if pixels.size:
+            block_pixels.append((window, pixels))
+            zone_ids.append(zones[pixels])
+    zone_ids = np.concatenate(zone_ids) if zone_ids else np.zeros(0, dtype=np.uint16)
+    # pixels ordered by zone so that each zone is one contiguous slice
+    zone_order = np.argsort(zone_ids, kind='stable')
+    zone_bounds = np.searchsorted(zone_ids[zone_order], np.arange(1, zone_count+2))
+
+    sums = np.zeros(zone_ids.size, dtype=np.float64)
+    valid = np.zeros(zone_ids.size, dtype=bool)
+
+    for raster_path in raster_paths:
+        ds = gdal.Open(raster_path)
+        if (ds.RasterXSize, ds.RasterYSize) != (zone_ds.RasterXSize, zone_ds.RasterYSize):
+            raise ValueError(f'{raster_path} does not share the grid of the first raster')
+        band = ds.GetRasterBand(1)
+        nodata = band.GetNoDataValue()
+        start = 0
+        for window, pixels in block_pixels:
+            if feedback is not None and feedback.isCanceled():
+                return
+            values = band.ReadAsArray(*window).ravel()[pixels].astype(np.float64)
+            is_valid = ~nodata_mask(values, nodata)
+            end = start+pixels.size
+            sums[start:end] += np.where(is_valid, values, 0)
+            valid[start:end] |= is_valid
+            start = end
+        ds = None
+
+        zone_sums = sums[zone_order]
+        zone_valid = valid[zone_order]
+        means = np.full(zone_count, np.nan)
+        medians = np.full(zone_count, np.nan)
+        for i in range(zone_count):
+            values = zone_sums[zone_bounds[i]:zone_bounds[i+1]][zone_valid[zone_bounds[i]:zone_bounds[i+1]]]
+            if values.size:
+                means[i] = values.mean()
+                medians[i] = np.median(values)
+        yield means, medians
+
+
+def zone_windows(zone_ds, zone_count):
+    '''Returns a dictionary of {zone id: (x_off, y_off, x_size, y_size)} giving
+    the smallest pixel window of zone_ds which contains each zone'''
+    zone_band = zone_ds.GetRasterBand(1)
+    bounds = {}
+    for x_off, y_off, cols, rows in block_windows(zone_band):
+        zones = zone_band.ReadAsArray(x_off, y_off, cols, rows)
+        for zone_id in np.unique(zones[zones > 0]):
+            in_zone = zones == zone_id
+            zone_rows = np.flatnonzero(in_zone.any(axis=1))
+            zone_cols = np.flatnonzero(in_zone.any(axis=0))
+            x_min, x_max, y_min, y_max = bounds.get(int(zone_id), (zone_ds.RasterXSize, -1, zone_ds.RasterYSize, -1))
+            bounds[int(zone_id)] = (min(x_min, x_off+zone_cols[0]),
+                                    max(x_max, x_off+zone_cols[-1]),
+                                    min(y_min, y_off+zone_rows[0]),
+                                    max(y_max, y_off+zone_rows[-1]))
+    return {zone_id: (int(x_min), int(y_min), int(x_max-x_min+1), int(y_max-y_min+1))
+            for zone_id, (x_min, x_max, y_min, y_max) in bounds.items() if zone_id <= zone_count}
+
+
+def clip_to_zone(raster_path, zone_ds, zone_id, window, output_path, driver_name, nodata=-999, data_type=gdal.GDT_Int32):
+    '''Write the pixels of raster_path inside window to output_path, setting
+    pixels outside zone zone_id (and source nodata pixels) to nodata. This is
+    the zone grid equivalent of gdal:cliprasterbymasklayer with
+    CROP_TO_CUTLINE, since window is aligned to the source pixel grid.'''
+    x_off, y_off, x_size, y_size = window
+    src_ds = gdal.Open(raster_path)
+    src_band = src_ds.GetRasterBand(1)
+    src_nodata = src_band.GetNoDataValue()
+    zone_band = zone_ds.GetRasterBand(1)
+
+    gt = src_ds.GetGeoTransform()
+    out_ds = gdal.GetDriverByName(driver_name).Create(output_path, x_size, y_size, 1, data_type)
+    out_ds.SetGeoTransform((gt[0]+x_off*gt[1]+y_off*gt[2], gt[1], gt[2],
+                            gt[3]+x_off*gt[4]+y_off*gt[5], gt[4], gt[5]))
+    out_ds.SetProjection(src_ds.GetProjection())
+    out_band = out_ds.GetRasterBand(1)
+    out_band.SetNoDataValue(nodata)
+
+    for block_x, block_y, cols, rows in block_windows(src_band, window):
+        values = src_band.ReadAsArray(block_x, block_y, cols, rows)
+        outside = zone_band.ReadAsArray(block_x, block_y, cols, rows) != zone_id
+        outside |= nodata_mask(values, src_nodata)
+        out_band.WriteArray(np.where(outside, nodata, values), block_x-x_off, block_y-y_off)
+    out_band.FlushCache()
+    out_ds = None
+    src_ds = None
+    return output_path
@@ -0,0 +1,126 @@
+'''
+Persistent on-disk cache of rasterized district zone grids.
+
+Zone grids are stored as compressed GeoTIFFs (with a small json sidecar
+holding the district names) in the QGIS settings folder. Each entry is keyed
+by the content hash of the district layer, the district name field and the
+target raster geotransform, size and CRS, so every algorithm which summarises
+rasters sharing one grid reuses a single zone grid and never rasterizes the
+district polygons again until the district layer changes.
+Least recently used entries are evicted once the cache exceeds
+CACHE_SIZE_LIMIT bytes.
+'''
+
+from qgis.core import QgsApplication, QgsProviderRegistry, QgsVectorLayer
+
+from zonal_stats import district_zone_grid
+from osgeo import gdal
+import hashlib
+import json
+import os
+
+CACHE_DIR = os.path.join(QgsApplication.qgisSettingsDirPath(), 'rangeland_tools', 'zone_cache')
+CACHE_SIZE_LIMIT = 512*1024*1024
+
+
+def district_layer_hash(districts, name_field):
+    '''Hash the content of the file behind a district layer, or the features
+    themselves when the districts do not come from a file (e.g. memory layers
+    or processing feature sources)'''
+    h = hashlib.sha1()
+    h.update(name_field.encode())
+    h.update(districts.sourceCrs().toWkt().encode())
+    if isinstance(districts, QgsVectorLayer):
+        uri_parts = QgsProviderRegistry.instance().decodeUri(districts.providerType(), districts.source())
+        path = uri_parts.get('path', '')
+        if path and os.path.isfile(path):
+            h.update(str(uri_parts.get('layerName', '')).encode())
+            h.update(districts.subsetString().encode())
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024*1024), b''):
+                    h.update(chunk)
+            return h.hexdigest()
+    for f in districts.getFeatures():
+        h.update(str(f[name_field]).encode())
+        h.update(bytes(f.geometry().asWkb()))
+    return h.hexdigest()
+
+
+def zone_grid_key(districts, name_field, raster_path):
+    '''Cache key for the zone grid of districts on the grid of raster_path'''
+    raster_ds = gdal.Open(raster_path)
+    h = hashlib.sha1()
+    h.update(district_layer_hash(districts, name_field).encode())
+    h.update(repr(raster_ds.GetGeoTransform()).encode())
+    h.update(repr((raster_ds.RasterXSize, raster_ds.RasterYSize)).encode())
+    h.update(raster_ds.GetProjection().encode())
+    raster_ds = None
+    return h.hexdigest()
+
+
+def cached_district_zone_grid(districts, name_field, raster_path, transform_context, feedback=None):
+    '''Drop in replacement for zonal_stats.district_zone_grid() which returns
+    the zone grid from the cache when available, and rasterizes and stores it
+    otherwise. Falls back to the in-memory zone grid if the cache folder can't
+    be written.'''
+    key = zone_grid_key(districts, name_field, raster_path)
+    grid_path = os.path.join(CACHE_DIR, f'{key}.tif')
+    names_path = os.path.join(CACHE_DIR, f'{key}.json')
+
+    if os.path.isfile(grid_path) and os.path.isfile(names_path):
+        zone_ds = gdal.Open(grid_path)
+        if zone_ds is not None:
+            with open(names_path) as f:
+                zone_names = json.load(f)
+            # touch entry so that it is the most recently used
+            os.utime(grid_path)
+            os.utime(names_path)
+            if feedback is not None:
+                feedback.pushInfo('Using cached district zone grid')
+            return zone_ds, zone_names
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+    except OSError as e:
+        if feedback is not None:
+            feedback.pushWarning(f'Could not cache district zone grid: {e}')
+        return district_zone_grid(districts, name_field, raster_path, transform_context)
+    # rasterize straight to a tiled GeoTIFF so that large grids are never held in memory
+    tmp_path = os.path.join(CACHE_DIR, f'{key}.tmp.tif')
+    zone_ds, zone_names = district_zone_grid(districts, name_field, raster_path, transform_context, tmp_path)
+    if zone_ds is None:
+        return district_zone_grid(districts, name_field, raster_path, transform_context)
+    zone_ds = None
+    with open(names_path, 'w') as f:
+        json.dump(zone_names, f)
+    os.replace(tmp_path, grid_path)
+    evict_zone_grids(keep=key)
+    return gdal.Open(grid_path), zone_names
+
+
+def evict_zone_grids(keep=None, size_limit=CACHE_SIZE_LIMIT):
+    '''Delete least recently used zone grids until the cache is no larger
+    than size_limit bytes. The entry named by keep is never deleted.'''
+    if not os.path.isdir(CACHE_DIR):
+        return
+    entries = []
+    for file in os.scandir(CACHE_DIR):
+        if file.name.endswith('.tif') and not file.name.endswith('.tmp.tif'):
+            key = file.name[:-len('.tif')]
+            names_path = os.path.join(CACHE_DIR, f'{key}.json')
+            size = file.stat().st_size
+            if os.path.isfile(names_path):
+                size += os.path.getsize(names_path)
+            entries.append((file.stat().st_mtime, size, key))
+    total_size = sum(entry[1] for entry in entries)
+    for mtime, size, key in sorted(entries):
+        if total_size <= size_limit:
+            break
+        if key == keep:
+            continue
+        for ext in ('.tif', '.json'):
+            try:
+                os.remove(os.path.join(CACHE_DIR, f'{key}{ext}'))
+            except OSError:
+                pass
+        total_size -= size
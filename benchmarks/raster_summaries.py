@@ -0,0 +1,329 @@
+'''
+Benchmark of the Feed Outlook raster summary algorithms on synthetic data.
+
+Generates synthetic TSDM, TSDM percentile, fire risk, percentile growth and
+monthly growth rasters over the Northern Territory at a configurable pixel
+size, plus a synthetic pastoral district layer with the same district names,
+field and CRS as data/DISTRICTS.gpkg (and jagged boundaries with many
+vertices, like the real ones). Each summary algorithm is then run end to end
+in a standalone (headless) QgsApplication, and the time spent in each of its
+processing steps and the peak resident memory are reported.
+
+Run with the python interpreter which ships with QGIS, e.g.
+
+    python benchmarks/raster_summaries.py --profile 250m --repeat 3 --csv bench.csv
+
+Each run uses an empty zone grid cache first (cold) and then the cache it
+filled (warm). Generated data is kept in --data-dir (default: a temporary
+folder) and reused when the profile matches, since generating 30 m rasters
+takes a while.
+'''
+
+import argparse
+import csv
+import datetime
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from qgis.core import (QgsApplication, QgsProcessingContext, QgsProcessingFeedback,
+                        QgsVectorLayer)
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(PLUGIN_DIR, 'algs'))
+
+# Northern Territory extent of data/DISTRICTS.gpkg (EPSG:4326)
+NT_EXTENT = (129.0, -26.0, 138.0, -10.9)
+
+# pixel size (degrees), raster format and creation options
+PROFILES = {'5km': (0.05, 'HFA', []),# native AussieGRASS resolution
+            '250m': (0.0025, 'HFA', []),
+            '30m': (0.0003, 'HFA', []),
+            'tiled': (0.0025, 'GTiff', ['TILED=YES', 'COMPRESS=DEFLATE'])}
+
+DISTRICT_NAMES = ['Darwin', 'V.R.D.', 'Katherine', 'Roper', 'Sturt Plateau', 'Gulf', 'Barkly',
+                  'Tennant Creek', 'Northern Alice Springs', 'Plenty', 'Southern Alice Springs']
+NORTHERN_DISTRICTS = ['Darwin', 'V.R.D.', 'Victoria River', 'Katherine', 'Roper', 'Sturt Plateau', 'Gulf', 'Barkly']
+
+SCALE_VALUES = {'Northern Scale': [0, 1000, 2000, 3000],
+                'Southern Scale': [0, 250, 500, 1000],
+                'Custom Scale': [0, 0, 0, 0]}
+
+# step names of each algorithm (in the order of its multi-step feedback)
+ALGORITHM_STAGES = {'TSDMSummary': ['zone grid', 'read/count TSDM', 'read/count percentile', 'spreadsheet export'],
+                    'FireRiskSummary': ['zone grid', 'read/count', 'spreadsheet export'],
+                    'TotalGrowthSummary': ['cell statistics', 'zone grid', 'read/count', 'spreadsheet export'],
+                    'RelativeGrowthSummary': ['zone grid', 'read/count', 'spreadsheet export']}
+
+
+class StageTimingFeedback(QgsProcessingFeedback):
+    '''Feedback which records when overall progress first enters each step of
+    an algorithm's multi-step feedback'''
+
+    def __init__(self, step_count):
+        super().__init__()
+        self.step_count = step_count
+        self.step_starts = {}
+        self.progressChanged.connect(self.progress_changed)
+
+    def progress_changed(self, progress):
+        step = min(int(progress/100*self.step_count), self.step_count-1)
+        self.step_starts.setdefault(step, time.perf_counter())
+
+    def stage_times(self, start, end):
+        '''Returns a list of seconds spent in each step'''
+        starts = dict(self.step_starts)
+        starts[0] = start
+        bounds = [starts.get(step) for step in range(self.step_count)]+[end]
+        # a step which reported no progress is counted as taking no time
+        for step in range(self.step_count-1, -1, -1):
+            if bounds[step] is None:
+                bounds[step] = bounds[step+1]
+        return [bounds[step+1]-bounds[step] for step in range(self.step_count)]
+
+
+def reset_peak_rss():
+    '''Reset the peak resident set size of this process (Linux only)'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    '''Peak resident set size of this process and of finished worker processes'''
+    own = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    own = int(line.split()[1])/1024
+                    break
+    except OSError:
+        pass
+    try:
+        import resource
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024
+        if own is None:
+            own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    except ImportError:
+        children = None
+    return own, children
+
+
+def write_raster(path, driver_name, options, pixel_size, data_type, nodata, fill_block):
+    '''Create a raster over NT_EXTENT, filling it block by block with
+    fill_block(rng, rows, cols) so that large rasters are never held in memory'''
+    from osgeo import gdal, osr
+    xmin, ymin, xmax, ymax = NT_EXTENT
+    cols = int(round((xmax-xmin)/pixel_size))
+    rows = int(round((ymax-ymin)/pixel_size))
+    ds = gdal.GetDriverByName(driver_name).Create(path, cols, rows, 1, data_type, options=options)
+    ds.SetGeoTransform((xmin, pixel_size, 0, ymax, 0, -pixel_size))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    rng = np.random.default_rng(zlib.crc32(os.path.basename(path).encode()))
+    block_rows = max(1, 4*1024*1024//cols)
+    for y_off in range(0, rows, block_rows):
+        block = fill_block(rng, min(block_rows, rows-y_off), cols)
+        # a strip along the western edge is nodata, so that nodata handling is exercised
+        block[:, :cols//200] = nodata
+        band.WriteArray(block, 0, y_off)
+    ds = None
+    return path
+
+
+def with_specials(values, rng, specials, fraction=0.02):
+    '''Replace a fraction of values with special values (water, fire scars etc)'''
+    mask = rng.random(values.shape) < fraction
+    values[mask] = rng.choice(specials, size=mask.sum())
+    return values
+
+
+def write_districts(path, vertices_per_boundary):
+    '''Synthetic districts: 11 bands across the NT separated by jagged
+    boundaries, with a DISTRICT name field, in EPSG:4326'''
+    from osgeo import ogr, osr
+    xmin, ymin, xmax, ymax = NT_EXTENT
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    ds = ogr.GetDriverByName('GPKG').CreateDataSource(path)
+    lyr = ds.CreateLayer('DISTRICTS', srs=srs, geom_type=ogr.wkbMultiPolygon)
+    lyr.CreateField(ogr.FieldDefn('DISTRICT', ogr.OFTString))
+    xs = np.linspace(xmin, xmax, vertices_per_boundary)
+    rng = np.random.default_rng(0)
+    band_height = (ymax-ymin)/len(DISTRICT_NAMES)
+    # boundary i separates district i-1 (north) from district i (south)
+    boundaries = [np.full(xs.size, ymax)]
+    for i in range(1, len(DISTRICT_NAMES)):
+        wobble = np.cumsum(rng.normal(0, band_height/50, xs.size))
+        wobble = np.clip(wobble-wobble.mean(), -band_height/3, band_height/3)
+        boundaries.append(ymax-i*band_height+wobble)
+    boundaries.append(np.full(xs.size, ymin))
+    for i, name in enumerate(DISTRICT_NAMES):
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in zip(xs, boundaries[i]):
+            ring.AddPoint_2D(float(x), float(y))
+        for x, y in zip(xs[::-1], boundaries[i+1][::-1]):
+            ring.AddPoint_2D(float(x), float(y))
+        ring.CloseRings()
+        polygon = ogr.Geometry(ogr.wkbPolygon)
+        polygon.AddGeometry(ring)
+        multi_polygon = ogr.Geometry(ogr.wkbMultiPolygon)
+        multi_polygon.AddGeometry(polygon)
+        feat = ogr.Feature(lyr.GetLayerDefn())
+        feat.SetField('DISTRICT', name)
+        feat.SetGeometry(multi_polygon)
+        lyr.CreateFeature(feat)
+    ds = None
+    return path
+
+
+def generate_data(data_dir, profile, vertices_per_boundary):
+    '''Generate (or reuse) the synthetic inputs for a profile'''
+    from osgeo import gdal
+    pixel_size, driver_name, options = PROFILES[profile]
+    ext = '.img' if driver_name == 'HFA' else '.tif'
+    folder = os.path.join(data_dir, profile)
+    growth_folder = os.path.join(folder, 'monthly_growth')
+    os.makedirs(growth_folder, exist_ok=True)
+
+    def raster(name, data_type, nodata, fill_block, out_folder=folder, driver_name=driver_name, options=options, ext=ext):
+        path = os.path.join(out_folder, name+ext)
+        if not os.path.isfile(path):
+            print(f'Generating {path}', flush=True)
+            write_raster(path, driver_name, options, pixel_size, data_type, nodata, fill_block)
+        return path
+
+    data = {}
+    data['tsdm'] = raster('tsdm', gdal.GDT_Int16, -999,
+                        lambda rng, rows, cols: rng.gamma(2, 800, (rows, cols)).astype(np.int16))
+    data['tsdm_pcnt'] = raster('tsdm_pcnt', gdal.GDT_Int16, -999,
+                        lambda rng, rows, cols: with_specials(rng.integers(0, 101, (rows, cols)).astype(np.int16), rng, [253, 254]))
+    data['fire_risk'] = raster('fire_risk', gdal.GDT_Int16, -999,
+                        lambda rng, rows, cols: with_specials(rng.integers(0, 41, (rows, cols)).astype(np.int16), rng, [253, -2]))
+    data['pcnt_growth'] = raster('pcnt_growth', gdal.GDT_Int16, -999,
+                        lambda rng, rows, cols: with_specials(rng.integers(0, 101, (rows, cols)).astype(np.int16), rng, [253, 254, 255]))
+    # Total growth summary only reads .img files, so monthly growth is always written as HFA
+    for month in range(12):
+        year = 2023 if month < 6 else 2024
+        raster(f'{year}{(month+6)%12+1:02d}.01months.growth.tot.nt', gdal.GDT_Int16, -999,
+                lambda rng, rows, cols: rng.gamma(1.5, 60, (rows, cols)).astype(np.int16), growth_folder, 'HFA', [], '.img')
+    data['growth_folder'] = growth_folder
+    data['districts'] = os.path.join(folder, 'districts.gpkg')
+    if not os.path.isfile(data['districts']):
+        write_districts(data['districts'], vertices_per_boundary)
+    return data
+
+
+def algorithm_runs(data, output_dir, parallel):
+    '''Returns a list of (name, algorithm class, parameters)'''
+    from Fire_risk_summary import FireRiskSummary
+    from TSDM_summary import TSDMSummary
+    from Total_growth_summary import TotalGrowthSummary
+    from Relative_growth_summary import RelativeGrowthSummary
+
+    districts = QgsVectorLayer(data['districts'], 'districts', 'ogr')
+    regions = {name: 'Northern' if name in NORTHERN_DISTRICTS else 'Southern' for name in DISTRICT_NAMES}
+    custom_params = [SCALE_VALUES, regions]
+    return [('TSDMSummary', TSDMSummary, {'TSDM': data['tsdm'],
+                                        'TSDM_PCNT': data['tsdm_pcnt'],
+                                        'DISTRICTS': districts,
+                                        'CUSTOM_PARAMS': custom_params,
+                                        'PARALLEL': parallel,
+                                        'XL_SUMMARY': os.path.join(output_dir, 'tsdm.xlsx')}),
+            ('FireRiskSummary', FireRiskSummary, {'FIRE_RISK': data['fire_risk'],
+                                        'DISTRICTS': districts,
+                                        'PARALLEL': parallel,
+                                        'XL_SUMMARY': os.path.join(output_dir, 'fire_risk.xlsx')}),
+            ('TotalGrowthSummary', TotalGrowthSummary, {'INPUT_FOLDER': data['growth_folder'],
+                                        'DISTRICT_LAYER': districts,
+                                        'CUSTOM_PARAMS': custom_params,
+                                        'PARALLEL': parallel,
+                                        'OUTPUT_XSLX': os.path.join(output_dir, 'total_growth.xlsx')}),
+            ('RelativeGrowthSummary', RelativeGrowthSummary, {'PERCENTILE_GROWTH_RASTER': data['pcnt_growth'],
+                                        'DISTRICT_LAYER': districts,
+                                        'DISTRICT_NAME_FIELD': 'DISTRICT',
+                                        'PARALLEL': parallel,
+                                        'OUTPUT_XSLX': os.path.join(output_dir, 'relative_growth.xlsx')})]
+
+
+def run_benchmark(name, alg_class, parameters):
+    '''Run one algorithm and return (total seconds, stage seconds, peak rss)'''
+    import processing
+    stages = ALGORITHM_STAGES[name]
+    context = QgsProcessingContext()
+    feedback = StageTimingFeedback(len(stages))
+    reset_peak_rss()
+    start = time.perf_counter()
+    processing.run(alg_class().create(), parameters, context=context, feedback=feedback)
+    end = time.perf_counter()
+    return end-start, feedback.stage_times(start, end), peak_rss_mb()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='250m')
+    parser.add_argument('--repeat', type=int, default=1, help='warm runs of each algorithm')
+    parser.add_argument('--algorithms', nargs='*', choices=sorted(ALGORITHM_STAGES), help='default: all')
+    parser.add_argument('--parallel', action='store_true', help='count pixels in parallel processes')
+    parser.add_argument('--vertices', type=int, default=2000, help='vertices per synthetic district boundary')
+    parser.add_argument('--data-dir', help='folder for generated data (kept between runs)')
+    parser.add_argument('--csv', help='append results to this csv file')
+    args = parser.parse_args()
+
+    qgs = QgsApplication([], False)
+    qgs.initQgis()
+    from processing.core.Processing import Processing
+    Processing.initialize()
+
+    import zone_cache
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='rangeland_bench_')
+    output_dir = tempfile.mkdtemp(prefix='rangeland_bench_out_')
+    data = generate_data(data_dir, args.profile, args.vertices)
+
+    rows = []
+    for name, alg_class, parameters in algorithm_runs(data, output_dir, args.parallel):
+        if args.algorithms and name not in args.algorithms:
+            continue
+        # cold run with an empty zone grid cache, then warm runs which reuse it
+        zone_cache.CACHE_DIR = tempfile.mkdtemp(prefix='rangeland_bench_cache_')
+        for run in ['cold']+['warm']*args.repeat:
+            total, stage_times, (rss, child_rss) = run_benchmark(name, alg_class, parameters)
+            stage_text = ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in zip(ALGORITHM_STAGES[name], stage_times))
+            print(f'{name} ({run}): {total:.2f}s [{stage_text}] peak RSS {rss:.0f} MB'
+                  +(f' (workers {child_rss:.0f} MB)' if args.parallel and child_rss else ''), flush=True)
+            rows.append({'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                         'profile': args.profile,
+                         'algorithm': name,
+                         'run': run,
+                         'parallel': args.parallel,
+                         'total_s': round(total, 3),
+                         'stages_s': ';'.join(f'{stage}={seconds:.3f}' for stage, seconds in zip(ALGORITHM_STAGES[name], stage_times)),
+                         'peak_rss_mb': None if rss is None else round(rss),
+                         'worker_peak_rss_mb': None if child_rss is None else round(child_rss)})
+
+    if args.csv and rows:
+        new_file = not os.path.isfile(args.csv)
+        with open(args.csv, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            if new_file:
+                writer.writeheader()
+            writer.writerows(rows)
+
+    qgs.exitQgis()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,9 +9,9 @@ from qgis.PyQt.QtGui import (QIcon, QCursor, QColor)
 
 from qgis.core import (QgsProject, QgsFieldProxyModel, QgsMapLayerProxyModel,
                         QgsVectorLayer, QgsField, QgsGeometry, QgsFeature,
-                        QgsCoordinateTransform, QgsFeatureRequest, QgsProject,
+                        QgsFeatureRequest, QgsProject,
                         QgsCoordinateReferenceSystem, QgsApplication,
-                        QgsRectangle, QgsCoordinateTransform, QgsWkbTypes,
+                        QgsRectangle, QgsWkbTypes,
                         QgsRasterLayer, QgsStyle, QgsSymbol, QgsProperty,
                         QgsSymbolLayer, QgsRendererCategory, QgsSpatialIndex,
                         QgsCategorizedSymbolRenderer, QgsFields, NULL)
@@ -20,6 +20,10 @@ from qgis.gui import (QgsMapLayerComboBox, QgsFieldComboBox, QgsMapCanvas,
                         QgsFileWidget, QgsMapToolPan, QgsMapTool,
                         QgsRubberBand)
 
+# algs folder is added to sys.path by the processing provider
+from transforms import transformed_geom
+from band_rings import distance_bands
+from watered_area_cache import WateredAreaCache
 import processing
 import os
 
@@ -439,60 +443,52 @@ class CustomWateredAreasWidget(QWidget):
         self.wa3km_lyr.dataProvider().deleteFeatures([ft.id() for ft in self.wa3km_lyr.getFeatures()])
         self.wa5km_lyr.dataProvider().deleteFeatures([ft.id() for ft in self.wa5km_lyr.getFeatures()])
         
-        for row in range(self.tbl.rowCount()):
-            # Get data from first cell of each row
-            pdk_info = self.tbl.item(row, 0).data(Qt.DisplayRole)
-            pdk_name = pdk_info.split('(')[0]
-            pdk_id = int(pdk_info.split('(')[1].split(')')[0])
-            pdk_ft = self.pdk_lyr.getFeature(pdk_id)
-            pdk_geom = self.transformed_geom(pdk_ft.geometry(), pdk_crs, wa_crs)
-            # get data from second cell of each row,
-            wp_info = self.tbl.item(row, 1).data(Qt.DisplayRole)
-            # extract ids as integers
-            wp_ids = self.parse_waterpoints(wp_info)
-            # get list of water point features
-            wp_fts = [self.wp_lyr.getFeature(id) for id in wp_ids]
-            # get list of waterpoint geometries
-            wp_geoms = [self.transformed_geom(ft.geometry(), wp_crs, wa_crs) for ft in wp_fts]
-            # collect
-            all_wp_geom = QgsGeometry.collectGeometry(wp_geoms)
-            # buffer 3km
-            buff_geom_3km = all_wp_geom.buffer(3000.0, 25)
-            # buffer 5km
-            buff_geom_5km = all_wp_geom.buffer(5000.0, 25)
-            # and clip with transformed paddock geometry.
-            pdk_3km_wa = buff_geom_3km.intersection(pdk_geom)
-            # and clip with transformed paddock geometry.
-            pdk_5km_wa = buff_geom_5km.intersection(pdk_geom)
+        # watered areas of paddocks (and waterpoints) which have not changed since the last run come from the cache
+        with WateredAreaCache(wa_crs) as wa_cache:
+            for row in range(self.tbl.rowCount()):
+                # Get data from first cell of each row
+                pdk_info = self.tbl.item(row, 0).data(Qt.DisplayRole)
+                pdk_name = pdk_info.split('(')[0]
+                pdk_id = int(pdk_info.split('(')[1].split(')')[0])
+                pdk_ft = self.pdk_lyr.getFeature(pdk_id)
+                pdk_geom = self.transformed_geom(pdk_ft.geometry(), pdk_crs, wa_crs)
+                # get data from second cell of each row,
+                wp_info = self.tbl.item(row, 1).data(Qt.DisplayRole)
+                # extract ids as integers
+                wp_ids = self.parse_waterpoints(wp_info)
+                # get list of water point features
+                wp_fts = [self.wp_lyr.getFeature(id) for id in wp_ids]
+                # get list of waterpoint geometries
+                wp_geoms = [self.transformed_geom(ft.geometry(), wp_crs, wa_crs) for ft in wp_fts]
+                # buffer 3km & 5km and clip with transformed paddock geometry.
+                pdk_3km_wa = wa_cache.watered_area(pdk_geom, wp_geoms, 3000.0)
+                pdk_5km_wa = wa_cache.watered_area(pdk_geom, wp_geoms, 5000.0)
             
-            # Then create features, add geometry from clipped buffers and add attributes
-            # 3km
-            feat_3km = QgsFeature(self.wa3km_lyr.fields())
-            feat_3km.setGeometry(pdk_3km_wa)
-            feat_3km.setAttributes([pdk_name, pdk_id, str(wp_info)])
-            # and add feature to watered area layer.
-            self.wa3km_lyr.dataProvider().addFeatures([feat_3km])
-            self.wa3km_lyr.updateExtents()
-            self.wa3km_lyr.triggerRepaint()
-            # 5km
-            feat_5km = QgsFeature(self.wa5km_lyr.fields())
-            feat_5km.setGeometry(pdk_5km_wa)
-            feat_5km.setAttributes([pdk_name, pdk_id, str(wp_info)])
-            # and add feature to watered area layer.
-            self.wa5km_lyr.dataProvider().addFeatures([feat_5km])
-            self.wa5km_lyr.updateExtents()
-            self.wa5km_lyr.triggerRepaint()
+                # Then create features, add geometry from clipped buffers and add attributes
+                # 3km
+                feat_3km = QgsFeature(self.wa3km_lyr.fields())
+                feat_3km.setGeometry(pdk_3km_wa)
+                feat_3km.setAttributes([pdk_name, pdk_id, str(wp_info)])
+                # and add feature to watered area layer.
+                self.wa3km_lyr.dataProvider().addFeatures([feat_3km])
+                self.wa3km_lyr.updateExtents()
+                self.wa3km_lyr.triggerRepaint()
+                # 5km
+                feat_5km = QgsFeature(self.wa5km_lyr.fields())
+                feat_5km.setGeometry(pdk_5km_wa)
+                feat_5km.setAttributes([pdk_name, pdk_id, str(wp_info)])
+                # and add feature to watered area layer.
+                self.wa5km_lyr.dataProvider().addFeatures([feat_5km])
+                self.wa5km_lyr.updateExtents()
+                self.wa5km_lyr.triggerRepaint()
+        
                         
         self.canvas.refresh()
         self.set_canvas_layers()
             
             
     def transformed_geom(self, g, orig_crs, target_crs):
-        geom_copy = QgsGeometry().fromWkt(g.asWkt())
-        if orig_crs != target_crs:
-            xform = QgsCoordinateTransform(orig_crs, target_crs, QgsProject.instance())
-            geom_copy.transform(xform)
-        return geom_copy
+        return transformed_geom(g, orig_crs, target_crs, QgsProject.instance())
             
 
     def parse_waterpoints(self, data_string):
@@ -659,49 +655,22 @@ class CustomWateredAreasWidget(QWidget):
             waterpoint_geoms = [self.transformed_geom(wp.geometry(), wpt_crs, tgt_crs) for wp in self.wp_lyr.getFeatures(wpt_ids)]
 #----------------------------
             if waterpoint_geoms:
-                buffer_distance = band_width
-                band_count = 0
-                band_intersects = True
-                # dissolved buffer of all paddock waterpoints
-                # this will be the first 'band' (just a buffer around waterpoint)
-                first_buffer = QgsGeometry.unaryUnion([geom.buffer(buffer_distance, 25) for geom in waterpoint_geoms])
-                # print(f'Band count: {band_count}')
-                if band_count == 0:
-                    if first_buffer.intersects(pdk_geom):
-                        clipped_to_pdk = first_buffer.intersection(pdk_geom)
-                        area_ha = round(clipped_to_pdk.area()/10000, 2)
-                        pcnt = round((clipped_to_pdk.area()/pdk_geom.area())*100, 7)
-                        feat = QgsFeature(dtw_band_flds)
-                        feat.setGeometry(clipped_to_pdk)
-                        feat.setAttributes([pdk_name, pdk_area, f'0-{buffer_distance}m', buffer_distance, area_ha, pcnt])
-                        feats.append(feat)
-                    buffer_distance+=band_width
-                    band_count+=1
-                # these will be 'band buffers' composed of difference between current & previous buffer
-                # break the loop if the last buffer does not intersect the paddock
-                while band_intersects and band_count < 500:
-                    # print(f'Band count: {band_count}')
-                    outer_ring = QgsGeometry.unaryUnion([geom.buffer(buffer_distance, 25) for geom in waterpoint_geoms])
-                    inner_ring = QgsGeometry.unaryUnion([geom.buffer(buffer_distance-band_width, 25) for geom in waterpoint_geoms])
-                    dtw_band = outer_ring.difference(inner_ring)
-                    if dtw_band.intersects(pdk_geom):
-                        clipped_to_pdk = dtw_band.intersection(pdk_geom)
-                        area_ha = round(clipped_to_pdk.area()/10000, 2)
-                        pcnt = round((clipped_to_pdk.area()/pdk_geom.area())*100, 7)
-                        feat = QgsFeature(dtw_band_flds)
-                        feat.setGeometry(clipped_to_pdk)
-                        feat.setAttributes([pdk_name,
-                                            pdk_area,
-                                            f'{buffer_distance-band_width}-{buffer_distance}m',
-                                            buffer_distance,
-                                            area_ha,
-                                            pcnt])
-                        feats.append(feat)
-                        buffer_distance+=band_width
-                        band_count+=1
-                    else:
-                        band_intersects = False
-                pdk_max_dist_to_water = band_count*band_width
+                # dissolved buffer rings around all paddock waterpoints, clipped to the paddock
+                # the first 'band' is just a buffer around the waterpoints
+                bands = distance_bands(waterpoint_geoms, pdk_geom, band_width)
+                for inner_distance, outer_distance, clipped_to_pdk in bands:
+                    area_ha = round(clipped_to_pdk.area()/10000, 2)
+                    pcnt = round((clipped_to_pdk.area()/pdk_geom.area())*100, 7)
+                    feat = QgsFeature(dtw_band_flds)
+                    feat.setGeometry(clipped_to_pdk)
+                    feat.setAttributes([pdk_name,
+                                        pdk_area,
+                                        f'{inner_distance}-{outer_distance}m',
+                                        outer_distance,
+                                        area_ha,
+                                        pcnt])
+                    feats.append(feat)
+                pdk_max_dist_to_water = bands[-1][1] if bands else band_width
                 pdk_max_dtws[pdk_name] = pdk_max_dist_to_water
         
         for ft in feats:
@@ -895,7 +864,4 @@ class SelectTool(QgsMapTool):
     def transformed_geom(self, g):
         '''Convenience method to transform rectangle rubber band from
         canvas CRS to waterpoint layer CRS to retrieve waterpoints'''
-        geom = QgsGeometry.fromWkt(g.asWkt())
-        xform = QgsCoordinateTransform(self.project.crs(), self.wp_layer.crs(), self.project)
-        geom.transform(xform)
-        return geom
+        return transformed_geom(g, self.project.crs(), self.wp_layer.crs(), self.project)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the algorithm helpers import each other as top level modules, as they do
+# when the processing provider puts the algs folder on sys.path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'algs'))
@@ -0,0 +1,82 @@
+'''
+ClassBins counts against the boolean mask counts they replaced in the raster
+summary algorithms.
+'''
+
+import numpy as np
+import pytest
+
+from class_bins import ClassBins, scale_bins, scale_error
+
+
+@pytest.fixture
+def raster():
+    rng = np.random.default_rng(0)
+    values = rng.integers(-5, 300, size=(200, 300)).astype(np.float32)
+    # values exactly on every edge, plus nodata
+    values[0, :12] = [0, 10, 20, 30, 40, 70, 80, 90, 100, 250, 500, 1000]
+    values[1, :3] = np.nan
+    return values
+
+
+def test_fire_risk_bins(raster):
+    counts = ClassBins([0, 20, 30, 40], special_values=[253, -2]).counts(raster)
+    expected = [((raster > 0) & (raster <= 20)).sum(),
+                ((raster > 20) & (raster <= 30)).sum(),
+                ((raster > 30) & (raster <= 40)).sum(),
+                (raster == 253).sum(),
+                (raster == -2).sum()]
+    assert counts.tolist() == expected
+
+
+def test_percentile_growth_bins(raster):
+    counts = ClassBins([0, 10, 20, 30, 70, 80, 90, 100], special_values=[255, 254, 253]).counts(raster)
+    edges = [0, 10, 20, 30, 70, 80, 90, 100]
+    expected = [((raster > low) & (raster <= high)).sum() for low, high in zip(edges[:-1], edges[1:])]
+    expected += [(raster == 255).sum(), (raster == 254).sum(), (raster == 253).sum()]
+    assert counts.tolist() == expected
+
+
+def test_tsdm_percentile_bins_include_lowest(raster):
+    counts = ClassBins([0, 30, 70, 100], special_values=[253, 254], include_lowest=True).counts(raster)
+    expected = [((raster >= 0) & (raster <= 30)).sum(),
+                ((raster > 30) & (raster <= 70)).sum(),
+                ((raster > 70) & (raster <= 100)).sum(),
+                (raster == 253).sum(),
+                (raster == 254).sum()]
+    assert counts.tolist() == expected
+
+
+@pytest.mark.parametrize('scale', [[0, 1000, 2000, 3000], [0, 250, 500, 1000], [5, 50, 60, 200]])
+def test_scale_bins(raster, scale):
+    bottom, low, mod, high = scale
+    counts = scale_bins(scale).counts(raster)
+    expected = [((raster >= bottom) & (raster <= low)).sum(),
+                ((raster > low) & (raster <= mod)).sum(),
+                ((raster > mod) & (raster <= high)).sum(),
+                (raster > high).sum()]
+    assert counts.tolist() == expected
+
+
+def test_special_values_take_precedence():
+    bins = ClassBins([0, 100, 300], special_values=[253])
+    assert bins.classify(np.array([50.0, 253.0, 400.0, np.nan])).tolist() == [0, 2, 3, 3]
+
+
+def test_edges_must_increase():
+    with pytest.raises(ValueError):
+        ClassBins([0, 20, 20, 40])
+
+
+@pytest.mark.parametrize('scale', [[0, 500, 1000, 0], [0, 500, 500, 1000], [0, 0, 0, 0]])
+def test_custom_scales_which_are_not_increasing_are_rejected(scale):
+    # e.g. a blank High cell (0) or a repeated value in the custom scale table
+    error = scale_error('Custom Scale', scale)
+    assert error is not None and 'Custom Scale' in error
+    with pytest.raises(ValueError):
+        scale_bins(scale)
+
+
+@pytest.mark.parametrize('scale', [[0, 1000, 2000, 3000], [0, 250, 500, 1000]])
+def test_default_scales_are_accepted(scale):
+    assert scale_error('Northern Scale', scale) is None
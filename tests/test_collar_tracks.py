@@ -0,0 +1,33 @@
+'''
+Sheet names of the tracks of each collar in the multi-collar batch mode of
+Daily movement stats.
+'''
+
+import pytest
+
+pytest.importorskip('qgis.core')
+
+from collar_tracks import SHEET_NAME_LENGTH, sheet_name
+
+
+def test_sheet_names_keep_the_collar_id_and_fit_excel():
+    used = set()
+    paddock = 'A very long paddock name indeed'
+    names = [sheet_name(collar, paddock, used) for collar in ('1234567', '1234568', '1234569')]
+    assert all(len(name) <= SHEET_NAME_LENGTH for name in names)
+    assert [name.split('_')[0] for name in names] == ['1234567', '1234568', '1234569']
+    assert names[0] == '1234567_A very long paddock nam'
+
+
+def test_sheet_names_are_unique():
+    used = set()
+    long_id = 'collar-' + 'x'*30
+    names = [sheet_name(long_id, 'Paddock', used) for _ in range(12)]
+    names.append(sheet_name(long_id.upper(), 'PADDOCK', used))
+    assert len({name.lower() for name in names}) == len(names)
+    assert all(len(name) <= SHEET_NAME_LENGTH for name in names)
+    assert names[1].endswith('_2') and names[11].endswith('_12')
+
+
+def test_sheet_names_replace_characters_excel_does_not_allow():
+    assert sheet_name('12/3', 'Bore [north]?', set()) == '12_3_Bore _north__'
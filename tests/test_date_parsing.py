@@ -0,0 +1,76 @@
+'''
+datetime_parser() against datetime.strptime(), which it replaces in the Add
+date field and Add datetime field algorithms: every string must parse to the
+same datetime, or raise ValueError when strptime does.
+'''
+
+from datetime import datetime
+import random
+
+import pytest
+
+from date_parsing import datetime_parser, iso_parser, regex_parser
+
+# the formats offered by the Add date field and Add datetime field algorithms
+FORMATS = ['%Y-%m-%d %H:%M:%SZ',
+           '%d/%m/%Y %H:%M:%S',
+           '%d-%m-%Y',
+           '%d/%m/%Y',
+           '%Y-%m-%d',
+           '%Y/%m/%d',
+           '%Y-%m-%dT%H:%M:%S',
+           '%d/%m/%y %H:%M',
+           '%H:%M:%S.%f',
+           '%d %b %Y']
+
+EXAMPLES = ['2022-05-18 20:35:20Z', '2022-05-18 20:35:20z', '2022-05-18 20:35:20', '2022-05-18T20:35:20Z',
+            '18/05/2022 00:06:02', '18/5/2022 0:6:2', '18-05-2022', '18/05/2022', '2022-05-18', '2022/05/18',
+            '2022-5-18', '2022-05-18T20:35:20', '2022-05-18 20:35:20+09:30', '18/05/22 23:59', '18/05/69 00:00',
+            '18/05/68 00:00', '20:35:20.5', '20:35:20.123456', '18 May 2022', '29/02/2023', '31/04/2022',
+            '2022-02-30', '24:00:00.0', ' 18/05/2022', '18/05/2022 ', '', '2022-05-18 20:35:60Z',
+            '2022-05-18  20:35:20Z', '１８/05/2022']
+
+
+def strptime_or_error(value, fmt):
+    try:
+        return datetime.strptime(value, fmt)
+    except ValueError:
+        return ValueError
+
+
+def parse_or_error(parse, value):
+    try:
+        return parse(value)
+    except ValueError:
+        return ValueError
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+@pytest.mark.parametrize('cache_size', [0, 16])
+def test_examples_match_strptime(fmt, cache_size):
+    parse = datetime_parser(fmt, cache_size)
+    for value in EXAMPLES:
+        assert parse_or_error(parse, value) == strptime_or_error(value, fmt), value
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_fuzzed_strings_match_strptime(fmt):
+    rng = random.Random(fmt)
+    parse = datetime_parser(fmt)
+    for _ in range(2000):
+        value = datetime(rng.randint(1, 9999), rng.randint(1, 12), rng.randint(1, 28),
+                         rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59),
+                         rng.randint(0, 999999)).strftime(fmt)
+        # mutate some characters so that invalid and unusual strings are tried too
+        for _ in range(rng.choice([0, 0, 1, 2])):
+            i = rng.randrange(len(value)+1)
+            value = value[:i]+rng.choice('0123456789 /-:TZ.')+value[i+1:]
+        assert parse_or_error(parse, value) == strptime_or_error(value, fmt), value
+
+
+def test_formats_take_the_expected_parser():
+    assert iso_parser('%Y-%m-%d %H:%M:%SZ') is not None
+    assert iso_parser('%d/%m/%Y') is None
+    assert regex_parser('%d/%m/%Y %H:%M:%S') is not None
+    # month names are left to strptime
+    assert regex_parser('%d %b %Y') is None
@@ -0,0 +1,141 @@
+'''
+TimeIndex range searches against the datetime filter expressions they
+replaced, which compare the stored date and time of each feature (whatever
+its time zone) with the local date and time of the range ends.
+'''
+
+import os
+
+import pytest
+
+qgis_core = pytest.importorskip('qgis.core')
+
+from qgis.PyQt.QtCore import Qt, QDate, QDateTime, QTime
+
+import time_index
+from time_index import TimeIndex, evict_indexes, file_stamp
+
+
+class Feature:
+    def __init__(self, fid, value):
+        self.fid = fid
+        self.value = value
+
+    def __getitem__(self, field):
+        return self.value
+
+    def id(self):
+        return self.fid
+
+
+class CollarLayer:
+    '''Vector layer stand in with one datetime per feature'''
+
+    def __init__(self, values):
+        self.features = [Feature(fid, value) for fid, value in enumerate(values)]
+
+    def fields(self):
+        return qgis_core.QgsFields()
+
+    def featureCount(self):
+        return len(self.features)
+
+    def getFeatures(self, request=None):
+        return iter(self.features)
+
+
+def wall_clock(value):
+    return (value.date().toJulianDay(), value.time().msecsSinceStartOfDay())
+
+
+def fix_datetimes():
+    '''Fixes every 37 minutes over four days, in UTC, in local time and at a
+    +09:30 offset, in no particular order'''
+    values = []
+    start = QDateTime(QDate(2022, 5, 17), QTime(0, 0), Qt.UTC)
+    for i in range(160):
+        utc = start.addSecs(i*37*60)
+        if i % 3 == 0:
+            values.append(utc)
+        elif i % 3 == 1:
+            values.append(QDateTime(utc.date(), utc.time()))
+        else:
+            values.append(QDateTime(utc.date(), utc.time(), Qt.OffsetFromUTC, 34200))
+    return values[::2]+values[1::2]
+
+
+@pytest.fixture
+def values():
+    return fix_datetimes()
+
+
+@pytest.fixture
+def index(values):
+    return TimeIndex.build(CollarLayer(values), 'datetime')
+
+
+@pytest.mark.parametrize('start, end', [((2022, 5, 17, 10, 0), (2022, 5, 18, 3, 30)),
+                                        ((2022, 5, 18, 0, 0), (2022, 5, 18, 23, 59)),
+                                        ((2022, 5, 16, 0, 0), (2022, 5, 25, 0, 0)),
+                                        ((2022, 5, 19, 12, 0), (2022, 5, 19, 11, 0))])
+def test_range_matches_filter_expression(values, index, start, end):
+    # range ends as they come from the (local time) QDateTimeEdit widgets
+    start = QDateTime(QDate(*start[:3]), QTime(*start[3:]))
+    end = QDateTime(QDate(*end[:3]), QTime(*end[3:]))
+    expected = sorted((wall_clock(value), fid) for fid, value in enumerate(values)
+                      if wall_clock(start) <= wall_clock(value) <= wall_clock(end))
+    assert index.range_fids(start, end) == [fid for value, fid in expected]
+    assert index.range_count(start, end) == len(expected)
+
+
+def test_day_fids(values, index):
+    date = QDate(2022, 5, 18)
+    expected = sorted((wall_clock(value), fid) for fid, value in enumerate(values) if value.date() == date)
+    assert index.day_fids(date) == [fid for value, fid in expected]
+
+
+def test_minimum_and_maximum_keep_the_stored_date_and_time(values, index):
+    assert wall_clock(index.minimum()) == min(wall_clock(value) for value in values)
+    assert wall_clock(index.maximum()) == max(wall_clock(value) for value in values)
+
+
+def test_empty_index():
+    index = TimeIndex.build(CollarLayer([]), 'datetime')
+    assert len(index) == 0
+    assert index.minimum() is None
+    assert index.range_fids(QDateTime.currentDateTime(), QDateTime.currentDateTime()) == []
+
+
+def test_file_stamp_covers_edit_sidecar_files(tmp_path):
+    gpkg = tmp_path/'collars.gpkg'
+    gpkg.write_bytes(b'gpkg')
+    stamp = file_stamp(str(gpkg))
+    (tmp_path/'collars.gpkg-wal').write_bytes(b'saved edit')
+    assert not (file_stamp(str(gpkg)) == stamp).all()
+
+    shp = tmp_path/'collars.shp'
+    shp.write_bytes(b'shp')
+    (tmp_path/'collars.dbf').write_bytes(b'dbf')
+    stamp = file_stamp(str(shp))
+    (tmp_path/'collars.dbf').write_bytes(b'edited dbf')
+    os.utime(tmp_path/'collars.dbf', ns=(1, 1))
+    assert not (file_stamp(str(shp)) == stamp).all()
+
+
+def test_subset_keeps_the_order_of_the_index(values, index):
+    start = QDateTime(QDate(2022, 5, 17), QTime(0, 0))
+    end = QDateTime(QDate(2022, 5, 20), QTime(0, 0))
+    subset_fids = [fid for fid in range(len(values)) if fid % 4 == 1]
+    subset = index.subset(subset_fids)
+    assert subset.range_fids(start, end) == [fid for fid in index.range_fids(start, end) if fid % 4 == 1]
+
+
+def test_least_recently_used_indexes_are_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(time_index, 'CACHE_DIR', str(tmp_path))
+    for i in range(5):
+        path = tmp_path/f'{i}.npz'
+        path.write_bytes(b'x'*100)
+        os.utime(path, (i, i))
+    (tmp_path/'partial.tmp.npz').write_bytes(b'x'*100)
+    evict_indexes(keep=str(tmp_path/'0.npz'), size_limit=250)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['0.npz', '4.npz', 'partial.tmp.npz']
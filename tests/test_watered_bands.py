@@ -0,0 +1,75 @@
+'''
+WateredBands.band_indices() against the band scan which Time per watered band
+used before (the first band in layer order with inner < distance < outer).
+'''
+
+import numpy as np
+import pytest
+
+qgis_core = pytest.importorskip('qgis.core')
+
+from watered_bands import WateredBands, band_limits
+
+
+class Feature:
+    def __init__(self, band_key):
+        self.band_key = band_key
+
+    def __getitem__(self, field):
+        return self.band_key
+
+    def geometry(self):
+        return qgis_core.QgsGeometry()
+
+
+class BandSource:
+    '''Feature source stand in with a band name per feature'''
+
+    def __init__(self, band_keys):
+        self.features = [Feature(key) for key in band_keys]
+
+    def fields(self):
+        return qgis_core.QgsFields()
+
+    def getFeatures(self, request=None):
+        return iter(self.features)
+
+
+def scanned_band_key(band_keys, dtw):
+    for k in band_keys:
+        inner_dist = int(k.split('-')[0])
+        outer_dist = int(k.split('-')[1][:-1])
+        if inner_dist < dtw < outer_dist:
+            return k
+
+
+# not in distance order, with a gap between 2000 and 3000 and a repeated band
+BAND_KEYS = ['1000-1500m', '0-500m', '500-1000m', '1500-2000m', '3000-4000m', '0-500m']
+
+
+def test_band_limits():
+    assert band_limits('1000-1500m') == (1000, 1500)
+
+
+def test_repeated_bands_are_read_once():
+    bands = WateredBands(BandSource(BAND_KEYS), 'band')
+    assert bands.keys == ['1000-1500m', '0-500m', '500-1000m', '1500-2000m', '3000-4000m']
+    assert len(bands) == 5
+
+
+def test_band_indices_match_band_scan():
+    bands = WateredBands(BandSource(BAND_KEYS), 'band')
+    rng = np.random.default_rng(0)
+    distances = np.concatenate([rng.uniform(-100, 4500, 5000),
+                                # band limits themselves are in no band
+                                [0, 500, 1000, 1500, 2000, 2500, 3000, 4000, -1, 4001, np.nan]])
+    indices = bands.band_indices(distances)
+    for distance, index in zip(distances.tolist(), indices.tolist()):
+        expected = scanned_band_key(bands.keys, distance)
+        assert (None if index < 0 else bands.keys[index]) == expected, distance
+        assert bands.band_key(distance) == expected
+
+
+def test_no_bands():
+    bands = WateredBands(BandSource([]), 'band')
+    assert bands.band_indices([10.0, 20.0]).tolist() == [-1, -1]